@@ -1,11 +1,16 @@
 from aws_cdk import aws_apigateway as _apigw
+from aws_cdk import aws_dynamodb as _dynamodb
+from aws_cdk import aws_kms as _kms
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk import aws_logs as _logs
 from aws_cdk import aws_iam as _iam
 from aws_cdk import core
 
+import json
 import os
 
+from bundling.lambda_bundle import AssetBundler
+
 
 class ApiConsumersStack(core.Stack):
 
@@ -15,34 +20,110 @@ class ApiConsumersStack(core.Stack):
         id: str,
         unicorn_user_pool_secrets_arn,
         premium_content_api_url,
+        premium_content_batch_api_url,
+        perf_profile,
+        app_clients=None,
+        api_key_clients=None,
         ** kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
 
-        # Create Serverless Event Processor using Lambda):
-        # Read Lambda Code
-        try:
-            with open("api_consumers/lambda_src/content_consumers.py", mode="r") as f:
-                content_consumers_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
+        # The function ships only the modules it imports, byte-compiled ahead
+        bundler = AssetBundler.from_context(
+            self.node, perf_profile.python_version, ["lambda_layers/shared"])
+        content_consumers_asset = bundler.function(
+            "content_consumers", "api_consumers/lambda_src", "content_consumers")
+
+        # Code shared by the functions, lazily built AWS clients, http pool, logging etc.
+        shared_layer = _lambda.LayerVersion(
+            self,
+            "sharedLayer",
+            code=_lambda.Code.from_asset(
+                bundler.layer("shared_layer", "lambda_layers/shared")),
+            compatible_runtimes=[perf_profile.runtime],
+            description="Code shared by the lambda functions"
+        )
+
+        # Access tokens shared by the containers of the function, so a new
+        # container takes a still valid token instead of minting its own
+        token_store = self.node.try_get_context("token_store") or {}
+        token_store_backend = token_store.get("backend", "none")
+        if token_store_backend not in ("none", "dynamodb", "ssm"):
+            raise ValueError(
+                f"Unsupported token_store backend: {token_store_backend}")
+        token_store_uri = ""
+        token_store_key = None
+        token_store_table = None
+        if token_store_backend != "none":
+            # Tokens are bearer credentials, they are stored encrypted
+            token_store_key = _kms.Key(
+                self,
+                "tokenStoreKey",
+                description="Encrypts the access tokens shared by the content consumers",
+                enable_key_rotation=True,
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+        if token_store_backend == "dynamodb":
+            token_store_table = _dynamodb.Table(
+                self,
+                "tokenStoreTable",
+                partition_key=_dynamodb.Attribute(
+                    name="pk",
+                    type=_dynamodb.AttributeType.STRING
+                ),
+                billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="ttl",
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+            token_store_uri = f"dynamodb:{token_store_table.table_name}"
+        elif token_store_backend == "ssm":
+            token_store_ssm_prefix = token_store.get(
+                "ssm_prefix", "/content-consumers/tokens").rstrip("/")
+            token_store_uri = f"ssm:{token_store_ssm_prefix}"
 
+        # Anyone can call the consumer api, a request may only select the app
+        # clients that list the route under `consumer_routes`
+        client_selection = {}
+        for app_client in app_clients or []:
+            for route in app_client.get("consumer_routes", []):
+                client_selection.setdefault(route, []).append(app_client["name"])
+
+        # Create Serverless Event Processor using Lambda):
+        # The function is shipped as an asset, as the token cache lives in its
+        # own module and the code no longer fits in the 4KB inline limit
         content_consumers_fn = _lambda.Function(
             self,
             "contentConsumersFn",
             function_name="content_consumers",
-            runtime=_lambda.Runtime.PYTHON_3_7,
-            handler="index.lambda_handler",
-            code=_lambda.InlineCode(
-                content_consumers_fn_code),
+            handler="content_consumers.lambda_handler",
+            code=_lambda.Code.from_asset(content_consumers_asset),
+            layers=[shared_layer],
             timeout=core.Duration.seconds(3),
-            reserved_concurrent_executions=1,
+            **perf_profile.function_props(),
             environment={
                 "LOG_LEVEL": "INFO",
+                "LOG_SAMPLE_RATES": "DEBUG=0.01",
+                "METRICS_SAMPLE_RATE": "1.0",
                 "Environment": "Production",
                 "USER_POOL_SECRETS_ARN": unicorn_user_pool_secrets_arn,
                 "PREMIUM_CONTENT_API_URL": premium_content_api_url,
+                "PREMIUM_CONTENT_BATCH_API_URL": premium_content_batch_api_url,
+                "BATCH_SIZE": "10",
+                "FANOUT_MAX_CONCURRENCY": "8",
+                "FANOUT_ROUTES": "/content/unauthorized-read,/content/authorized-read,/content/authorized-batch-read",
+                "CLIENT_SELECTION": json.dumps(client_selection),
+                "API_KEY_CLIENTS": self.to_json_string(api_key_clients or []),
+                "SECRET_CACHE_TTL_SECONDS": "300",
+                "TOKEN_EXPIRY_SKEW_SECONDS": "30",
+                "TOKEN_REFRESH_WINDOW_SECONDS": "120",
+                "TOKEN_STORE": token_store_uri,
+                "TOKEN_STORE_KMS_KEY_ID": token_store_key.key_arn if token_store_key else "",
+                "HTTP_CONNECT_TIMEOUT": "0.5",
+                "HTTP_READ_TIMEOUT": "2.0",
+                "RETRY_ATTEMPTS": "3",
+                "BREAKER_FAILURE_THRESHOLD": "5",
+                "BREAKER_RESET_SECONDS": "10",
+                "TOKEN_HEDGE_AFTER_MS": "300",
             }
         )
 
@@ -57,6 +138,44 @@ class ApiConsumersStack(core.Stack):
 
         content_consumers_fn.add_to_role_policy(roleStmt1)
 
+        if token_store_key:
+            token_store_key.grant_encrypt_decrypt(content_consumers_fn)
+        if token_store_table:
+            token_store_table.grant_read_write_data(content_consumers_fn)
+        if token_store_backend == "ssm":
+            roleStmt2 = _iam.PolicyStatement(
+                effect=_iam.Effect.ALLOW,
+                resources=[
+                    f"arn:aws:ssm:{core.Aws.REGION}:{core.Aws.ACCOUNT_ID}:parameter{token_store_ssm_prefix}/*"
+                ],
+                actions=[
+                    "ssm:GetParameter",
+                    "ssm:PutParameter",
+                    "ssm:DeleteParameter"
+                ]
+            )
+            roleStmt2.sid = "AllowLambdaToShareTokens"
+            content_consumers_fn.add_to_role_policy(roleStmt2)
+
+        if api_key_clients:
+            # Values of the api keys API Gateway generated for the app clients
+            roleStmt3 = _iam.PolicyStatement(
+                effect=_iam.Effect.ALLOW,
+                resources=[
+                    f"arn:aws:apigateway:{core.Aws.REGION}::/apikeys/{key_id}"
+                    for key_id, _client_id in api_key_clients
+                ],
+                actions=[
+                    "apigateway:GET"
+                ]
+            )
+            roleStmt3.sid = "AllowLambdaToReadApiKeys"
+            content_consumers_fn.add_to_role_policy(roleStmt3)
+
+        # Keep the function warm with provisioned concurrency, when the profile asks for it
+        content_consumers_fn_target = perf_profile.apply(
+            self, content_consumers_fn)
+
         # Create Custom Loggroup
         # /aws/lambda/function-name
         content_consumers_fn_lg = _logs.LogGroup(
@@ -70,8 +189,7 @@ class ApiConsumersStack(core.Stack):
         # Add API GW front end for the Lambda
         miztiik_world_api_stage_options = _apigw.StageOptions(
             stage_name="miztiik",
-            throttling_rate_limit=10,
-            throttling_burst_limit=100,
+            **perf_profile.stage_throttling(),
             logging_level=_apigw.MethodLoggingLevel.INFO
         )
 
@@ -81,10 +199,12 @@ class ApiConsumersStack(core.Stack):
             "miztiikWorld",
             rest_api_name="miztiik-world-api",
             deploy_options=miztiik_world_api_stage_options,
+            # Compressed bodies go back base64 encoded, API Gateway decodes them for the client
+            binary_media_types=["*/*"],
             endpoint_types=[
                 _apigw.EndpointType.REGIONAL
             ],
-            handler=content_consumers_fn,
+            handler=content_consumers_fn_target,
             proxy=False
         )
 
@@ -104,6 +224,14 @@ class ApiConsumersStack(core.Stack):
             "authorized-write")
         post_authorized_request_method = post_authorized_request.add_method(
             "GET")
+        # GET Authorized Batch Request
+        get_authorized_batch_request = get_content.add_resource(
+            "authorized-batch-read")
+        get_authorized_batch_request_method = get_authorized_batch_request.add_method(
+            "GET")
+        # GET all of the above concurrently, in one call
+        get_aggregate_request = get_content.add_resource("aggregate")
+        get_aggregate_request_method = get_aggregate_request.add_method("GET")
 
         output_1 = core.CfnOutput(self,
                                   "UnauthorizedUrl",
@@ -120,3 +248,13 @@ class ApiConsumersStack(core.Stack):
                                   value=f"{post_authorized_request.url}",
                                   description="Use a browser to access this url"
                                   )
+        output_4 = core.CfnOutput(self,
+                                  "AuthorizedBatchReadUrl",
+                                  value=f"{get_authorized_batch_request.url}",
+                                  description="Use a browser to access this url"
+                                  )
+        output_5 = core.CfnOutput(self,
+                                  "AggregateUrl",
+                                  value=f"{get_aggregate_request.url}",
+                                  description="Use a browser to access this url"
+                                  )
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: client_registry
+    :Actions: Index of the app clients in the user pool secret, by client id & name
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+The `cognito_{user_pool_id}` secret has the fields of the pool's primary
+app client at the top level and, with more clients, each of them under
+`app_clients` by client id, with only what differs per client,
+
+    {"user_pool_client_id": "abc", "app_client_secret": "..",
+     "user_pool_oauth2_endpoint": "..", ...,
+     "app_clients": {"abc": {"client_name": "premium_app_users",
+                             "app_client_secret": "..", "scopes": ["read"]},
+                     ...}}
+
+The registry is built once per secret document, lookups are dict reads, so
+their cost does not grow with the number of clients. Onboarding a client is
+a stack deploy, the secret picks it up, the code stays the same.
+"""
+
+
+class RegistryError(Exception):
+    """ The request can not be served with the app client it selected """
+    status_code = 400
+
+
+class UnknownClientError(RegistryError):
+    status_code = 400
+
+
+class ScopeNotAllowedError(RegistryError):
+    status_code = 403
+
+
+class ClientConfig:
+    """ What the consumer needs to mint tokens for one app client """
+    __slots__ = ("client_id", "client_secret", "name", "scopes",
+                 "oauth2_endpoint", "res_srv_identifier")
+
+    def __init__(self, client_id, client_secret, name, scopes, oauth2_endpoint, res_srv_identifier):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.name = name
+        # `None` when the secret does not say, the token endpoint decides then
+        self.scopes = frozenset(scopes) if scopes is not None else None
+        self.oauth2_endpoint = oauth2_endpoint
+        self.res_srv_identifier = res_srv_identifier
+
+    def allows(self, scope):
+        return self.scopes is None or scope in self.scopes
+
+    def scope_uri(self, scope):
+        """ `read` -> `premium_api/read`, as the token endpoint expects it """
+        return f"{self.res_srv_identifier}/{scope}"
+
+
+class ClientRegistry:
+    """ App clients of a secret document, by client id and by client name """
+
+    def __init__(self, clients, default_client_id):
+        self._by_id = {_c.client_id: _c for _c in clients}
+        self._by_name = {_c.name: _c for _c in clients if _c.name}
+        self.default_client_id = default_client_id
+
+    @classmethod
+    def from_document(cls, doc):
+        entries = doc.get("app_clients") or {
+            doc["user_pool_client_id"]: doc}
+        clients = []
+        for client_id, _e in entries.items():
+            # Pool wide fields only come from the top level when the entry
+            # does not have its own
+            clients.append(ClientConfig(
+                client_id,
+                _e.get("app_client_secret"),
+                _e.get("client_name"),
+                _e.get("scopes"),
+                _e.get("user_pool_oauth2_endpoint",
+                       doc["user_pool_oauth2_endpoint"]),
+                _e.get("unicorn_user_pool_res_srv_identifier",
+                       doc["unicorn_user_pool_res_srv_identifier"])
+            ))
+        return cls(clients, doc["user_pool_client_id"])
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def get(self, client=None):
+        """ The client with this id or name, the default client for `None` """
+        if not client:
+            client = self.default_client_id
+        _c = self._by_id.get(client) or self._by_name.get(client)
+        if _c is None:
+            raise UnknownClientError(f"Unknown app client: {client}")
+        return _c
+
+    def select(self, client, scope):
+        """ `get`, checking the client may ask for `scope` before any token is minted """
+        _c = self.get(client)
+        if not _c.allows(scope):
+            raise ScopeNotAllowedError(
+                f"App client {_c.name or _c.client_id} may not use the {scope} scope")
+        return _c
+
+
+class RegistryCache:
+    """
+    Registry of the document a `SecretCache` holds, rebuilt only when the
+    cache read a new document, per version stage.
+    """
+
+    def __init__(self, secret_cache):
+        self.secret_cache = secret_cache
+        self._registries = {}
+
+    def get(self, version_stage="AWSCURRENT", force_refresh=False):
+        doc = self.secret_cache.get(
+            version_stage=version_stage, force_refresh=force_refresh)
+        _r = self._registries.get(version_stage)
+        if _r is None or _r[0] is not doc:
+            _r = (doc, ClientRegistry.from_document(doc))
+            self._registries[version_stage] = _r
+        return _r[1]
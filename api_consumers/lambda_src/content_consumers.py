@@ -7,11 +7,23 @@
 .. contactauthor:: miztiik@github issues
 """
 
-import boto3
+import base64
 import json
-import logging
+import math
 import os
-from botocore.vendored import requests
+
+from shared import aws_clients, http_client
+from shared.api_request import ApiRequest, Router, error_response
+from shared.compression import decompress, encode_response, negotiate, supported_encodings
+from shared.metrics import metrics
+from shared.structured_logging import event_summary, log_fields, set_logging
+from client_registry import RegistryCache, RegistryError
+from fanout_client import Deadline, FanoutClient
+from resilience import (DependencyError, ThrottledError, circuit_breaker, error_for_exception,
+                        error_for_status, hedged_call, retry_call)
+from secret_cache import SecretCache
+from token_cache import TokenCache
+from token_store import token_store_from_uri
 
 
 __author__ = "Mystique"
@@ -26,102 +38,517 @@ class global_args:
     ENVIRONMENT = "production"
     MODULE_NAME = "premium_content"
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
     USER_POOL_SECRETS_ARN = os.getenv("USER_POOL_SECRETS_ARN")
     PREMIUM_CONTENT_API_URL = os.getenv("PREMIUM_CONTENT_API_URL")
+    PREMIUM_CONTENT_BATCH_API_URL = os.getenv("PREMIUM_CONTENT_BATCH_API_URL")
+    BATCH_SIZE = int(os.getenv("BATCH_SIZE", 10))
+    MAX_BATCH_SIZE = 50
+    SECRET_CACHE_TTL_SECONDS = int(os.getenv("SECRET_CACHE_TTL_SECONDS", 300))
+    TOKEN_EXPIRY_SKEW_SECONDS = int(os.getenv("TOKEN_EXPIRY_SKEW_SECONDS", 30))
+    TOKEN_REFRESH_WINDOW_SECONDS = int(
+        os.getenv("TOKEN_REFRESH_WINDOW_SECONDS", 120))
+    TOKEN_STORE = os.getenv("TOKEN_STORE", "")
+    TOKEN_STORE_KMS_KEY_ID = os.getenv("TOKEN_STORE_KMS_KEY_ID")
+    FANOUT_MAX_CONCURRENCY = int(os.getenv("FANOUT_MAX_CONCURRENCY", 8))
+    RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", 3))
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+    BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 10))
+    TOKEN_HEDGE_AFTER_MS = int(os.getenv("TOKEN_HEDGE_AFTER_MS", 300))
+    # Budget of token requests made outside of an invocation
+    TOKEN_BUDGET_SECONDS = float(os.getenv("TOKEN_BUDGET_SECONDS", 2))
+    # Consumer route -> names of the app clients a request may select on it,
+    # "*" for any of them. Selections not listed here get the default client.
+    CLIENT_SELECTION = json.loads(os.getenv("CLIENT_SELECTION") or "{}")
+    # [[api key id, app client id], ..] of the keys API Gateway generated,
+    # the clients not listed send their client id as the key
+    API_KEY_CLIENTS = json.loads(os.getenv("API_KEY_CLIENTS") or "[]")
+    FANOUT_ROUTES = [r for r in os.getenv(
+        "FANOUT_ROUTES",
+        "/content/unauthorized-read,/content/authorized-read,/content/authorized-batch-read"
+    ).split(",") if r]
 
 
-def set_logging(lv=global_args.LOG_LEVEL):
-    """ Helper to enable logging """
-    logging.basicConfig(level=lv)
-    logger = logging.getLogger()
-    logger.setLevel(lv)
-    return logger
+# Initial some defaults in global context to reduce lambda start time, when re-using container
+logger = set_logging(global_args.LOG_LEVEL, global_args.LOG_SAMPLE_RATES)
 
+_secret_cache = SecretCache(
+    global_args.USER_POOL_SECRETS_ARN,
+    client_factory=lambda: aws_clients.client("secretsmanager"),
+    ttl=global_args.SECRET_CACHE_TTL_SECONDS
+)
 
-# Initial some defaults in global context to reduce lambda start time, when re-using container
-logger = set_logging()
+# App clients of the secret, by id & name, rebuilt when the secret changes
+_registry = RegistryCache(_secret_cache)
 
-_sec_client = boto3.client("secretsmanager")
 
+class RelayedBody:
+    """
+    Premium api response body relayed to the caller as it came, still
+    compressed. The premium api answers `{"message": ...}` like this api does,
+    so there is nothing to parse and re-serialise.
+    """
+    __slots__ = ("raw", "content_encoding")
 
-def _cog_auth_token(api_path):
-    _t = ""
-    try:
-        resp = _sec_client.get_secret_value(
-            SecretId=global_args.USER_POOL_SECRETS_ARN
-        )
-        _d = json.loads(resp["SecretString"])
-
-        oauth2_url = _d["user_pool_oauth2_endpoint"]
-        client_id = _d["user_pool_client_id"]
-        client_secret = _d["app_client_secret"]
-        grant_type = "client_credentials"
-
-        resp = requests.post(
-            oauth2_url,
-            auth=(client_id, client_secret),
-            data={
-                "grant_type": grant_type,
-                "client_id": client_id,
-                "client_secret": client_secret,
-                "scope": f"{_d['unicorn_user_pool_res_srv_identifier']}/{api_path}"
+    def __init__(self, raw, content_encoding=None):
+        self.raw = raw
+        self.content_encoding = content_encoding
+
+    def to_response(self, accept_encoding):
+        _ce = self.content_encoding
+        if _ce and negotiate(accept_encoding, supported=(_ce,)) == _ce:
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Encoding": _ce, "Vary": "Accept-Encoding"},
+                "body": base64.b64encode(self.raw).decode("ascii"),
+                "isBase64Encoded": True
             }
+        # The caller can not take this coding, decode it once
+        return {
+            "statusCode": 200,
+            "body": decompress(self.raw, _ce).decode("utf-8")
+        }
+
+    def message(self):
+        """ The `message` of the body, for callers that need the content itself """
+        _d = json.loads(decompress(self.raw, self.content_encoding))
+        return _d.get("message", _d) if isinstance(_d, dict) else _d
+
+
+class InvalidClientError(Exception):
+    """ Raised when the token endpoint rejects the app client credentials """
+    pass
+
+
+def _breaker(dependency):
+    return circuit_breaker(
+        dependency,
+        failure_threshold=global_args.BREAKER_FAILURE_THRESHOLD,
+        reset_timeout=global_args.BREAKER_RESET_SECONDS
+    )
+
+
+# Deadline of the invocation in progress, for the calls made on its behalf
+_invocation_deadline = None
+
+
+def _current_deadline():
+    """ The invocation deadline, or a fresh budget for token requests made outside of one """
+    _dl = _invocation_deadline
+    if _dl is None or _dl.remaining() <= 0:
+        return Deadline(global_args.TOKEN_BUDGET_SECONDS)
+    return _dl
+
+
+def _request_token(client, scope, timeout=None):
+    grant_type = "client_credentials"
+    try:
+        with metrics.timer("CognitoTokenLatency"):
+            resp = http_client.request(
+                "POST",
+                client.oauth2_endpoint,
+                headers={"Authorization": http_client.basic_auth(
+                    client.client_id, client.client_secret)},
+                fields={
+                    "grant_type": grant_type,
+                    "client_id": client.client_id,
+                    "client_secret": client.client_secret,
+                    "scope": client.scope_uri(scope)
+                },
+                timeout=timeout
+            )
+    except Exception as e:
+        raise error_for_exception("Cognito", e)
+    _err = error_for_status(
+        "Cognito", resp.status, resp.headers.get("Retry-After"))
+    if _err is not None:
+        raise _err
+    _r = json.loads(resp.data)
+    if _r.get("error") == "invalid_client":
+        raise InvalidClientError(
+            f"Token endpoint rejected client {client.client_id}")
+    if "access_token" not in _r:
+        raise DependencyError(
+            "Cognito", f"token request failed: {_r.get('error')}", status_code=502)
+    return _r["access_token"], _r["expires_in"]
+
+
+def _resilient_token_request(client, scope):
+    """
+    Token request with a hedge after `TOKEN_HEDGE_AFTER_MS`, retried with
+    backoff within the deadline and failing fast while Cognito is degraded.
+    """
+    hedge_after = global_args.TOKEN_HEDGE_AFTER_MS / 1000
+    return retry_call(
+        lambda timeout: hedged_call(
+            lambda t: _request_token(client, scope, t), timeout, hedge_after, "Cognito"),
+        _current_deadline(),
+        attempts=global_args.RETRY_ATTEMPTS,
+        breaker=_breaker("Cognito")
+    )
+
+
+def _mint_token(key):
+    """ Exchange the app client credentials for an access token, `key` is `(client_id, scope)` """
+    client_id, scope = key
+    try:
+        return _resilient_token_request(_registry.get().get(client_id), scope)
+    except InvalidClientError as e:
+        logger.warning("%s, refreshing client secret", e)
+    # The cached credentials are stale, re-read them. During a rotation the new
+    # credentials may only be staged as AWSPENDING, so try those last.
+    try:
+        return _resilient_token_request(
+            _registry.get(force_refresh=True).get(client_id), scope)
+    except InvalidClientError:
+        return _resilient_token_request(
+            _registry.get(version_stage="AWSPENDING",
+                          force_refresh=True).get(client_id),
+            scope
         )
-        logger.debug(resp.json())
-        _t = resp.json()["access_token"]
-        logger.debug(_t)
+
+
+_token_cache = TokenCache(
+    _mint_token,
+    expiry_skew=global_args.TOKEN_EXPIRY_SKEW_SECONDS,
+    refresh_window=global_args.TOKEN_REFRESH_WINDOW_SECONDS,
+    # Keyed by (client_id, scope), containers share the tokens of a client
+    store=token_store_from_uri(
+        global_args.TOKEN_STORE, global_args.TOKEN_STORE_KMS_KEY_ID)
+)
+
+
+# App client id -> id of its api key, the values are read once per container
+_api_key_ids = {
+    client_id: key_id for key_id, client_id in global_args.API_KEY_CLIENTS}
+_api_keys = {}
+
+
+def _api_key(client_id):
+    """ Value of the app client's api key """
+    key_id = _api_key_ids.get(client_id)
+    if key_id is None:
+        return client_id
+    _k = _api_keys.get(key_id)
+    if _k is None:
+        _k = aws_clients.client("apigateway").get_api_key(
+            apiKey=key_id, includeValue=True)["value"]
+        _api_keys[key_id] = _k
+    return _k
+
+
+def _selected_client(request):
+    """
+    App client id or name the request asks for, `None` for the default client.
+    The consumer api is open to anyone, so a request only picks a client the
+    route allows it to under `CLIENT_SELECTION`, it gets the default otherwise.
+    """
+    client = request.header("x-client-id") or request.query.get("client")
+    if not client:
+        return None
+    allowed = global_args.CLIENT_SELECTION.get(request.resource, ())
+    if client in allowed or "*" in allowed:
+        return client
+    metrics.incr("ClientSelectionIgnored")
+    logger.info("App client selection not allowed on the route, using the default",
+                extra=log_fields(client=client, route=request.resource))
+    return None
+
+
+def _auth_headers(client, scope):
+    """
+    Id of the app client with this id or name, along with its access token for
+    `scope` and its api key, the premium api meters & throttles each client on it
+    """
+    try:
+        _c = _registry.get().select(client, scope)
+        return _c.client_id, {
+            "Authorization": _token_cache.get((_c.client_id, scope)),
+            "x-api-key": _api_key(_c.client_id)
+        }
+    except RegistryError:
+        raise
+    except DependencyError:
+        metrics.incr("TokenErrors")
+        raise
+    except InvalidClientError as e:
+        metrics.incr("TokenErrors")
+        raise DependencyError("Cognito", str(e), status_code=502)
     except Exception as e:
-        logger.error(f"{str(e)}")
-    return _t
+        # Secrets Manager, the shared token store or the api key lookup
+        metrics.incr("TokenErrors")
+        raise error_for_exception("TokenSource", e)
 
 
-def get_content(e):
-    data = f""
-    _t = ""
-    _m_verb = "GET"
-    api_path = e["requestContext"]["resourcePath"]
-    logger.debug(f"api_path:{api_path}")
+# Consumer route -> (premium api method, scope needed to call it)
+_CONTENT_ROUTES = {
+    "/content/unauthorized-read": ("GET", None),
+    "/content/authorized-read": ("GET", "read"),
+    "/content/authorized-write": ("POST", "write"),
+    "/content/authorized-batch-read": ("BATCH", "read"),
+}
+
+# Ask the premium api for a compressed body, in the codings we can read back
+_ACCEPT_ENCODING = ", ".join(supported_encodings())
+
+
+def _premium_request(method, url, headers, deadline, body=None, idempotent=True):
+    """
+    Premium api call behind its circuit breaker, retried within the deadline.
+    Non idempotent calls are only retried when throttled, as that is the one
+    answer known to mean the request was not processed.
+    """
+    def _call(timeout):
+        try:
+            with metrics.timer("PremiumApiLatency"):
+                resp = http_client.request(
+                    method,
+                    url,
+                    headers=headers,
+                    body=body,
+                    preload_content=False,
+                    timeout=timeout
+                )
+                try:
+                    # Keep the body as it came over the wire, it is relayed
+                    # compressed when the caller accepts the same coding
+                    raw = resp.read(decode_content=False)
+                finally:
+                    resp.release_conn()
+        except Exception as e:
+            raise error_for_exception("PremiumApi", e)
+        _err = error_for_status(
+            "PremiumApi", resp.status, resp.headers.get("Retry-After"))
+        if _err is not None:
+            raise _err
+        return resp, raw
 
-    if api_path == "/content/authorized-read" or api_path == "/content/authorized-write":
-        _t = _cog_auth_token(api_path.split("-")[1])
+    return retry_call(
+        _call,
+        deadline,
+        attempts=global_args.RETRY_ATTEMPTS,
+        breaker=_breaker("PremiumApi"),
+        retry_on=None if idempotent else (
+            lambda err: isinstance(err, ThrottledError))
+    )
 
-    if api_path == "/content/authorized-write":
-        _m_verb = "POST"
 
+def _relayed_error(resp, raw):
+    """
+    `DependencyError` carrying the premium api's own 4xx, `None` for any other
+    status. The 429s and 5xxs were raised already, retryable, by the call.
+    """
+    if not 400 <= resp.status < 500:
+        return None
+    message = f"answered {resp.status}"
     try:
-        resp = requests.request(
-            _m_verb,
-            global_args.PREMIUM_CONTENT_API_URL,
-            headers={"Authorization": _t}
-        )
-        logger.debug(f"ResData:{resp.text}")
-        data = json.loads(resp.text)
+        _d = json.loads(decompress(raw, resp.headers.get("Content-Encoding")))
+        message = f"{message}: {_d.get('message', _d) if isinstance(_d, dict) else _d}"
+    except ValueError:
+        pass
+    return DependencyError("PremiumApi", message, status_code=resp.status)
+
+
+def _empty_body_error(raw):
+    """ `DependencyError` when the premium api answered without a body to relay """
+    if raw:
+        return None
+    return DependencyError("PremiumApi", "answered without a body", status_code=502)
+
+
+def get_batch_content(request, auth_headers, deadline):
+    """ Fetch `BATCH_SIZE` premium items, or `?items=<n>`, in a single api call """
+    try:
+        n = int(request.query.get("items", global_args.BATCH_SIZE))
+    except ValueError:
+        n = global_args.BATCH_SIZE
+    n = max(1, min(n, global_args.MAX_BATCH_SIZE))
+    items = [
+        {"id": str(i), "method": "GET", "path": "/home/premium"} for i in range(n)
+    ]
+
+    # Only reads in the batch, so it is safe to retry
+    resp, raw = _premium_request(
+        "POST",
+        global_args.PREMIUM_CONTENT_BATCH_API_URL,
+        dict(auth_headers,
+             **{"Content-Type": "application/json",
+                "Accept-Encoding": _ACCEPT_ENCODING}),
+        deadline,
+        body=json.dumps({"items": items})
+    )
+    logger.debug("premium api batch response", extra=log_fields(
+        status=resp.status, body_bytes=len(raw)))
+    _err = _relayed_error(resp, raw) or _empty_body_error(raw)
+    if _err is not None:
+        raise _err
+    _d = json.loads(decompress(raw, resp.headers.get("Content-Encoding")))
+    if resp.status != 207:
+        return _d.get("message", "") if isinstance(_d, dict) else _d
+
+    # Every item succeeds or fails on its own
+    data = []
+    for r in _d["responses"]:
+        _b = r.get("body") or {}
+        data.append({
+            "id": r.get("id"),
+            "status": r.get("status"),
+            "message": _b.get("message", "") if isinstance(_b, dict) else _b
+        })
+        if r.get("status", 500) >= 400:
+            metrics.incr("PremiumApiBatchItemErrors")
+    return data
+
+
+# (app client id, consumer route) -> (ETag, content) of the last premium api
+# GET, revalidated with `If-None-Match` so unchanged content is not sent again.
+# Keyed by client too, clients may be served different content.
+_content_etags = {}
+
+
+def get_content(request, deadline=None):
+    data = f""
+    _client_id, _auth = None, {"Authorization": ""}
+    api_path = request.resource
+    logger.debug("api_path: %s", api_path)
+    deadline = deadline or _current_deadline()
+
+    _m_verb, _scope = _CONTENT_ROUTES.get(api_path, ("GET", None))
+    if _scope:
+        _client_id, _auth = _auth_headers(_selected_client(request), _scope)
+    if _m_verb == "BATCH":
+        return get_batch_content(request, _auth, deadline)
+
+    headers = dict(_auth, **{"Accept-Encoding": _ACCEPT_ENCODING})
+    etag_key = (_client_id, api_path)
+    _cached = _content_etags.get(etag_key) if _m_verb == "GET" else None
+    if _cached:
+        headers["If-None-Match"] = _cached[0]
+
+    resp, raw = _premium_request(
+        _m_verb,
+        global_args.PREMIUM_CONTENT_API_URL,
+        headers,
+        deadline,
+        idempotent=_m_verb == "GET"
+    )
+    _ce = resp.headers.get("Content-Encoding")
+    logger.debug("premium api response", extra=log_fields(
+        status=resp.status, body_bytes=len(raw), content_encoding=_ce))
+    if resp.status == 304:
+        if not _cached:
+            # Nothing of ours to revalidate, there is no body to relay
+            raise DependencyError(
+                "PremiumApi", "not modified, without a cached copy", status_code=502)
+        metrics.incr("PremiumApiNotModified")
+        return _cached[1]
+    # Our caller gets the premium api's 401, 403, 404 etc., not a 200 saying so
+    _err = _relayed_error(resp, raw) or _empty_body_error(raw)
+    if _err is not None:
+        raise _err
+    if "json" in resp.headers.get("Content-Type", "application/json"):
+        data = RelayedBody(raw, _ce)
+    else:
+        data = json.loads(decompress(raw, _ce))
         if "message" in data:
             data = data["message"]
-    except Exception as e:
-        logger.error(f"{str(e)}")
+    _etag = resp.headers.get("ETag")
+    if _m_verb == "GET" and resp.status == 200 and _etag:
+        _content_etags[etag_key] = (_etag, data)
 
     if not data:
         data = "Something Obviously went wrong, Let me check"
-    logger.debug(data)
     return data
 
 
+_fanout = FanoutClient(max_concurrency=global_args.FANOUT_MAX_CONCURRENCY)
+
+
+def get_aggregate_content(request, deadline):
+    """
+    Content of every `FANOUT_ROUTES` route, fetched concurrently. Each route
+    succeeds or fails on its own, the slowest one sets the latency.
+    """
+    def _route_call(route):
+        _r = request.replace(resource=route)
+        return lambda timeout: get_content(_r, Deadline(timeout))
+
+    results = _fanout.run(
+        {route: _route_call(route) for route in global_args.FANOUT_ROUTES},
+        deadline
+    )
+    data = []
+    for route, r in results.items():
+        if r.ok:
+            value = r.value.message() if isinstance(
+                r.value, RelayedBody) else r.value
+            data.append({"route": route, "status": "ok", "message": value,
+                         "elapsed_ms": round(r.elapsed_ms, 2)})
+        else:
+            logger.error("Fan-out call to %s failed: %s", route, r.error)
+            data.append({"route": route, "status": "error",
+                         "status_code": getattr(r.error, "status_code", 500),
+                         "message": str(r.error)})
+    return data
+
+
+# Every consumer route is a GET, served by its handler with `(request, deadline)`
+_router = Router()
+for _route in _CONTENT_ROUTES:
+    _router.add("GET", _route, get_content)
+_router.add("GET", "/content/aggregate", get_aggregate_content)
+
+
+def _error_response(status_code, message, retry_after=None):
+    return error_response(
+        status_code,
+        message,
+        {"Retry-After": str(int(math.ceil(retry_after)))} if retry_after else None
+    )
+
+
+@metrics.instrument
 def lambda_handler(event, context):
-    logger.debug(f"received_event:{event}")
+    global _invocation_deadline
+    logger.debug("received_event", extra=log_fields(
+        event=lambda: event_summary(event)))
+    request = ApiRequest.from_event(event)
+    handler = _router.match(request.http_method, request.resource)
+    if handler is None:
+        return _router.unmatched(request.http_method, request.resource)
+    accept_encoding = request.header("accept-encoding")
     try:
         data = ""
-        data = get_content(event)
+        # Leave time to answer before the function times out
+        _invocation_deadline = deadline = Deadline.from_context(context)
+        data = handler(request, deadline)
+    except RegistryError as e:
+        # Unknown app client, or one not allowed the scope of the route
+        logger.info("%s", e)
+        return _error_response(e.status_code, str(e))
+    except DependencyError as e:
+        # Throttled(429), degraded(502/503) or out of time(504), say which
+        metrics.incr(f"{e.dependency}Errors")
+        logger.error("%s", e)
+        return _error_response(e.status_code, str(e), e.retry_after)
     except Exception as e:
-        logger.error(f"{str(e)}")
+        metrics.incr("Errors")
+        logger.exception("%s", e)
+        return _error_response(500, "Something Obviously went wrong, Let me check")
+    finally:
+        _invocation_deadline = None
+        metrics.put("SecretCacheAge", _secret_cache.age(), "Seconds")
+
+    if isinstance(data, RelayedBody):
+        return encode_response(data.to_response(accept_encoding), accept_encoding)
 
     if not data:
         data = "Something Obviously went wrong, Let me check"
-    return {
+    return encode_response({
         "statusCode": 200,
         "body": json.dumps(
             {
                 "message": data
             }
         )
-    }
+    }, accept_encoding)
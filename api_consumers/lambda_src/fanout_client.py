@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: fanout_client
+    :Actions: Run blocking calls concurrently on asyncio, bounded and under a deadline
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    deadline = Deadline.from_context(context)
+    results = fanout.run({
+        "read": lambda timeout: get_content(read_event, timeout),
+        "batch": lambda timeout: get_content(batch_event, timeout),
+    }, deadline)
+
+Every call gets the time left on the deadline as its `timeout` argument, to
+pass on to its own I/O. The calls are blocking(_urllib3, boto3_), asyncio
+runs them on a thread pool with at most `max_concurrency` in flight, so the
+whole fan-out takes as long as the slowest call rather than their sum. Calls
+still running when the deadline passes are cancelled and reported as
+`DeadlineExceeded`, the invocation does not wait for them.
+
+asyncio and the thread pool cost ~60ms to import, they are only imported by
+the first fan-out so the other routes do not pay for them at cold start.
+"""
+
+import threading
+import time
+
+from shared.metrics import metrics
+
+
+class DeadlineExceeded(Exception):
+    """ The call did not finish before the invocation deadline """
+    pass
+
+
+class Deadline:
+    """ Absolute point in time the calls of an invocation must finish by """
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_context(cls, context, reserve_ms=250, default_ms=3000):
+        """
+        Deadline from `context.get_remaining_time_in_millis()`, keeping
+        `reserve_ms` to build and return the response.
+        """
+        remaining_ms = default_ms
+        if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+            remaining_ms = context.get_remaining_time_in_millis()
+        return cls(max(0, remaining_ms - reserve_ms) / 1000)
+
+    def remaining(self):
+        """ Seconds left, never negative """
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+class CallResult:
+    """ Outcome of one call of a fan-out """
+    __slots__ = ("key", "value", "error", "elapsed_ms")
+
+    def __init__(self, key, value=None, error=None, elapsed_ms=0.0):
+        self.key = key
+        self.value = value
+        self.error = error
+        self.elapsed_ms = elapsed_ms
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class FanoutClient:
+    """
+    Runs `{key: fn(timeout)}` calls concurrently and returns `{key: CallResult}`
+    in the order of the calls. The event loop and the thread pool live as
+    long as the container, so warm invocations do not build them again.
+    """
+
+    def __init__(self, max_concurrency=8):
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def run(self, calls, deadline):
+        with self._lock:
+            if self._loop is None:
+                import asyncio
+                from concurrent.futures import ThreadPoolExecutor
+                self._loop = asyncio.new_event_loop()
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    thread_name_prefix="fanout"
+                )
+            # One fan-out at a time per loop, run_until_complete is not re-entrant
+            with metrics.timer("FanoutLatency"):
+                return self._loop.run_until_complete(self.gather(calls, deadline))
+
+    async def gather(self, calls, deadline):
+        import asyncio
+        sem = asyncio.Semaphore(self.max_concurrency)
+        tasks = {
+            key: asyncio.ensure_future(self._call(sem, key, fn, deadline))
+            for key, fn in calls.items()
+        }
+        if not tasks:
+            return {}
+        _done, pending = await asyncio.wait(
+            list(tasks.values()), timeout=deadline.remaining())
+        # Cancel whatever is left, and let the cancellations settle so nothing
+        # of this invocation is left behind on the loop for the next one
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+        results = {}
+        for key, t in tasks.items():
+            if t.cancelled():
+                results[key] = CallResult(
+                    key, error=DeadlineExceeded(f"{key} cancelled at the deadline"))
+            else:
+                results[key] = t.result()
+        failed = sum(1 for r in results.values() if not r.ok)
+        metrics.put("FanoutCalls", len(results))
+        metrics.put("FanoutFailures", failed)
+        return results
+
+    async def _call(self, sem, key, fn, deadline):
+        import asyncio
+        async with sem:
+            timeout = deadline.remaining()
+            if timeout <= 0:
+                return CallResult(key, error=DeadlineExceeded(f"{key} not started before the deadline"))
+            t0 = time.perf_counter()
+            loop = asyncio.get_event_loop()
+            try:
+                value = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, fn, timeout), timeout)
+                return CallResult(key, value=value, elapsed_ms=(time.perf_counter() - t0) * 1000)
+            except asyncio.TimeoutError:
+                # The worker thread runs on until its own I/O timeout, its
+                # result is dropped
+                error = DeadlineExceeded(f"{key} timed out after {timeout:.3f}s")
+            except Exception as e:
+                error = e
+            return CallResult(key, error=error, elapsed_ms=(time.perf_counter() - t0) * 1000)
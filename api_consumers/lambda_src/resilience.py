@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: resilience
+    :Actions: Backoff, circuit breakers and hedged calls for the consumer's dependencies
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+- `retry_call` retries retryable failures with full jitter exponential
+  backoff, but only while the invocation deadline leaves room for another
+  attempt.
+- `CircuitBreaker` fails fast for `reset_timeout` seconds once a dependency
+  failed `failure_threshold` times in a row, then lets one probe call through.
+- `hedged_call` sends a second, identical request when the first one has not
+  answered after `hedge_after` seconds and takes whichever answers first.
+
+Failures are raised as `DependencyError`s carrying the status code the API
+should answer with, so throttling(429), a dependency being down(502/503) and
+running out of time(504) stay distinguishable.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from shared.metrics import metrics
+
+
+logger = logging.getLogger()
+
+
+class DependencyError(Exception):
+    """ A call to `dependency` failed, `status_code` is what to tell our caller """
+
+    def __init__(self, dependency, message, status_code=502, retryable=False, retry_after=None):
+        super().__init__(f"{dependency}: {message}")
+        self.dependency = dependency
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class ThrottledError(DependencyError):
+    """ The dependency asked us to slow down, 429 / TooManyRequestsException """
+
+    def __init__(self, dependency, message="throttled", retry_after=None):
+        super().__init__(dependency, message, status_code=429,
+                         retryable=True, retry_after=retry_after)
+
+
+class CircuitOpenError(DependencyError):
+    """ Failing fast, the dependency failed too often recently """
+
+    def __init__(self, dependency, retry_after):
+        super().__init__(dependency, "circuit open, failing fast",
+                         status_code=503, retryable=False, retry_after=retry_after)
+
+
+def error_for_status(dependency, status, retry_after=None):
+    """ `DependencyError` for an HTTP status of a dependency, `None` when it succeeded """
+    if status == 429:
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            # An HTTP date, back off by our own schedule instead
+            retry_after = None
+        return ThrottledError(dependency, retry_after=retry_after)
+    if status >= 500:
+        return DependencyError(dependency, f"answered {status}", status_code=502, retryable=True)
+    return None
+
+
+def error_for_exception(dependency, e):
+    """ `DependencyError` for an exception raised while calling a dependency """
+    if isinstance(e, DependencyError):
+        return e
+    name = type(e).__name__
+    if "Timeout" in name:
+        return DependencyError(dependency, f"timed out: {e}", status_code=504, retryable=True)
+    if name in ("TooManyRequestsException", "ThrottlingException"):
+        return ThrottledError(dependency, str(e))
+    # Connection refused / reset and the like
+    return DependencyError(dependency, f"{name}: {e}", status_code=502, retryable=True)
+
+
+class CircuitBreaker:
+    """ Consecutive failure counting breaker, closed -> open -> half-open -> closed """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """ Raise `CircuitOpenError` unless a call may go through now """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            waited = time.monotonic() - self.opened_at
+            if self.state == self.OPEN and waited >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                # Let one probe call find out whether the dependency is back
+                self._probing = True
+                return
+            metrics.incr(f"{self.name}CircuitRejected")
+            raise CircuitOpenError(
+                self.name, retry_after=max(1, int(self.reset_timeout - waited)))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit %s closed", self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Circuit %s opened after %s failures",
+                                   self.name, self.failures)
+                    metrics.incr(f"{self.name}CircuitOpened")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run `fn` through the breaker. Only retryable `DependencyError`s count
+        as failures, any other answer means the dependency is up.
+        """
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except DependencyError as e:
+            if e.retryable:
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+        return result
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(name, failure_threshold=5, reset_timeout=10):
+    """ The container wide breaker of a dependency, created on first use """
+    _b = _breakers.get(name)
+    if _b is None:
+        with _breakers_lock:
+            _b = _breakers.setdefault(
+                name, CircuitBreaker(name, failure_threshold, reset_timeout))
+    return _b
+
+
+def backoff_delay(attempt, base=0.05, cap=1.0):
+    """ Full jitter: uniform between 0 and the capped exponential delay """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_call(fn, deadline, attempts=3, base=0.05, cap=1.0, min_attempt_time=0.1,
+               breaker=None, retry_on=None):
+    """
+    Call `fn(timeout)` up to `attempts` times while it raises retryable
+    `DependencyError`s, narrowed further by the `retry_on(error)` predicate
+    when given. A retry only happens when, after the backoff, at least
+    `min_attempt_time` seconds of the deadline are left for it.
+    """
+    for attempt in range(attempts):
+        try:
+            timeout = deadline.remaining()
+            if timeout <= 0:
+                raise DependencyError("Deadline", "no time left to call", status_code=504)
+            if breaker is not None:
+                return breaker.call(fn, timeout)
+            return fn(timeout)
+        except DependencyError as e:
+            if not e.retryable or attempt == attempts - 1:
+                raise
+            if retry_on is not None and not retry_on(e):
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            if e.retry_after:
+                delay = max(delay, min(cap, e.retry_after))
+            if deadline.remaining() - delay < min_attempt_time:
+                logger.info("Not retrying %s, the time budget is spent", e.dependency)
+                raise
+            metrics.incr(f"{e.dependency}Retries")
+            time.sleep(delay)
+
+
+_hedge_executor = None
+_hedge_lock = threading.Lock()
+
+
+def _executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_lock:
+            if _hedge_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix="hedge")
+    return _hedge_executor
+
+
+def hedged_call(fn, timeout, hedge_after, dependency="hedged"):
+    """
+    Call `fn(timeout)` and, when it has not returned after `hedge_after`
+    seconds, call it once more in parallel. The first success wins, a failure
+    of the first call before `hedge_after` is raised as it is.
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+    started = time.monotonic()
+    futures = [_executor().submit(fn, timeout)]
+    done, _ = wait(futures, timeout=min(hedge_after, timeout))
+    if not done:
+        metrics.incr(f"{dependency}Hedged")
+        futures.append(_executor().submit(
+            fn, max(0.0, timeout - (time.monotonic() - started))))
+
+    error = None
+    pending = set(futures)
+    while pending:
+        left = timeout - (time.monotonic() - started)
+        if left <= 0:
+            break
+        done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                return f.result()
+            error = f.exception()
+    if error is not None:
+        raise error
+    raise DependencyError(dependency, f"no answer within {timeout:.3f}s", status_code=504, retryable=True)
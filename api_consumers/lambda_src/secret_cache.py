@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: secret_cache
+    :Actions: Cache Secrets Manager documents across warm lambda invocations
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+import json
+import logging
+import threading
+import time
+
+from shared.metrics import metrics
+
+
+logger = logging.getLogger()
+
+
+class CachedSecret:
+    """ Parsed secret document along with the version it was read from """
+    __slots__ = ("value", "version_id", "fetched_at")
+
+    def __init__(self, value, version_id, fetched_at):
+        self.value = value
+        self.version_id = version_id
+        self.fetched_at = fetched_at
+
+
+class SecretCache:
+    """
+    Lazily loaded, TTL bound cache of a JSON secret.
+
+    Each version stage (AWSCURRENT, AWSPENDING, ...) is cached on its own, so
+    callers can fall back to the pending version while a rotation is in
+    flight. Entries older than `ttl` seconds are re-read on next access, which
+    lets rotated secrets reach warm containers without a cold start.
+
+    Pass either a ready `client` or a `client_factory`, which is only called on
+    the first read so the client costs nothing at import time.
+    """
+
+    def __init__(self, secret_id, client=None, ttl=300, client_factory=None):
+        self.secret_id = secret_id
+        self.client = client
+        self.client_factory = client_factory
+        self.ttl = ttl
+        self._secrets = {}
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def _stale(self, _c):
+        return _c is None or time.time() - _c.fetched_at >= self.ttl
+
+    def get(self, version_stage="AWSCURRENT", force_refresh=False):
+        _c = self._secrets.get(version_stage)
+        if force_refresh or self._stale(_c):
+            # Concurrent callers wait for the read in progress instead of
+            # each reading the secret themselves
+            with self._fetch_lock:
+                _c = self._secrets.get(version_stage)
+                if force_refresh or self._stale(_c):
+                    _c = self._fetch(version_stage)
+        return _c.value
+
+    def age(self, version_stage="AWSCURRENT"):
+        """ Seconds since the version stage was last read, `None` if never read """
+        _c = self._secrets.get(version_stage)
+        if _c is None:
+            return None
+        return time.time() - _c.fetched_at
+
+    def invalidate(self, version_stage=None):
+        with self._lock:
+            if version_stage is None:
+                self._secrets.clear()
+            else:
+                self._secrets.pop(version_stage, None)
+
+    def _fetch(self, version_stage):
+        if self.client is None:
+            self.client = self.client_factory()
+        with metrics.timer("SecretsManagerLatency"):
+            resp = self.client.get_secret_value(
+                SecretId=self.secret_id,
+                VersionStage=version_stage
+            )
+        _c = CachedSecret(
+            json.loads(resp["SecretString"]),
+            resp.get("VersionId"),
+            time.time()
+        )
+        with self._lock:
+            _prev = self._secrets.get(version_stage)
+            self._secrets[version_stage] = _c
+        if _prev is not None and _prev.version_id != _c.version_id:
+            logger.info("Secret version changed for %s: %s",
+                        version_stage, _c.version_id)
+        return _c
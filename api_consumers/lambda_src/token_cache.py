@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: token_cache
+    :Actions: Cache OAuth2 access tokens across warm lambda invocations
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from shared.metrics import metrics
+
+
+logger = logging.getLogger()
+
+
+class CachedToken:
+    """ Access token along with its absolute expiry time """
+    __slots__ = ("access_token", "expires_at")
+
+    def __init__(self, access_token, expires_at):
+        self.access_token = access_token
+        self.expires_at = expires_at
+
+
+class _Flight:
+    """ A token fetch in progress, that concurrent callers wait on """
+    __slots__ = ("done", "token", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.token = None
+        self.error = None
+
+
+class TokenCache:
+    """
+    Expiry aware token cache keyed by scope, or by a tuple such as
+    `(client_id, scope)` when several app clients share the cache.
+
+    Tokens are handed out until `expiry_skew` seconds before they expire. Once a
+    token enters the last `refresh_window` seconds of its life, the next caller
+    mints a replacement inline, the callers meanwhile still get the cached
+    token. A refresh that fails keeps the cached token for the next caller to
+    try again. The refresh is not left to a background thread, the lambda
+    freezes those between invocations. `fetch_fn(key)` must return a tuple
+    of `(access_token, expires_in)`.
+
+    Only one fetch per key is in flight at a time, concurrent callers wait for
+    its result. With a shared `store` the same holds across containers: the
+    container holding the mint lease calls `fetch_fn`, the others poll the store
+    for up to `lease_wait` seconds before minting on their own. An early
+    refresh does not wait on another container's lease, it keeps the cached
+    token.
+
+    Store keys are the parts of the key joined by `:`, after `namespace` when
+    there is one(_it may be a callable_), so containers of the same app client
+    share its tokens. A store that can not be reached is skipped, the
+    container mints on its own.
+    """
+
+    def __init__(self, fetch_fn, expiry_skew=30, refresh_window=120,
+                 store=None, namespace=None, lease_ttl=5, lease_wait=2):
+        self.fetch_fn = fetch_fn
+        self.expiry_skew = expiry_skew
+        self.refresh_window = refresh_window
+        self.store = store
+        self.namespace = namespace
+        self.lease_ttl = lease_ttl
+        self.lease_wait = lease_wait
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self._tokens = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, scope):
+        now = time.time()
+        _c = self._tokens.get(scope)
+        if _c is not None and now < _c.expires_at - self.expiry_skew:
+            # Hits are 1 and misses 0, so the Average statistic is the hit ratio
+            metrics.put("TokenCacheHit", 1)
+            if now >= _c.expires_at - self.refresh_window:
+                return self._refresh_early(scope, _c).access_token
+            return _c.access_token
+        metrics.put("TokenCacheHit", 0)
+        return self._fetch(scope).access_token
+
+    def invalidate(self, scope=None):
+        with self._lock:
+            if scope is None:
+                self._tokens.clear()
+            else:
+                self._tokens.pop(scope, None)
+
+    def _usable(self, _c, now):
+        return _c is not None and now < _c.expires_at - self.refresh_window
+
+    def _fetch(self, scope):
+        with self._lock:
+            flight = self._inflight.get(scope)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[scope] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.token
+
+        try:
+            flight.token = self._fetch_shared(scope)
+            with self._lock:
+                self._tokens[scope] = flight.token
+            return flight.token
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[scope]
+            flight.done.set()
+
+    def _refresh_early(self, scope, current):
+        """ Replacement of the `current` token, still valid, when no other caller is minting it """
+        with self._lock:
+            if scope in self._inflight:
+                return current
+            flight = _Flight()
+            self._inflight[scope] = flight
+
+        flight.token = current
+        try:
+            _c = self._fetch_shared(scope, wait=False)
+            if _c is not None:
+                flight.token = _c
+                with self._lock:
+                    self._tokens[scope] = _c
+        except Exception as e:
+            # The current token is still valid, the next caller will try again
+            logger.error("Early token refresh failed: %s", e)
+        finally:
+            with self._lock:
+                del self._inflight[scope]
+            flight.done.set()
+        return flight.token
+
+    def _fetch_shared(self, scope, wait=True):
+        """ Token from the store or minted under the lease, `None` when not `wait`ing on another minter """
+        if self.store is None:
+            return self._mint(scope)
+
+        key = self._store_key(scope)
+        _s = self._from_store(key)
+        if self._usable(_s, time.time()):
+            metrics.put("TokenStoreHit", 1)
+            return CachedToken(_s.access_token, _s.expires_at)
+        metrics.put("TokenStoreHit", 0)
+
+        if self._acquire_lease(key):
+            try:
+                # The previous lease holder may have published while we waited
+                _s = self._from_store(key) or _s
+                if self._usable(_s, time.time()):
+                    return CachedToken(_s.access_token, _s.expires_at)
+                _c = self._mint(scope)
+                self._publish(key, _c, _s.version if _s else None)
+                return _c
+            finally:
+                self._release_lease(key)
+
+        if not wait:
+            return None
+        # Another container is minting, wait for it to publish the token
+        deadline = time.time() + self.lease_wait
+        while time.time() < deadline:
+            time.sleep(0.05)
+            _s = self._from_store(key)
+            if self._usable(_s, time.time()):
+                return CachedToken(_s.access_token, _s.expires_at)
+        logger.warning("Timed out waiting on the shared token for %s", scope)
+        return self._mint(scope)
+
+    def _store_key(self, scope):
+        namespace = self.namespace() if callable(self.namespace) else self.namespace
+        parts = scope if isinstance(scope, tuple) else (scope,)
+        if namespace:
+            parts = (namespace,) + parts
+        return ":".join(str(p) for p in parts)
+
+    def _from_store(self, key):
+        try:
+            return self.store.get(key)
+        except Exception as e:
+            logger.error("Unable to read the shared token store: %s", e)
+            return None
+
+    def _publish(self, key, _c, version):
+        try:
+            if not self.store.put(key, _c.access_token, _c.expires_at, version):
+                # Another container published a newer token while we minted,
+                # keep it and use ours in this container until it expires
+                metrics.incr("TokenStoreConflicts")
+                logger.info("Shared token for %s was refreshed concurrently", key)
+        except Exception as e:
+            logger.error("Unable to publish to the shared token store: %s", e)
+
+    def _acquire_lease(self, key):
+        try:
+            return self.store.acquire_lease(key, self.owner, self.lease_ttl)
+        except Exception as e:
+            # Nobody to coordinate with, mint without waiting on the others
+            logger.error("Unable to take the mint lease: %s", e)
+            return True
+
+    def _release_lease(self, key):
+        try:
+            self.store.release_lease(key, self.owner)
+        except Exception as e:
+            # The lease expires on its own after lease_ttl
+            logger.error("Unable to release the mint lease: %s", e)
+
+    def _mint(self, scope):
+        access_token, expires_in = self.fetch_fn(scope)
+        return CachedToken(access_token, time.time() + int(expires_in))
@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: token_store
+    :Actions: Shared token stores used to coalesce token minting across containers
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+A store keeps minted tokens and short lived mint leases. The container that
+wins the lease for a key mints the token and publishes it, the others wait
+for it to show up in the store instead of calling the token endpoint.
+
+Every stored token carries a version. A token is only published when the
+stored version is still the one the minter read before minting, so a slow
+minter whose lease ran out never overwrites a newer token(_optimistic
+concurrency_).
+
+Backends,
+  - `DynamoDBTokenStore` : conditional writes, the one to use across containers
+  - `SsmTokenStore`      : SecureString parameters, for a handful of scopes
+  - `SqliteTokenStore`   : local stand-in with the same semantics, for tests
+  - `FileTokenStore`, `InMemoryTokenStore` : simplest local stand-ins
+
+Tokens are bearer credentials, `EncryptedTokenStore` encrypts them with KMS
+before they reach the store. Parameter Store encrypts SecureStrings itself.
+"""
+
+import abc
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from shared import aws_clients
+
+
+logger = logging.getLogger()
+
+
+class StoredToken:
+    """ Access token in the store, its absolute expiry time and version """
+    __slots__ = ("access_token", "expires_at", "version")
+
+    def __init__(self, access_token, expires_at, version):
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.version = version
+
+
+class TokenStore(abc.ABC):
+    """ Interface of a shared token store """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """ Return a `StoredToken` or `None` """
+
+    @abc.abstractmethod
+    def put(self, key, access_token, expires_at, version=None):
+        """
+        Publish a token, only when the stored version is still `version`
+        (`None`: nothing stored yet). Returns `False` when another container
+        published first.
+        """
+
+    @abc.abstractmethod
+    def acquire_lease(self, key, owner, ttl):
+        """ Try to become the single minter of `key` for `ttl` seconds """
+
+    @abc.abstractmethod
+    def release_lease(self, key, owner):
+        """ Give up the lease of `key`, when `owner` still holds it """
+
+
+def _digest(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _error_code(e):
+    """ Error code of a botocore `ClientError`, without importing botocore """
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+
+class InMemoryTokenStore(TokenStore):
+    """ Process local stand-in, handy to exercise the lease logic in tests """
+
+    def __init__(self):
+        self._tokens = {}
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._tokens.get(key)
+
+    def put(self, key, access_token, expires_at, version=None):
+        with self._lock:
+            _s = self._tokens.get(key)
+            if (_s.version if _s else None) != version:
+                return False
+            self._tokens[key] = StoredToken(
+                access_token, expires_at, (version or 0) + 1)
+            return True
+
+    def acquire_lease(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            _l = self._leases.get(key)
+            if _l is not None and _l[0] != owner and _l[1] > now:
+                return False
+            self._leases[key] = (owner, now + ttl)
+            return True
+
+    def release_lease(self, key, owner):
+        with self._lock:
+            if self._leases.get(key, (None,))[0] == owner:
+                del self._leases[key]
+
+
+class FileTokenStore(TokenStore):
+    """
+    File backed stand-in, shared by every process that can see `directory`.
+    Leases are created with O_EXCL so exactly one process wins them, tokens
+    are published under an exclusive `flock`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, f"{_digest(key)}.{suffix}")
+
+    def get(self, key):
+        try:
+            with open(self._path(key, "token"), mode="r") as f:
+                _d = json.load(f)
+            return StoredToken(_d["access_token"], _d["expires_at"], _d.get("version", 1))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, access_token, expires_at, version=None):
+        import fcntl
+        _p = self._path(key, "token")
+        with open(f"{_p}.lock", mode="w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _s = self.get(key)
+            if (_s.version if _s else None) != version:
+                return False
+            _tmp = f"{_p}.{os.getpid()}.{threading.get_ident()}"
+            with open(_tmp, mode="w") as f:
+                json.dump({"access_token": access_token, "expires_at": expires_at,
+                           "version": (version or 0) + 1}, f)
+            # Readers never see a half written token
+            os.replace(_tmp, _p)
+            return True
+
+    def acquire_lease(self, key, owner, ttl):
+        _p = self._path(key, "lease")
+        now = time.time()
+        for _ in range(2):
+            try:
+                fd = os.open(_p, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(_p, mode="r") as f:
+                        _owner, _expires_at = json.load(f)
+                except (OSError, ValueError):
+                    # Lease file is being written right now
+                    return False
+                if _owner == owner:
+                    return True
+                if _expires_at > now:
+                    return False
+                # The previous minter died holding the lease, take it over
+                try:
+                    os.remove(_p)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, mode="w") as f:
+                json.dump([owner, now + ttl], f)
+            return True
+        return False
+
+    def release_lease(self, key, owner):
+        _p = self._path(key, "lease")
+        try:
+            with open(_p, mode="r") as f:
+                _owner, _expires_at = json.load(f)
+            if _owner == owner:
+                os.remove(_p)
+        except (OSError, ValueError):
+            pass
+
+
+class SqliteTokenStore(TokenStore):
+    """
+    SQLite stand-in with the conditional write semantics of the DynamoDB
+    store, shared by the processes on one host. Sticks to SQL the old SQLite
+    of the lambda runtime understands(_no upserts_).
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self._conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, "
+                "access_token TEXT, expires_at REAL, version INTEGER)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, "
+                "owner TEXT, expires_at REAL)")
+
+    def get(self, key):
+        with self._lock:
+            _r = self._conn.execute(
+                "SELECT access_token, expires_at, version FROM tokens WHERE key = ?",
+                (key,)).fetchone()
+        return StoredToken(*_r) if _r else None
+
+    def put(self, key, access_token, expires_at, version=None):
+        with self._lock:
+            if version is None:
+                _c = self._conn.execute(
+                    "INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, 1)",
+                    (key, access_token, expires_at))
+            else:
+                _c = self._conn.execute(
+                    "UPDATE tokens SET access_token = ?, expires_at = ?, version = version + 1 "
+                    "WHERE key = ? AND version = ?",
+                    (access_token, expires_at, key, version))
+            return _c.rowcount == 1
+
+    def acquire_lease(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM leases WHERE key = ? AND (expires_at < ? OR owner = ?)",
+                    (key, now, owner))
+                _c = self._conn.execute(
+                    "INSERT OR IGNORE INTO leases VALUES (?, ?, ?)", (key, owner, now + ttl))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return _c.rowcount == 1
+
+    def release_lease(self, key, owner):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+
+class DynamoDBTokenStore(TokenStore):
+    """
+    Tokens and leases as items of one table, partition key `pk`. Tokens are
+    published and leases taken with conditional writes, reads are strongly
+    consistent so a container sees a token the moment it is published. The
+    `ttl` attribute lets DynamoDB delete expired items.
+    """
+
+    def __init__(self, table_name, client_factory=None):
+        self.table_name = table_name
+        self._client_factory = client_factory or (lambda: aws_clients.client("dynamodb"))
+
+    @property
+    def client(self):
+        return self._client_factory()
+
+    def get(self, key):
+        _i = self.client.get_item(
+            TableName=self.table_name,
+            Key={"pk": {"S": key}},
+            ConsistentRead=True,
+            ProjectionExpression="access_token, expires_at, version"
+        ).get("Item")
+        if not _i:
+            return None
+        return StoredToken(_i["access_token"]["S"], float(_i["expires_at"]["N"]), int(_i["version"]["N"]))
+
+    def put(self, key, access_token, expires_at, version=None):
+        if version is None:
+            condition, values = "attribute_not_exists(pk)", {}
+        else:
+            condition, values = "version = :v", {":v": {"N": str(version)}}
+        kwargs = {"ExpressionAttributeValues": values} if values else {}
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "pk": {"S": key},
+                    "access_token": {"S": access_token},
+                    "expires_at": {"N": str(expires_at)},
+                    "version": {"N": str((version or 0) + 1)},
+                    "ttl": {"N": str(int(expires_at) + 60)},
+                },
+                ConditionExpression=condition,
+                **kwargs
+            )
+        except Exception as e:
+            if _error_code(e) == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def acquire_lease(self, key, owner, ttl):
+        now = time.time()
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "pk": {"S": f"lease#{key}"},
+                    "lease_owner": {"S": owner},
+                    "lease_expires": {"N": str(now + ttl)},
+                    "ttl": {"N": str(int(now + ttl) + 60)},
+                },
+                ConditionExpression="attribute_not_exists(pk) OR lease_expires < :now OR lease_owner = :owner",
+                ExpressionAttributeValues={
+                    ":now": {"N": str(now)}, ":owner": {"S": owner}}
+            )
+        except Exception as e:
+            if _error_code(e) == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def release_lease(self, key, owner):
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key={"pk": {"S": f"lease#{key}"}},
+                ConditionExpression="lease_owner = :owner",
+                ExpressionAttributeValues={":owner": {"S": owner}}
+            )
+        except Exception as e:
+            if _error_code(e) != "ConditionalCheckFailedException":
+                raise
+
+
+class SsmTokenStore(TokenStore):
+    """
+    Tokens as SecureString parameters under `prefix`, encrypted with
+    `kms_key_id`(_or the account's default key_). Parameter Store has no
+    conditional writes, the version check before an overwrite narrows the
+    race rather than closing it, the mint lease does the rest. Its writes are
+    throttled at a few per second, so it suits a handful of scopes.
+    """
+
+    def __init__(self, prefix, kms_key_id=None, client_factory=None):
+        self.prefix = prefix.rstrip("/")
+        self.kms_key_id = kms_key_id
+        self._client_factory = client_factory or (lambda: aws_clients.client("ssm"))
+
+    @property
+    def client(self):
+        return self._client_factory()
+
+    def _name(self, key, kind="tokens"):
+        return f"{self.prefix}/{kind}/{_digest(key)}"
+
+    def _get_parameter(self, name, decrypt):
+        try:
+            return self.client.get_parameter(Name=name, WithDecryption=decrypt)["Parameter"]
+        except Exception as e:
+            if _error_code(e) == "ParameterNotFound":
+                return None
+            raise
+
+    def _create(self, name, value, secure):
+        kwargs = {"Type": "String"}
+        if secure:
+            kwargs = {"Type": "SecureString"}
+            if self.kms_key_id:
+                kwargs["KeyId"] = self.kms_key_id
+        try:
+            self.client.put_parameter(Name=name, Value=value, Overwrite=False, **kwargs)
+        except Exception as e:
+            if _error_code(e) == "ParameterAlreadyExists":
+                return False
+            raise
+        return True
+
+    def get(self, key):
+        _p = self._get_parameter(self._name(key), decrypt=True)
+        if _p is None:
+            return None
+        _d = json.loads(_p["Value"])
+        return StoredToken(_d["access_token"], _d["expires_at"], _p["Version"])
+
+    def put(self, key, access_token, expires_at, version=None):
+        name = self._name(key)
+        value = json.dumps({"access_token": access_token, "expires_at": expires_at})
+        if version is None:
+            return self._create(name, value, secure=True)
+        _p = self._get_parameter(name, decrypt=False)
+        if _p is None or _p["Version"] != version:
+            return False
+        kwargs = {"KeyId": self.kms_key_id} if self.kms_key_id else {}
+        self.client.put_parameter(
+            Name=name, Value=value, Type="SecureString", Overwrite=True, **kwargs)
+        return True
+
+    def acquire_lease(self, key, owner, ttl):
+        name = self._name(key, "leases")
+        for _ in range(2):
+            if self._create(name, json.dumps([owner, time.time() + ttl]), secure=False):
+                return True
+            _p = self._get_parameter(name, decrypt=False)
+            if _p is None:
+                # Released in between, try again
+                continue
+            _owner, _expires_at = json.loads(_p["Value"])
+            if _owner == owner:
+                return True
+            if _expires_at > time.time():
+                return False
+            # The previous minter died holding the lease, take it over
+            self._delete(name)
+        return False
+
+    def release_lease(self, key, owner):
+        name = self._name(key, "leases")
+        _p = self._get_parameter(name, decrypt=False)
+        if _p is not None and json.loads(_p["Value"])[0] == owner:
+            self._delete(name)
+
+    def _delete(self, name):
+        try:
+            self.client.delete_parameter(Name=name)
+        except Exception as e:
+            if _error_code(e) != "ParameterNotFound":
+                raise
+
+
+class KmsCipher:
+    """ Encrypts with a KMS key, bound to an encryption context """
+
+    def __init__(self, key_id, client_factory=None):
+        self.key_id = key_id
+        self._client_factory = client_factory or (lambda: aws_clients.client("kms"))
+
+    def encrypt(self, plaintext, context):
+        _r = self._client_factory().encrypt(
+            KeyId=self.key_id, Plaintext=plaintext.encode("utf-8"), EncryptionContext=context)
+        return base64.b64encode(_r["CiphertextBlob"]).decode("ascii")
+
+    def decrypt(self, ciphertext, context):
+        _r = self._client_factory().decrypt(
+            CiphertextBlob=base64.b64decode(ciphertext), EncryptionContext=context)
+        return _r["Plaintext"].decode("utf-8")
+
+
+class EncryptedTokenStore(TokenStore):
+    """
+    Encrypts tokens before they reach `store` and decrypts them on the way
+    back. The store key is the encryption context, so a ciphertext copied to
+    another key does not decrypt. Costs one KMS call per mint and per token
+    a container takes from the store, not per request.
+    """
+
+    def __init__(self, store, cipher):
+        self.store = store
+        self.cipher = cipher
+
+    def get(self, key):
+        _s = self.store.get(key)
+        if _s is None:
+            return None
+        return StoredToken(
+            self.cipher.decrypt(_s.access_token, {"token_key": key}), _s.expires_at, _s.version)
+
+    def put(self, key, access_token, expires_at, version=None):
+        return self.store.put(
+            key, self.cipher.encrypt(access_token, {"token_key": key}), expires_at, version)
+
+    def acquire_lease(self, key, owner, ttl):
+        return self.store.acquire_lease(key, owner, ttl)
+
+    def release_lease(self, key, owner):
+        return self.store.release_lease(key, owner)
+
+
+def token_store_from_uri(uri, kms_key_id=None):
+    """
+    Build a store from a `TOKEN_STORE` setting,
+      - "" or "none"        : no shared store
+      - "memory"            : process local store
+      - "file:/tmp/path"    : file backed store
+      - "sqlite:/tmp/db"    : SQLite backed store
+      - "dynamodb:table"    : DynamoDB table
+      - "ssm:/path/prefix"  : Parameter Store SecureStrings
+    With a `kms_key_id`, tokens are encrypted with it before they are stored.
+    """
+    if not uri or uri == "none":
+        return None
+    scheme, _, location = uri.partition(":")
+    if scheme == "ssm":
+        # SecureStrings are encrypted by Parameter Store itself
+        return SsmTokenStore(location, kms_key_id=kms_key_id)
+    if scheme == "memory":
+        store = InMemoryTokenStore()
+    elif scheme == "file":
+        store = FileTokenStore(location)
+    elif scheme == "sqlite":
+        store = SqliteTokenStore(location)
+    elif scheme == "dynamodb":
+        store = DynamoDBTokenStore(location)
+    else:
+        raise ValueError(f"Unsupported token store: {uri}")
+    if kms_key_id:
+        store = EncryptedTokenStore(store, KmsCipher(kms_key_id))
+    return store
@@ -5,9 +5,13 @@ from aws_cdk import core
 from cognito_identity_provider.cognito_identity_provider_stack import CognitoIdentityProviderStack
 from premium_api.premium_api_stack import PremiumApiStack
 from api_consumers.api_consumers_stack import ApiConsumersStack
+from performance_profiles.performance_profile import PerformanceProfile
 
 app = core.App()
 
+# Memory, concurrency & throttling of the functions and APIs, from cdk.json context
+perf_profile = PerformanceProfile.from_context(app.node)
+
 
 # Cognito Identity Store Stack
 cognito_identity_provider = CognitoIdentityProviderStack(
@@ -25,6 +29,9 @@ premium_content_provider = PremiumApiStack(
     unicorn_user_pool_res_srv_identifier=cognito_identity_provider.unicorn_user_pool_res_srv_identifier,
     unicorn_read_scope=cognito_identity_provider.unicorn_read_scope,
     unicorn_write_scope=cognito_identity_provider.unicorn_write_scope,
+    app_clients=cognito_identity_provider.app_clients,
+    app_client_ids=cognito_identity_provider.app_client_ids,
+    perf_profile=perf_profile,
     description="The Premium Content Provider API"
 )
 
@@ -34,6 +41,10 @@ content_consumers = ApiConsumersStack(
     "content-consumers-stack",
     unicorn_user_pool_secrets_arn=cognito_identity_provider.unicorn_user_pool_secrets_arn,
     premium_content_api_url=premium_content_provider.premium_content_api_url,
+    premium_content_batch_api_url=premium_content_provider.premium_content_batch_api_url,
+    perf_profile=perf_profile,
+    app_clients=cognito_identity_provider.app_clients,
+    api_key_clients=premium_content_provider.api_key_clients,
     description="Content Consumers Stack to Access Premium Content"
 )
 
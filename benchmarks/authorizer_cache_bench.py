@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: authorizer_cache_bench
+    :Actions: Count Lambda authorizer invocations behind the API Gateway result cache, per policy mode
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage: python3 benchmarks/authorizer_cache_bench.py [--clients 20] [--calls 3600]
+
+API Gateway caches a token authorizer's response by token, for the
+authorizer's TTL, and evaluates the cached policy against whatever method is
+called next. Each client makes `--calls` calls, one a second over random
+routes, with one token. The run is replayed against the real authorizer
+handler under each policy mode, with its API Gateway TTL.
+
+`wrongly denied` are the calls a cached single method policy turned away,
+although the token's scopes allow them.
+"""
+
+import argparse
+import fnmatch
+import os
+import random
+import sys
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT_DIR, "premium_api", "lambda_src"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "lambda_layers", "shared", "python"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from route_policy import CompiledRoutePolicy  # noqa: E402
+from rsa_keys import RsaPrivateKey, access_token_claims  # noqa: E402
+
+REGION = "us-east-1"
+USER_POOL_ID = "us-east-1_bench"
+ISSUER = f"https://cognito-idp.{REGION}.amazonaws.com/{USER_POOL_ID}"
+STAGE_ARN = "arn:aws:execute-api:us-east-1:111111111111:bench/prod"
+
+ROUTES = [
+    ("GET", "/home/premium", ["premium_api/read"]),
+    ("POST", "/home/premium", ["premium_api/write"]),
+    ("POST", "/home/premium/batch", ["premium_api/read"]),
+]
+
+# (policy mode, API Gateway TTL the stack gives it)
+MODES = [("method", 15), ("method", 0), ("aggregated", 3600)]
+
+
+def _load_authorizer(clients):
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    os.environ["ALLOWED_CLIENT_IDS"] = ",".join(f"bench-client-{i}" for i in range(clients))
+    os.environ["USER_POOL_ID"] = USER_POOL_ID
+    os.environ["USER_POOL_REGION"] = REGION
+    os.environ["ROUTE_POLICY"] = CompiledRoutePolicy(ROUTES).to_json()
+    import api_authorizer
+    return api_authorizer
+
+
+def _allows(response, method_arn):
+    """ IAM evaluation of the one statement the authorizer returns """
+    _s = response["policyDocument"]["Statement"][0]
+    resources = _s["Resource"] if isinstance(_s["Resource"], list) else [_s["Resource"]]
+    matched = any(fnmatch.fnmatchcase(method_arn, _r) for _r in resources)
+    return matched and _s["Effect"] == "Allow"
+
+
+def replay(authorizer, mode, ttl, tokens, calls, seed=7):
+    authorizer.global_args.AUTHORIZER_POLICY = mode
+    authorizer._decisions = authorizer.DecisionCache()
+    rng = random.Random(seed)
+    policy = CompiledRoutePolicy(ROUTES)
+
+    gateway_cache = {}
+    invocations = 0
+    wrongly_denied = 0
+    elapsed = 0.0
+    for second in range(calls):
+        for _t, scope in tokens:
+            http_method, resource = rng.choice(policy.routes())
+            method_arn = f"{STAGE_ARN}/{http_method}{resource}"
+            _c = gateway_cache.get(_t)
+            if _c is None or _c[0] <= second:
+                invocations += 1
+                start = time.perf_counter()
+                response = authorizer.lambda_handler(
+                    {"type": "TOKEN", "authorizationToken": _t, "methodArn": method_arn}, None)
+                elapsed += time.perf_counter() - start
+                _c = (second + ttl, response)
+                if ttl:
+                    gateway_cache[_t] = _c
+            allowed = policy.is_allowed(http_method, resource, policy.scope_mask(scope))
+            if allowed and not _allows(_c[1], method_arn):
+                wrongly_denied += 1
+    return invocations, wrongly_denied, elapsed / max(invocations, 1) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=20,
+                        help="clients, each with its own token")
+    parser.add_argument("--calls", type=int, default=3600,
+                        help="calls per client, one a second")
+    args = parser.parse_args()
+
+    authorizer = _load_authorizer(args.clients)
+    key = RsaPrivateKey()
+    authorizer._verifier.jwks.load({"keys": [key.jwk()]})
+    tokens = []
+    for i in range(args.clients):
+        # Every other client may only read
+        scope = "premium_api/read premium_api/write" if i % 2 else "premium_api/read"
+        tokens.append((key.encode_jwt(access_token_claims(
+            ISSUER, f"bench-client-{i}", scope, expires_in=args.calls + 60)), scope))
+
+    total = args.clients * args.calls
+    print(f"{args.clients} clients x {args.calls} calls = {total} calls")
+    print(f"{'policy':<12}{'ttl s':>8}{'invocations':>14}{'per 1k calls':>14}{'wrongly denied':>16}{'us/invocation':>16}")
+    for mode, ttl in MODES:
+        invocations, wrongly_denied, latency = replay(
+            authorizer, mode, ttl, tokens, args.calls)
+        print(f"{mode:<12}{ttl:>8}{invocations:>14}{invocations / total * 1000:>14.1f}"
+              f"{wrongly_denied:>16}{latency:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: bundle_report
+    :Actions: Compare the package size and init duration of the plain and the bundled lambda assets
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    python3 benchmarks/bundle_report.py [--runs 10]
+    python3 benchmarks/bundle_report.py --save /tmp/bundles.json
+    python3 benchmarks/bundle_report.py --compare /tmp/bundles.json
+
+Each handler is built in a temporary directory as `source`, the whole
+function directory & layer(_what `Code.from_asset` shipped before bundling_),
+as `bundled` by `AssetBundler`, byte-compiled for this interpreter, and as
+`compiled`, bundled without the sources(_`keep_sources: false`_). Init is
+the import of the handler module in a fresh interpreter that can not write
+`__pycache__`, like on the read-only lambda file system, the fastest of
+`--runs`. `--compare` shows the change against a report saved with `--save`.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bundling.lambda_bundle import AssetBundler, bundle_size, copy_files, source_files  # noqa: E402
+from import_times import LAMBDA_ENV  # noqa: E402
+
+SHARED_LAYER = os.path.join(ROOT_DIR, "lambda_layers", "shared")
+
+# handler module -> directory holding the function code
+HANDLERS = {
+    "content_consumers": os.path.join(ROOT_DIR, "api_consumers", "lambda_src"),
+    "premium_content": os.path.join(ROOT_DIR, "premium_api", "lambda_src"),
+    "api_authorizer": os.path.join(ROOT_DIR, "premium_api", "lambda_src"),
+}
+
+
+def init_ms(module, function_dir, layer_dir, runs):
+    """ Fastest import of `module` in a fresh interpreter, in milliseconds """
+    env = dict(os.environ)
+    env.update(LAMBDA_ENV)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [function_dir, os.path.join(layer_dir, "python")])
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    env["LOG_LEVEL"] = "ERROR"
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c",
+             f"import time; _t = time.perf_counter(); import {module}; "
+             f"print((time.perf_counter() - _t) * 1000)"],
+            env=env, capture_output=True, text=True, check=True
+        )
+        timings.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(timings)
+
+
+def build(module, source_dir, work_dir, runs):
+    """ `{"source": {..}, "bundled": {..}, "compiled": {..}}` sizes & init of the handler `module` """
+    _plain_fn = os.path.join(work_dir, "source", module)
+    _plain_layer = os.path.join(work_dir, "source", f"{module}_layer")
+    copy_files(source_files(source_dir), source_dir, _plain_fn)
+    copy_files(source_files(SHARED_LAYER), SHARED_LAYER, _plain_layer)
+
+    builds = [("source", _plain_fn, _plain_layer)]
+    for kind, keep_sources in (("bundled", True), ("compiled", False)):
+        bundler = AssetBundler(os.path.join(work_dir, kind), sys.version_info[:2],
+                               [SHARED_LAYER], keep_sources=keep_sources)
+        builds.append((kind, bundler.function(module, source_dir, module),
+                       bundler.layer(f"{module}_layer", SHARED_LAYER)))
+
+    report = {}
+    for kind, fn_dir, layer_dir in builds:
+        _files, _bytes, _zipped = bundle_size(fn_dir)
+        _lfiles, _lbytes, _lzipped = bundle_size(layer_dir)
+        report[kind] = {
+            "files": _files + _lfiles,
+            "bytes": _bytes + _lbytes,
+            "zipped_bytes": _zipped + _lzipped,
+            "init_ms": init_ms(module, fn_dir, layer_dir, runs)
+        }
+    return report
+
+
+def _delta(new, old):
+    if not old:
+        return ""
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10,
+                        help="report the fastest of this many imports")
+    parser.add_argument("--save", help="write the report to this json file")
+    parser.add_argument("--compare", help="report saved with --save to compare against")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for module, source_dir in HANDLERS.items():
+            results[module] = build(module, source_dir, work_dir, args.runs)
+
+    print(f"python {sys.version_info[0]}.{sys.version_info[1]}, function & layer together")
+    print(f"{'handler':<20}{'build':<10}{'files':>7}{'KiB':>9}{'zip KiB':>9}{'init ms':>9}"
+          f"{'zip vs':>9}{'init vs':>9}")
+    for module, builds in results.items():
+        for kind, r in builds.items():
+            # Against the saved report when there is one, else against the source build
+            _b = baseline.get(module, {}).get(kind) if baseline else builds["source"]
+            _b = _b if _b is not r else None
+            print(f"{module:<20}{kind:<10}{r['files']:>7}{r['bytes'] / 1024:>9.1f}"
+                  f"{r['zipped_bytes'] / 1024:>9.1f}{r['init_ms']:>9.2f}"
+                  f"{_delta(r['zipped_bytes'], _b and _b['zipped_bytes']):>9}"
+                  f"{_delta(r['init_ms'], _b and _b['init_ms']):>9}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: import_times
+    :Actions: Report the import time breakdown of every lambda handler module
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Each module is imported in a fresh interpreter with `-X importtime`, with the
+function code and the shared layer on the path like in the lambda runtime.
+Import time is part of every cold start, so keep an eye on it.
+
+Usage: python3 benchmarks/import_times.py [--top 10] [--runs 5]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+SHARED_LAYER = os.path.join(ROOT_DIR, "lambda_layers", "shared", "python")
+
+# module -> directory holding the function code
+HANDLER_MODULES = {
+    "content_consumers": os.path.join(ROOT_DIR, "api_consumers", "lambda_src"),
+    "premium_content": os.path.join(ROOT_DIR, "premium_api", "lambda_src"),
+    "api_authorizer": os.path.join(ROOT_DIR, "premium_api", "lambda_src"),
+    "index": os.path.join(ROOT_DIR, "cognito_identity_provider", "custom_resources",
+                          "cognito_app_client_secret_retriever", "lambda_src"),
+}
+
+# Values the modules read from the environment at import time
+LAMBDA_ENV = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_REGION": "us-east-1",
+    "USER_POOL_SECRETS_ARN": "arn:aws:secretsmanager:us-east-1:111111111111:secret:cognito_local",
+    "PREMIUM_CONTENT_API_URL": "https://localhost/prod/home/premium",
+    "USER_POOL_ID": "us-east-1_local",
+}
+
+
+def import_time(module, src_dir):
+    """
+    Returns `([(cumulative_us, self_us, name), ...], error)`, rows sorted by
+    cumulative time. `error` is the last stderr line when the import failed.
+    """
+    env = dict(os.environ)
+    env.update(LAMBDA_ENV)
+    env["PYTHONPATH"] = os.pathsep.join([src_dir, SHARED_LAYER])
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _self, _cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(_cumulative), int(_self), name.rstrip()))
+    error = out.stderr.strip().splitlines()[-1] if out.returncode else None
+    return sorted(rows, reverse=True), error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--top", type=int, default=10,
+                        help="slowest imports to show per module")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="report the fastest of this many runs")
+    args = parser.parse_args()
+
+    for module, src_dir in HANDLER_MODULES.items():
+        runs = [import_time(module, src_dir) for _ in range(args.runs)]
+        rows, error = min(runs, key=lambda r: sum(x[1] for x in r[0]))
+        total = sum(x[1] for x in rows)
+        print(f"\n{module}: {total / 1000:.1f} ms")
+        if error:
+            print(f"  import failed: {error}")
+        print(f"{'cumulative ms':>14}{'self ms':>10}  module")
+        for _cumulative, _self, name in rows[:args.top]:
+            print(f"{_cumulative / 1000:>14.1f}{_self / 1000:>10.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
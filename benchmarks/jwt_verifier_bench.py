@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: jwt_verifier_bench
+    :Actions: Measure local JWT verification throughput of the premium api authorizer engine
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage: python3 benchmarks/jwt_verifier_bench.py [--tokens 200] [--rounds 20000]
+
+Runs in a single thread, so the numbers are verifications per core.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "premium_api", "lambda_src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from jwt_verifier import JwksCache, JwtVerifier  # noqa: E402
+from rsa_keys import RsaPrivateKey, access_token_claims  # noqa: E402
+
+ISSUER = "https://cognito-idp.us-east-1.amazonaws.com/us-east-1_bench"
+
+
+def _rate(fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    return n / elapsed, elapsed / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=200,
+                        help="distinct tokens signed up front")
+    parser.add_argument("--rounds", type=int, default=20000,
+                        help="verifications in the cached run")
+    args = parser.parse_args()
+
+    key = RsaPrivateKey()
+    tokens = [
+        key.encode_jwt(access_token_claims(ISSUER, "bench-client", "premium_api/read"))
+        for _ in range(args.tokens)
+    ]
+    jwks = JwksCache("http://unused.invalid/jwks.json")
+    jwks.load({"keys": [key.jwk()]})
+
+    uncached = JwtVerifier(ISSUER, jwks, cache_size=0)
+    cached = JwtVerifier(ISSUER, jwks, cache_size=1024)
+
+    rate, latency = _rate(lambda i: uncached.verify(tokens[i % len(tokens)]), len(tokens))
+    print(f"signature verify : {rate:>12,.0f} tokens/s {latency:>10.1f} us/token")
+    rate, latency = _rate(lambda i: cached.verify(tokens[i % len(tokens)]), args.rounds)
+    print(f"digest cache hit : {rate:>12,.0f} tokens/s {latency:>10.1f} us/token")
+
+
+if __name__ == "__main__":
+    main()
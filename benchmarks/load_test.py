@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: load_test
+    :Actions: Load test and latency benchmark of the lambda handlers against local stand-ins
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Runs `content_consumers.lambda_handler` and `premium_content.lambda_handler`
+in-process. The consumer talks to a fake Cognito token endpoint, a fake
+Secrets Manager and the premium api stub over local HTTP, exactly like it
+does in AWS. Reports throughput, p50/p95/p99 latency, traced allocations
+and cold vs warm start time for every scenario.
+
+Usage:
+    python3 benchmarks/load_test.py [--iterations 500] [--concurrency 1]
+    python3 benchmarks/load_test.py --save-baseline main
+    python3 benchmarks/load_test.py --compare main [--tolerance 0.15] [--min-delta-ms 0.1]
+    python3 benchmarks/load_test.py --token-store sqlite:/tmp/tokens.db
+
+Baselines are written to benchmarks/baselines/<name>.json. `--compare`
+exits with status 1 when a scenario regressed beyond the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+CONSUMER_SRC = os.path.join(ROOT_DIR, "api_consumers", "lambda_src")
+PREMIUM_SRC = os.path.join(ROOT_DIR, "premium_api", "lambda_src")
+SHARED_LAYER = os.path.join(ROOT_DIR, "lambda_layers", "shared", "python")
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+SECRET_ID = "arn:aws:secretsmanager:us-east-1:111111111111:secret:cognito_local_pool"
+CLIENT_ID = "bench-client"
+CLIENT_SECRET = "bench-secret"
+RES_SRV_IDENTIFIER = "premium_api"
+
+for _p in (BENCH_DIR, SHARED_LAYER, PREMIUM_SRC, CONSUMER_SRC):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+
+
+class LambdaContext:
+    """ Minimal stand-in of the lambda context object """
+    function_name = "benchmark"
+    aws_request_id = "00000000-0000-0000-0000-000000000000"
+
+    def __init__(self, timeout_ms=3000):
+        self._deadline = time.time() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.time()) * 1000))
+
+
+def consumer_event(resource_path):
+    return {
+        "resource": resource_path,
+        "path": resource_path,
+        "httpMethod": "GET",
+        "headers": {"Accept": "application/json"},
+        "requestContext": {"resourcePath": resource_path, "httpMethod": "GET", "stage": "miztiik"}
+    }
+
+
+def premium_event(http_method):
+    return {
+        "resource": "/home/premium",
+        "path": "/home/premium",
+        "httpMethod": http_method,
+        "headers": {"Accept": "application/json"},
+        "requestContext": {"resourcePath": "/home/premium", "httpMethod": http_method, "stage": "prod"}
+    }
+
+
+def premium_batch_event(n=10):
+    event = premium_event("POST")
+    event["resource"] = event["path"] = "/home/premium/batch"
+    event["requestContext"]["resourcePath"] = "/home/premium/batch"
+    event["body"] = json.dumps({"items": [
+        {"id": str(i), "method": "GET", "path": "/home/premium"} for i in range(n)
+    ]})
+    return event
+
+
+def _bench_clients(n):
+    """ `{client_id: (name, secret)}` of the extra app clients in the registry """
+    return {f"bench-client-{i}": (f"bench-svc-{i}", f"bench-secret-{i}") for i in range(n)}
+
+
+def _secret_doc(cognito, clients=0):
+    doc = {
+        "app_client_secret": CLIENT_SECRET,
+        "user_pool_id": "local_pool",
+        "user_pool_client_id": CLIENT_ID,
+        "user_pool_oauth2_endpoint": cognito.token_url,
+        "unicorn_user_pool_res_srv_identifier": RES_SRV_IDENTIFIER,
+        "unicorn_read_scope": "read",
+        "unicorn_write_scope": "write"
+    }
+    if clients:
+        # Batched document of the app client registry, as the stack writes it
+        doc["app_clients"] = {CLIENT_ID: {"app_client_secret": CLIENT_SECRET}}
+        for client_id, (name, secret) in _bench_clients(clients).items():
+            doc["app_clients"][client_id] = {
+                "client_name": name, "app_client_secret": secret, "scopes": ["read"]}
+    return doc
+
+
+def multi_client_event(i):
+    event = consumer_event("/content/authorized-read")
+    event["headers"]["X-Client-Id"] = f"bench-svc-{i}"
+    return event
+
+
+def _quiet_logging():
+    """ Keep the cost of formatting log records and metrics, drop the output """
+    devnull = open(os.devnull, "w")
+    for h in logging.getLogger().handlers:
+        if isinstance(h, logging.StreamHandler):
+            h.setStream(devnull)
+    from shared.metrics import metrics
+    metrics.stream = devnull
+
+
+class Environment:
+    """ Fake Cognito, Secrets Manager and premium api wired to the handlers """
+
+    def __init__(self, upstream_latency_ms=0, token_store="", clients=0):
+        from jwt_verifier import JwksCache, JwtVerifier
+        from local_stubs import FakeCognito, FakeSecretsManager, PremiumApiStub
+        from route_policy import CompiledRoutePolicy
+
+        self.clients = clients
+        _credentials = {CLIENT_ID: CLIENT_SECRET}
+        _credentials.update(
+            {_id: secret for _id, (_, secret) in _bench_clients(clients).items()})
+        self.cognito = FakeCognito(_credentials).start()
+        jwks = JwksCache(f"{self.cognito.issuer}/.well-known/jwks.json")
+        jwks.load({"keys": [self.cognito.key.jwk()]})
+        route_policy = CompiledRoutePolicy([
+            ("GET", "/home/premium", [f"{RES_SRV_IDENTIFIER}/read"]),
+            ("POST", "/home/premium", [f"{RES_SRV_IDENTIFIER}/write"]),
+            ("POST", "/home/premium/batch", [f"{RES_SRV_IDENTIFIER}/read"]),
+        ])
+        self.route_policy = route_policy
+        self.token_store = token_store
+        os.environ["ROUTE_POLICY"] = route_policy.to_json()
+
+        import premium_content
+        self.premium_content = premium_content
+        self.premium_api = PremiumApiStub(
+            premium_content.lambda_handler, JwtVerifier(self.cognito.issuer, jwks), route_policy,
+            latency_ms=upstream_latency_ms).start()
+
+        self.secrets = FakeSecretsManager()
+        self.secrets.put(SECRET_ID, _secret_doc(self.cognito, clients))
+        os.environ.update(self.consumer_env())
+
+        import content_consumers
+        self.content_consumers = content_consumers
+        install_fake_secrets(content_consumers, self.secrets)
+        _quiet_logging()
+
+    def consumer_env(self):
+        return {
+            "AWS_DEFAULT_REGION": os.getenv("AWS_DEFAULT_REGION", "us-east-1"),
+            "USER_POOL_SECRETS_ARN": SECRET_ID,
+            "PREMIUM_CONTENT_API_URL": self.premium_api.url,
+            "PREMIUM_CONTENT_BATCH_API_URL": f"{self.premium_api.url}/batch",
+            "ROUTE_POLICY": self.route_policy.to_json(),
+            "BENCH_SECRET_DOC": json.dumps(_secret_doc(self.cognito, self.clients)),
+            "BENCH_CLIENTS": str(self.clients),
+            # Any bench client may be selected for the multi client reads
+            "CLIENT_SELECTION": json.dumps({"/content/authorized-read": ["*"]}),
+            # Shared with the cold start interpreters, like containers share it
+            "TOKEN_STORE": self.token_store,
+        }
+
+    def multi_client(self):
+        """ Authorized reads rotating over every registered app client """
+        cc, n = self.content_consumers, max(1, self.clients)
+        events = [multi_client_event(i) for i in range(n)]
+        state = {"i": 0}
+
+        def _call():
+            if state["i"] == 0:
+                # Mint every client's token up front, only lookups are measured
+                for _e in events:
+                    cc.lambda_handler(_e, LambdaContext())
+            state["i"] += 1
+            return cc.lambda_handler(events[state["i"] % n], LambdaContext())
+        return _call
+
+    def scenarios(self):
+        cc, pc = self.content_consumers, self.premium_content
+        return {
+            "consumer_unauthorized_read": lambda: cc.lambda_handler(consumer_event("/content/unauthorized-read"), LambdaContext()),
+            "consumer_authorized_read": lambda: cc.lambda_handler(consumer_event("/content/authorized-read"), LambdaContext()),
+            "consumer_authorized_write": lambda: cc.lambda_handler(consumer_event("/content/authorized-write"), LambdaContext()),
+            "consumer_authorized_batch_read": lambda: cc.lambda_handler(consumer_event("/content/authorized-batch-read"), LambdaContext()),
+            "consumer_aggregate": lambda: cc.lambda_handler(consumer_event("/content/aggregate"), LambdaContext()),
+            "consumer_multi_client": self.multi_client(),
+            "premium_get": lambda: pc.lambda_handler(premium_event("GET"), LambdaContext()),
+            "premium_post": lambda: pc.lambda_handler(premium_event("POST"), LambdaContext()),
+            "premium_batch": lambda: pc.lambda_handler(premium_batch_event(), LambdaContext()),
+        }
+
+    def stop(self):
+        self.premium_api.stop()
+        self.cognito.stop()
+
+
+def install_fake_secrets(content_consumers, fake):
+    """ Point the consumer's secret cache at the fake Secrets Manager """
+    content_consumers._secret_cache.client = fake
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def measure(fn, iterations, concurrency, warmup):
+    for _ in range(warmup):
+        fn()
+
+    def _timed(_):
+        t0 = time.perf_counter()
+        fn()
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as ex:
+            latencies = list(ex.map(_timed, range(iterations)))
+    else:
+        latencies = [_timed(i) for i in range(iterations)]
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "throughput_rps": iterations / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def measure_allocations(fn, calls=50):
+    """ Traced memory of `calls` warm invocations """
+    fn()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for _ in range(calls):
+        fn()
+    _current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    return {
+        "alloc_blocks_per_call": sum(s.count_diff for s in stats if s.count_diff > 0) / calls,
+        "alloc_kib_per_call": sum(s.size_diff for s in stats if s.size_diff > 0) / calls / 1024,
+        "peak_kib": peak / 1024,
+    }
+
+
+def cold_start(env, scenario):
+    """ Import and first two invocations of a scenario in a fresh interpreter """
+    _env = dict(os.environ)
+    _env.update(env.consumer_env())
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--probe", scenario],
+        env=_env, capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def probe(scenario):
+    """ Runs in the child interpreter started by `cold_start` """
+    t0 = time.perf_counter()
+    if scenario.startswith("consumer"):
+        import content_consumers as module
+        from local_stubs import FakeSecretsManager
+        fake = FakeSecretsManager()
+        fake.put(SECRET_ID, os.environ["BENCH_SECRET_DOC"])
+        install_fake_secrets(module, fake)
+        if scenario == "consumer_multi_client":
+            event = multi_client_event(int(os.environ["BENCH_CLIENTS"]) // 2)
+        else:
+            event = consumer_event(
+                "/content/" + scenario[len("consumer_"):].replace("_", "-"))
+        call = lambda: module.lambda_handler(event, LambdaContext())  # noqa: E731
+    else:
+        import premium_content as module
+        if scenario == "premium_batch":
+            event = premium_batch_event()
+        else:
+            event = premium_event(scenario.split("_")[-1].upper())
+        call = lambda: module.lambda_handler(event, LambdaContext())  # noqa: E731
+    _quiet_logging()
+    t1 = time.perf_counter()
+    call()
+    t2 = time.perf_counter()
+    call()
+    t3 = time.perf_counter()
+    print(json.dumps({
+        "init_ms": (t1 - t0) * 1000,
+        "cold_invoke_ms": (t2 - t1) * 1000,
+        "warm_invoke_ms": (t3 - t2) * 1000,
+    }))
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """ Regressions beyond `tolerance`, ignoring differences below `min_delta_ms` """
+    regressions = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        cur_ms, base_ms = 1000 / cur["throughput_rps"], 1000 / base["throughput_rps"]
+        if cur_ms > base_ms * (1 + tolerance) and cur_ms - base_ms > min_delta_ms:
+            regressions.append(
+                f"{name}: throughput {cur['throughput_rps']:.0f} < {base['throughput_rps']:.0f} rps")
+        for k in ("p95_ms", "p99_ms", "init_ms"):
+            if k in base and k in cur and cur[k] > base[k] * (1 + tolerance) and cur[k] - base[k] > min_delta_ms:
+                regressions.append(f"{name}: {k} {cur[k]:.2f} > {base[k]:.2f}")
+    return regressions
+
+
+def report(results):
+    cols = (("throughput_rps", "rps"), ("p50_ms", "p50 ms"), ("p95_ms", "p95 ms"), ("p99_ms", "p99 ms"),
+            ("alloc_blocks_per_call", "blocks/call"), ("peak_kib", "peak KiB"), ("init_ms", "init ms"),
+            ("cold_invoke_ms", "cold ms"), ("warm_invoke_ms", "warm ms"))
+    print(f"{'scenario':<32}" + "".join(f"{label:>12}" for _, label in cols))
+    for name, r in results.items():
+        print(f"{name:<32}" + "".join(f"{r.get(c, 0):>12.2f}" for c, _ in cols))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--scenario", action="append",
+                        help="run only these scenarios")
+    parser.add_argument("--no-cold-start", action="store_true")
+    parser.add_argument("--upstream-latency-ms", type=float, default=0,
+                        help="delay every premium api request by this much")
+    parser.add_argument("--token-store", default="", metavar="URI",
+                        help="shared token store of the consumer, e.g. sqlite:/tmp/tokens.db")
+    parser.add_argument("--clients", type=int, default=200,
+                        help="app clients in the registry of the multi client scenario")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--min-delta-ms", type=float, default=0.1,
+                        help="ignore latency differences smaller than this")
+    parser.add_argument("--json", metavar="FILE", help="also write the results here")
+    parser.add_argument("--probe", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        return probe(args.probe)
+
+    env = Environment(upstream_latency_ms=args.upstream_latency_ms,
+                      token_store=args.token_store, clients=args.clients)
+    results = {}
+    try:
+        for name, fn in env.scenarios().items():
+            if args.scenario and name not in args.scenario:
+                continue
+            r = measure(fn, args.iterations, args.concurrency, args.warmup)
+            r.update(measure_allocations(fn))
+            if not args.no_cold_start:
+                r.update(cold_start(env, name))
+            results[name] = r
+        results_meta = {"tokens_issued": env.cognito.tokens_issued,
+                        "secret_reads": env.secrets.calls}
+    finally:
+        env.stop()
+
+    report(results)
+    print(f"\ncognito tokens issued: {results_meta['tokens_issued']}, "
+          f"secrets manager reads: {results_meta['secret_reads']}")
+
+    if args.json:
+        with open(args.json, mode="w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{args.save_baseline}.json"), mode="w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json"), mode="r") as f:
+            regressions = compare(
+                results, json.load(f), args.tolerance, args.min_delta_ms)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
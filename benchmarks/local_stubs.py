@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: local_stubs
+    :Actions: Local stand-ins for Cognito, Secrets Manager and the premium api
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Everything runs in-process on 127.0.0.1, so the handlers can be exercised
+without an AWS account.
+  - `FakeCognito` serves `/oauth2/token` (client_credentials grant, RS256
+    signed access tokens) and `/.well-known/jwks.json`
+  - `FakeSecretsManager` answers `get_secret_value` like the boto3 client
+  - `PremiumApiStub` checks the bearer token the way the API Gateway
+    authorizer does, then calls `premium_content.lambda_handler`
+"""
+
+import base64
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rsa_keys import RsaPrivateKey, access_token_claims
+
+
+class _Server:
+    """ Threaded HTTP server on a free local port """
+
+    def __init__(self, handler_cls):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_cls)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, do not let Nagle hold them
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        n = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(n) if n else b""
+
+    def _send(self, status, body, headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _CognitoHandler(_Handler):
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path.endswith("/.well-known/jwks.json"):
+            return self._send(200, {"keys": [stub.key.jwk()]})
+        self._send(404, {"error": "not_found"})
+
+    def do_POST(self):
+        stub = self.server.stub
+        if not self.path.endswith("/oauth2/token"):
+            return self._send(404, {"error": "not_found"})
+        form = dict(urllib.parse.parse_qsl(self._read_body().decode("utf-8")))
+        client_id, client_secret = form.get("client_id"), form.get("client_secret")
+        _auth = self.headers.get("Authorization", "")
+        if _auth.startswith("Basic "):
+            client_id, client_secret = base64.b64decode(
+                _auth[6:]).decode("utf-8").split(":", 1)
+        if form.get("grant_type") != "client_credentials":
+            return self._send(400, {"error": "unsupported_grant_type"})
+        if stub.clients.get(client_id) != client_secret:
+            return self._send(400, {"error": "invalid_client"})
+        with stub.lock:
+            stub.tokens_issued += 1
+        claims = access_token_claims(
+            stub.issuer, client_id, form.get("scope", ""), expires_in=stub.expires_in)
+        self._send(200, {
+            "access_token": stub.key.encode_jwt(claims),
+            "expires_in": stub.expires_in,
+            "token_type": "Bearer"
+        })
+
+
+class FakeCognito(_Server):
+    """ Token endpoint of a user pool domain, with its signing keys """
+
+    def __init__(self, clients, expires_in=3600, key=None):
+        super().__init__(_CognitoHandler)
+        self.clients = dict(clients)
+        self.expires_in = expires_in
+        self.key = key or RsaPrivateKey()
+        self.issuer = f"{self.base_url}/local_pool"
+        self.token_url = f"{self.base_url}/oauth2/token"
+        self.tokens_issued = 0
+        self.lock = threading.Lock()
+
+
+class FakeSecretsManager:
+    """ Just enough of the boto3 secretsmanager client for the handlers """
+
+    def __init__(self, secrets=None):
+        # {secret_id: {version_stage: secret_string}}
+        self.secrets = secrets or {}
+        self.calls = 0
+
+    def put(self, secret_id, value, version_stage="AWSCURRENT"):
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        self.secrets.setdefault(secret_id, {})[version_stage] = value
+
+    def get_secret_value(self, SecretId, VersionStage="AWSCURRENT", **kwargs):
+        self.calls += 1
+        try:
+            value = self.secrets[SecretId][VersionStage]
+        except KeyError:
+            raise KeyError(f"ResourceNotFoundException: {SecretId}/{VersionStage}")
+        return {
+            "ARN": SecretId,
+            "SecretString": value,
+            "VersionId": f"{VersionStage}-{hash(value) & 0xffff:04x}",
+            "VersionStages": [VersionStage]
+        }
+
+
+class _PremiumApiHandler(_Handler):
+
+    def _invoke(self, http_method):
+        stub = self.server.stub
+        path = urllib.parse.urlsplit(self.path).path
+        body = self._read_body()
+        if stub.latency_ms:
+            time.sleep(stub.latency_ms / 1000)
+        resource = path[len(stub.stage_prefix):]
+        required = stub.route_policy.required_mask(http_method, resource)
+        if required is None:
+            return self._send(403, {"message": "Missing Authentication Token"})
+
+        _t = self.headers.get("Authorization", "")
+        try:
+            claims = stub.verifier.verify(_t)
+        except Exception:
+            return self._send(401, {"message": "Unauthorized"})
+        if not stub.route_policy.is_allowed(http_method, resource, stub.route_policy.scope_mask(claims.get("scope", ""))):
+            return self._send(403, {"message": "Unauthorized"})
+
+        event = {
+            "resource": resource,
+            "path": path,
+            "httpMethod": http_method,
+            "headers": dict(self.headers),
+            "queryStringParameters": None,
+            "body": body.decode("utf-8") if body else None,
+            "isBase64Encoded": False,
+            "requestContext": {
+                "resourcePath": resource,
+                "httpMethod": http_method,
+                "stage": "prod",
+                "authorizer": {"claims": claims}
+            }
+        }
+        resp = stub.handler(event, None)
+        # Binary media types, API Gateway decodes base64 bodies before sending them
+        body = resp.get("body") or ""
+        body = base64.b64decode(body) if resp.get("isBase64Encoded") else body.encode("utf-8")
+        self._send(resp.get("statusCode", 200), body, resp.get("headers"))
+
+    def do_GET(self):
+        self._invoke("GET")
+
+    def do_POST(self):
+        self._invoke("POST")
+
+
+class PremiumApiStub(_Server):
+    """ API Gateway stand-in in front of the premium content handler """
+
+    def __init__(self, handler, verifier, route_policy, stage="prod", latency_ms=0):
+        super().__init__(_PremiumApiHandler)
+        # Added to every request, to stand in for the network & gateway
+        self.latency_ms = latency_ms
+        self.handler = handler
+        self.verifier = verifier
+        self.route_policy = route_policy
+        self.stage_prefix = f"/{stage}"
+        self.url = f"{self.base_url}/{stage}/home/premium"
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: rsa_keys
+    :Actions: Generate RSA keys and sign RS256 JWTs for local stand-ins, no third party packages
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+import base64
+import hashlib
+import json
+import random
+import time
+
+_SMALL_PRIMES = [p for p in range(3, 2000) if all(p % d for d in range(2, int(p ** 0.5) + 1))]
+_SHA256_DIGEST_INFO = bytes.fromhex("3031300d060960864801650304020105000420")
+
+
+def _is_probable_prime(n, rounds=40):
+    for p in _SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for _ in range(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _random_prime(bits):
+    while True:
+        c = random.getrandbits(bits) | (1 << (bits - 1)) | (1 << (bits - 2)) | 1
+        if _is_probable_prime(c):
+            return c
+
+
+def b64url_encode(b):
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+
+def _uint_b64(i):
+    return b64url_encode(i.to_bytes((i.bit_length() + 7) // 8, "big"))
+
+
+class RsaPrivateKey:
+    """ Test only RSA key, do not use it for anything real """
+
+    def __init__(self, kid="local-key-1", bits=2048, e=65537):
+        while True:
+            p, q = _random_prime(bits // 2), _random_prime(bits // 2)
+            phi = (p - 1) * (q - 1)
+            if p != q and phi % e:
+                break
+        self.kid = kid
+        self.n, self.e = p * q, e
+        self.p, self.q = p, q
+        self.d = pow(e, -1, phi)
+        self.size = (self.n.bit_length() + 7) // 8
+
+    def jwk(self):
+        return {"kid": self.kid, "kty": "RSA", "alg": "RS256", "use": "sig",
+                "n": _uint_b64(self.n), "e": _uint_b64(self.e)}
+
+    def sign_rs256(self, message):
+        t = _SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+        em = b"\x00\x01" + b"\xff" * (self.size - len(t) - 3) + b"\x00" + t
+        m = int.from_bytes(em, "big")
+        # CRT makes signing roughly 3x faster
+        sp = pow(m, self.d % (self.p - 1), self.p)
+        sq = pow(m, self.d % (self.q - 1), self.q)
+        s = sq + self.q * ((pow(self.q, -1, self.p) * (sp - sq)) % self.p)
+        return s.to_bytes(self.size, "big")
+
+    def encode_jwt(self, claims):
+        header = {"kid": self.kid, "alg": "RS256"}
+        signing_input = (b64url_encode(json.dumps(header).encode()) + "." +
+                         b64url_encode(json.dumps(claims).encode())).encode("ascii")
+        return (signing_input + b"." + b64url_encode(self.sign_rs256(signing_input)).encode()).decode("ascii")
+
+
+def access_token_claims(issuer, client_id, scope, expires_in=3600, **extra):
+    now = int(time.time())
+    claims = {
+        "sub": client_id,
+        "token_use": "access",
+        "scope": scope,
+        "auth_time": now,
+        "iss": issuer,
+        "exp": now + expires_in,
+        "iat": now,
+        "version": 2,
+        "jti": f"{random.getrandbits(64):016x}",
+        "client_id": client_id
+    }
+    claims.update(extra)
+    return claims
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: lambda_bundle
+    :Actions: Build the function and layer assets, stripped to the modules in use & byte-compiled
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    bundler = AssetBundler(".build/premium-content-provider", (3, 7), ["lambda_layers/shared"])
+    code = _lambda.Code.from_asset(
+        bundler.function("premium_content", "premium_api/lambda_src", "premium_content"))
+    layer_code = _lambda.Code.from_asset(bundler.layer("shared", "lambda_layers/shared"))
+
+A function asset holds only the modules its handler imports, following the
+imports(_deferred ones too_) through the function code and the layers. A
+layer asset holds only the modules the functions built before it import.
+
+The function code lives on a read-only file system, so Python can not cache
+the modules it compiles and compiles them again on every cold start. The
+bundles ship with `__pycache__` compiled ahead by the runtime's Python
+version, in the `unchecked-hash` mode, the runtime loads them without looking
+at the source. The bytes of such a `.pyc` do not depend on file times, so an
+unchanged bundle keeps its asset hash and is not uploaded again. Without
+`keep_sources` the `.py` files are dropped and the compiled modules take
+their place, a smaller package, but tracebacks show no source lines.
+
+Only the standard library is used, the module runs outside of the CDK too.
+"""
+
+import ast
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+
+logger = logging.getLogger()
+
+
+def _imported_names(path):
+    """ Every module name `path` imports, at any depth of the code """
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(_a.name for _a in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+            names.add(node.module)
+            # `from package import module`
+            names.update(f"{node.module}.{_a.name}" for _a in node.names)
+    return names
+
+
+def _module_files(name, root):
+    """ Files under `root` of the module `name` and of the packages holding it, `[]` when not there """
+    parts = name.split(".")
+    files = []
+    for i in range(1, len(parts)):
+        _init = os.path.join(*parts[:i], "__init__.py")
+        if not os.path.isfile(os.path.join(root, _init)):
+            return []
+        files.append(_init)
+    for _f in (os.path.join(*parts) + ".py", os.path.join(*parts, "__init__.py")):
+        if os.path.isfile(os.path.join(root, _f)):
+            return files + [_f]
+    return []
+
+
+def module_closure(entry_module, roots):
+    """
+    `{root: {relative file paths}}` of `entry_module` and of every module it
+    imports found under the `roots`, transitively. The standard library and
+    the runtime's packages are not under the roots and are left out.
+    """
+    found = {root: set() for root in roots}
+    pending = [entry_module]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for root in roots:
+            files = _module_files(name, root)
+            if not files:
+                continue
+            for _f in files:
+                if _f not in found[root]:
+                    found[root].add(_f)
+                    pending.extend(_imported_names(os.path.join(root, _f)))
+            break
+    return found
+
+
+def python_for(version):
+    """ Interpreter of the Python `version`, `(3, 8)`, `None` when there is none here """
+    if sys.version_info[:2] == tuple(version):
+        return sys.executable
+    python = shutil.which("python{}.{}".format(*version))
+    if python is None:
+        return None
+    # Version managers put shims on the path for versions not installed
+    _v = subprocess.run(
+        [python, "-c", "import sys; print('%d.%d' % sys.version_info[:2])"],
+        capture_output=True, text=True)
+    return python if _v.stdout.strip() == "{}.{}".format(*version) else None
+
+
+def compile_tree(directory, python, display_dir, keep_sources=True):
+    """
+    Byte-compile the modules under `directory` with `python`, into
+    `__pycache__`, or in place of the sources without `keep_sources`.
+    Tracebacks show the paths under `display_dir`, where the code is
+    unpacked in the lambda.
+    """
+    subprocess.run(
+        [python, "-m", "compileall", "-q", "-d", display_dir,
+         "--invalidation-mode", "unchecked-hash"]
+        + ([] if keep_sources else ["-b"]) + [directory],
+        check=True
+    )
+    if not keep_sources:
+        for _f in source_files(directory):
+            if _f.endswith(".py"):
+                os.remove(os.path.join(directory, _f))
+
+
+def copy_files(files, source_dir, out_dir):
+    """ Fresh `out_dir` holding `files`, relative to `source_dir` """
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    for _f in sorted(files):
+        _dst = os.path.join(out_dir, _f)
+        os.makedirs(os.path.dirname(_dst), exist_ok=True)
+        # Contents only, file times would not change the asset anyway
+        shutil.copyfile(os.path.join(source_dir, _f), _dst)
+
+
+def source_files(source_dir):
+    """ Every file under `source_dir`, less caches of the local interpreter """
+    files = []
+    for _dir, _dirs, _files in os.walk(source_dir):
+        _dirs[:] = [d for d in _dirs if d != "__pycache__"]
+        files.extend(os.path.relpath(os.path.join(_dir, f), source_dir)
+                     for f in _files if not f.endswith((".pyc", ".pyo")))
+    return files
+
+
+def bundle_size(directory):
+    """ `(files, bytes, zipped bytes)` of the asset `directory` """
+    files = [os.path.relpath(os.path.join(_dir, f), directory)
+             for _dir, _, _files in os.walk(directory) for f in _files]
+    raw = sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+    _zip = directory.rstrip(os.sep) + ".zip"
+    with zipfile.ZipFile(_zip, "w", zipfile.ZIP_DEFLATED) as z:
+        for f in sorted(files):
+            z.write(os.path.join(directory, f), f)
+    zipped = os.path.getsize(_zip)
+    os.remove(_zip)
+    return len(files), raw, zipped
+
+
+class AssetBundler:
+    """
+    Builds the assets of one stack under `build_dir`. `layer_dirs` are the
+    layer assets the functions import from, with the code under `python/`.
+    Disabled, it hands back the source directories as they are.
+    """
+
+    def __init__(self, build_dir, python_version, layer_dirs=(), compile_modules=True,
+                 keep_sources=True, enabled=True, warn=None):
+        self.build_dir = build_dir
+        self.python_version = tuple(python_version)
+        self.layer_dirs = list(layer_dirs)
+        self.compile_modules = compile_modules
+        self.keep_sources = keep_sources
+        self.enabled = enabled
+        self._warn = warn or logger.warning
+        # Layer directory -> the files of it the functions built so far import
+        self._layer_files = {}
+        self._python = None
+
+    @classmethod
+    def from_context(cls, node, python_version, layer_dirs=()):
+        """
+        Settings of the `bundling` context value, `{"enabled": true,
+        "compile": true, "keep_sources": true, "build_dir": ".build"}`, for
+        the stack of `node`.
+        """
+        _b = node.try_get_context("bundling") or {}
+        return cls(
+            os.path.join(_b.get("build_dir", ".build"), node.id),
+            python_version,
+            layer_dirs,
+            compile_modules=_b.get("compile", True),
+            keep_sources=_b.get("keep_sources", True),
+            enabled=_b.get("enabled", True),
+            warn=node.add_warning
+        )
+
+    def _compile(self, directory, display_dir):
+        if not self.compile_modules:
+            return
+        if self._python is None:
+            self._python = python_for(self.python_version) or ""
+            if not self._python:
+                self._warn(
+                    "No python{}.{} to byte-compile the lambda code with, "
+                    "shipping the sources only".format(*self.python_version))
+        if self._python:
+            compile_tree(directory, self._python, display_dir, self.keep_sources)
+
+    def function(self, name, source_dir, handler_module):
+        """ Asset directory of the function with the handler in `handler_module` """
+        if not self.enabled:
+            return source_dir
+        _layer_roots = [os.path.join(_l, "python") for _l in self.layer_dirs]
+        closure = module_closure(handler_module, [source_dir] + _layer_roots)
+        for _l, _root in zip(self.layer_dirs, _layer_roots):
+            self._layer_files.setdefault(_l, set()).update(
+                os.path.join("python", _f) for _f in closure[_root])
+
+        out_dir = os.path.join(self.build_dir, name)
+        copy_files(closure[source_dir], source_dir, out_dir)
+        self._compile(out_dir, "/var/task")
+        return out_dir
+
+    def layer(self, name, layer_dir):
+        """ Asset directory of the layer, the whole of it when no function uses it yet """
+        if not self.enabled:
+            return layer_dir
+        files = self._layer_files.get(layer_dir) or source_files(layer_dir)
+        out_dir = os.path.join(self.build_dir, name)
+        copy_files(files, layer_dir, out_dir)
+        self._compile(out_dir, "/opt")
+        return out_dir
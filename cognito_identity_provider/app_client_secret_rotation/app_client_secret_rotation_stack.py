@@ -0,0 +1,81 @@
+from aws_cdk import aws_iam as _iam
+from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_logs as _logs
+from aws_cdk import core
+
+
+class AppClientSecretRotationStack(core.Construct):
+    """
+    Rotates the app client secrets of a `cognito_{user_pool_id}` secret every
+    `rotation_days` days, with a Secrets Manager rotation function. Cognito's
+    client secret APIs need a newer boto3 than the python3.7 runtime has, the
+    function runs `code` on `runtime`, with the shared code of `shared_layer`.
+    """
+
+    def __init__(self, scope: core.Construct, id: str, secret_arn, user_pool_arn,
+                 code, shared_layer, runtime, rotation_days=30) -> None:
+        super().__init__(scope, id)
+
+        roleStmt1 = _iam.PolicyStatement(
+            effect=_iam.Effect.ALLOW,
+            resources=[user_pool_arn],
+            actions=["cognito-idp:ListUserPoolClientSecrets",
+                     "cognito-idp:AddUserPoolClientSecret",
+                     "cognito-idp:DeleteUserPoolClientSecret"]
+        )
+        roleStmt1.sid = "AllowLambdaToRotateAppClientSecrets"
+
+        roleStmt2 = _iam.PolicyStatement(
+            effect=_iam.Effect.ALLOW,
+            resources=[secret_arn],
+            actions=["secretsmanager:DescribeSecret",
+                     "secretsmanager:GetSecretValue",
+                     "secretsmanager:PutSecretValue",
+                     "secretsmanager:UpdateSecretVersionStage"]
+        )
+        roleStmt2.sid = "AllowLambdaToRotateTheSecret"
+
+        secret_rotation_fn = _lambda.Function(
+            self,
+            "secretRotationFn",
+            code=code,
+            layers=[shared_layer],
+            handler="secret_rotation.lambda_handler",
+            # Every app client of the pool is rotated & tested, one after another
+            timeout=core.Duration.minutes(5),
+            runtime=runtime,
+            reserved_concurrent_executions=1,
+            environment={
+                "LOG_LEVEL": "INFO",
+                "APP_ENV": "Production",
+                "TOKEN_TIMEOUT_SECONDS": "5"
+            }
+        )
+        secret_rotation_fn.add_to_role_policy(roleStmt1)
+        secret_rotation_fn.add_to_role_policy(roleStmt2)
+
+        secret_rotation_fn_lg = _logs.LogGroup(
+            self,
+            "secretRotationFnLoggroup",
+            log_group_name=f"/aws/lambda/{secret_rotation_fn.function_name}",
+            retention=_logs.RetentionDays.ONE_WEEK,
+            removal_policy=core.RemovalPolicy.DESTROY
+        )
+
+        secret_rotation_fn.add_permission(
+            "allowSecretsManagerInvoke",
+            principal=_iam.ServicePrincipal("secretsmanager.amazonaws.com")
+        )
+
+        # The secret is made by a custom resource, not by a `Secret` construct
+        rotation_schedule = core.CfnResource(
+            self,
+            "rotationSchedule",
+            type="AWS::SecretsManager::RotationSchedule",
+            properties={
+                "SecretId": secret_arn,
+                "RotationLambdaARN": secret_rotation_fn.function_arn,
+                "RotationRules": {"AutomaticallyAfterDays": rotation_days}
+            }
+        )
+        rotation_schedule.node.add_dependency(secret_rotation_fn)
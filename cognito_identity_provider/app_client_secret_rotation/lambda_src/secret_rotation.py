@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: secret_rotation
+    :Actions: Rotate the app client secrets of a `cognito_{user_pool_id}` secret, without downtime
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Secrets Manager calls the function once per step of a rotation,
+    createSecret  - Cognito adds a new secret to every app client of the
+                    document, the document with them is staged as AWSPENDING
+    setSecret     - Cognito made the new secrets, nothing is left to set,
+                    checks every app client still has its new secret
+    testSecret    - mints a token with every new secret, a rotation the
+                    consumers could not use stops here
+    finishSecret  - moves AWSCURRENT to the new version
+
+A Cognito app client holds two secrets, both valid. The secrets a version
+replaced stay valid until the next rotation removes them, so a consumer
+still holding the old document keeps minting tokens with it. One that finds
+its secret rejected re-reads AWSCURRENT, then AWSPENDING.
+
+The client secret APIs of Cognito need a recent boto3, newer than the one
+of the python3.7 & python3.8 runtimes.
+"""
+
+import json
+import os
+
+from shared import http_client
+from shared.aws_clients import client
+from shared.metrics import metrics
+from shared.structured_logging import set_logging
+
+
+class global_args:
+    """ Global statics """
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "secret_rotation"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    TOKEN_TIMEOUT_SECONDS = float(os.getenv("TOKEN_TIMEOUT_SECONDS", 5))
+
+
+logger = set_logging(global_args.LOG_LEVEL)
+
+
+def _client_ids(doc):
+    """ Ids of the app clients of the document, the primary client first """
+    ids = [doc["user_pool_client_id"]]
+    ids.extend(_id for _id in doc.get("app_clients") or {} if _id not in ids)
+    return ids
+
+
+def _entries(doc, client_id):
+    """ The dicts holding fields of the app client, the top level is the primary client's """
+    entries = []
+    if doc["user_pool_client_id"] == client_id:
+        entries.append(doc)
+    if client_id in (doc.get("app_clients") or {}):
+        entries.append(doc["app_clients"][client_id])
+    return entries
+
+
+def _field(doc, client_id, name, default=None):
+    """ A field of the app client, the pool wide one when the client has none """
+    for _e in reversed(_entries(doc, client_id)):
+        if name in _e:
+            return _e[name]
+    return doc.get(name, default)
+
+
+def _client_secrets(user_pool_id, client_id):
+    """ Descriptors of the secrets Cognito holds for the app client """
+    _cognito = client("cognito-idp")
+    kwargs = {"UserPoolId": user_pool_id, "ClientId": client_id}
+    secrets = []
+    while True:
+        resp = _cognito.list_user_pool_client_secrets(**kwargs)
+        secrets.extend(resp.get("ClientSecrets", []))
+        if not resp.get("NextToken"):
+            return secrets
+        kwargs["NextToken"] = resp["NextToken"]
+
+
+def _secret_in_use(secrets, doc, client_id):
+    """ Id of the Cognito secret the document has for the app client """
+    _ids = {_s["ClientSecretId"] for _s in secrets}
+    _id = _field(doc, client_id, "app_client_secret_id")
+    if _id in _ids:
+        return _id
+    # Never rotated, the document only has the value
+    _value = _field(doc, client_id, "app_client_secret")
+    for _s in secrets:
+        if _s.get("ClientSecretValue") == _value:
+            return _s["ClientSecretId"]
+    if len(secrets) == 1:
+        return secrets[0]["ClientSecretId"]
+    raise ValueError(
+        f"Can not tell which of the {len(secrets)} secrets of app client {client_id} is in use")
+
+
+def _pending_document(sm, arn, token):
+    return json.loads(sm.get_secret_value(
+        SecretId=arn, VersionId=token, VersionStage="AWSPENDING")["SecretString"])
+
+
+def _rotated_clients(doc):
+    """ The app clients of the document that have a secret, clients without one have nothing to rotate """
+    return [_id for _id in _client_ids(doc) if _field(doc, _id, "app_client_secret")]
+
+
+def create_secret(sm, arn, token):
+    try:
+        _pending_document(sm, arn, token)
+        logger.info("createSecret: %s already has a pending version %s", arn, token)
+        return
+    except sm.exceptions.ResourceNotFoundException:
+        pass
+
+    _current = sm.get_secret_value(SecretId=arn, VersionStage="AWSCURRENT")["SecretString"]
+    doc = json.loads(_current)
+    pending = json.loads(_current)
+    _cognito = client("cognito-idp")
+    for client_id in _rotated_clients(doc):
+        secrets = _client_secrets(doc["user_pool_id"], client_id)
+        in_use = _secret_in_use(secrets, doc, client_id)
+        # Secrets of the version before, or of an attempt of this rotation
+        # that failed half way, an app client only takes two
+        for _s in secrets:
+            if _s["ClientSecretId"] != in_use:
+                _cognito.delete_user_pool_client_secret(
+                    UserPoolId=doc["user_pool_id"],
+                    ClientId=client_id,
+                    ClientSecretId=_s["ClientSecretId"]
+                )
+        new = _cognito.add_user_pool_client_secret(
+            UserPoolId=doc["user_pool_id"],
+            ClientId=client_id
+        )["ClientSecretDescriptor"]
+        for _e in _entries(pending, client_id):
+            _e["app_client_secret"] = new["ClientSecretValue"]
+            _e["app_client_secret_id"] = new["ClientSecretId"]
+
+    sm.put_secret_value(
+        SecretId=arn,
+        ClientRequestToken=token,
+        SecretString=json.dumps(pending),
+        VersionStages=["AWSPENDING"]
+    )
+    metrics.incr("ClientSecretsAdded", len(_rotated_clients(doc)))
+    logger.info("createSecret: staged new secrets of %s as version %s", arn, token)
+
+
+def set_secret(sm, arn, token):
+    pending = _pending_document(sm, arn, token)
+    for client_id in _rotated_clients(pending):
+        _ids = {_s["ClientSecretId"]
+                for _s in _client_secrets(pending["user_pool_id"], client_id)}
+        if _field(pending, client_id, "app_client_secret_id") not in _ids:
+            raise ValueError(
+                f"App client {client_id} does not hold the secret of version {token}")
+
+
+@metrics.timed("TestTokenLatency")
+def _mint_token(doc, client_id):
+    """ Access token of the app client, with the secret of `doc` """
+    secret = _field(doc, client_id, "app_client_secret")
+    fields = {"grant_type": "client_credentials", "client_id": client_id}
+    scopes = _field(doc, client_id, "scopes")
+    if scopes:
+        _res_srv = _field(doc, client_id, "unicorn_user_pool_res_srv_identifier")
+        fields["scope"] = " ".join(f"{_res_srv}/{_s}" for _s in scopes)
+    resp = http_client.request(
+        "POST",
+        _field(doc, client_id, "user_pool_oauth2_endpoint"),
+        headers={"Authorization": http_client.basic_auth(client_id, secret)},
+        fields=fields,
+        timeout=global_args.TOKEN_TIMEOUT_SECONDS
+    )
+    _r = json.loads(resp.data or b"{}")
+    if resp.status != 200 or "access_token" not in _r:
+        raise ValueError(
+            f"App client {client_id} got no token with its new secret: {resp.status} {_r.get('error')}")
+
+
+def test_secret(sm, arn, token):
+    pending = _pending_document(sm, arn, token)
+    for client_id in _rotated_clients(pending):
+        _mint_token(pending, client_id)
+    logger.info("testSecret: every app client of %s mints tokens with version %s", arn, token)
+
+
+def finish_secret(sm, arn, token):
+    versions = sm.describe_secret(SecretId=arn)["VersionIdsToStages"]
+    current = next(
+        (_v for _v, _stages in versions.items() if "AWSCURRENT" in _stages), None)
+    if current == token:
+        logger.info("finishSecret: version %s of %s is AWSCURRENT already", token, arn)
+        return
+    sm.update_secret_version_stage(
+        SecretId=arn,
+        VersionStage="AWSCURRENT",
+        MoveToVersionId=token,
+        RemoveFromVersionId=current
+    )
+    logger.info("finishSecret: version %s of %s is AWSCURRENT", token, arn)
+
+
+_STEPS = {
+    "createSecret": create_secret,
+    "setSecret": set_secret,
+    "testSecret": test_secret,
+    "finishSecret": finish_secret,
+}
+
+
+@metrics.instrument
+def lambda_handler(event, context):
+    arn = event["SecretId"]
+    token = event["ClientRequestToken"]
+    step = event["Step"]
+    logger.info("Rotation step %s of %s, version %s", step, arn, token)
+
+    sm = client("secretsmanager")
+    metadata = sm.describe_secret(SecretId=arn)
+    if not metadata.get("RotationEnabled"):
+        raise ValueError(f"Rotation is not enabled for {arn}")
+    versions = metadata["VersionIdsToStages"]
+    if token not in versions:
+        raise ValueError(f"Version {token} of {arn} has no stage")
+    if "AWSCURRENT" in versions[token]:
+        logger.info("Version %s of %s is AWSCURRENT already", token, arn)
+        return
+    if "AWSPENDING" not in versions[token]:
+        raise ValueError(f"Version {token} of {arn} is not AWSPENDING")
+    if step not in _STEPS:
+        raise ValueError(f"Unknown rotation step {step}")
+    _STEPS[step](sm, arn, token)
@@ -1,7 +1,11 @@
 from aws_cdk import core
 from aws_cdk import aws_cognito as _cognito
+from aws_cdk import aws_lambda as _lambda
 import os
 
+from bundling.lambda_bundle import AssetBundler
+from performance_profiles.performance_profile import PerformanceProfile
+from cognito_identity_provider.app_client_secret_rotation.app_client_secret_rotation_stack import AppClientSecretRotationStack
 from cognito_identity_provider.custom_resources.cognito_app_client_secret_retriever.app_client_secret_retriever_stack import CognitoAppClientSecretRetrieverStack
 
 
@@ -91,55 +95,135 @@ class CognitoIdentityProviderStack(core.Stack):
             ]
         )
 
-        user_pool_client = _cognito.UserPoolClient(
-            self,
-            "AppClient",
-            user_pool=self.unicorn_user_pool,
-            user_pool_client_name="premium_app_users",
-            generate_secret=True,
-            # We'll allow both Flows, Implicit and Authorization Code, and decide in the app which to use.
-            auth_flows=_cognito.AuthFlow(
-                admin_user_password=False,
-                custom=True,
-                refresh_token=True,
-                user_password=False,
-                user_srp=True
-            ),
-            prevent_user_existence_errors=True,
-            o_auth=_cognito.OAuthSettings(
-                flows=_cognito.OAuthFlows(
-                    authorization_code_grant=False, implicit_code_grant=False, client_credentials=True),
-                scopes=[
-                    # _cognito.OAuthScope.EMAIL,
-                    # _cognito.OAuthScope.OPENID,
-                    # _cognito.OAuthScope.COGNITO_ADMIN,
-                    # _cognito.OAuthScope.PROFILE,
-                    # https://docs.aws.amazon.com/cdk/api/latest/python/aws_cdk.aws_cognito/OAuthScope.html#aws_cdk.aws_cognito.OAuthScope
-                    _cognito.OAuthScope.custom(
-                        f"{self.unicorn_user_pool_res_srv_identifier}/{self.unicorn_read_scope}"),
-                    _cognito.OAuthScope.custom(
-                        f"{self.unicorn_user_pool_res_srv_identifier}/{self.unicorn_write_scope}")
-                ]
+        # App client registry: the machine clients of the premium api and the
+        # scopes each of them may ask for, declared under `app_clients` in the
+        # `cdk.json` context. The first one is the default client.
+        app_clients = self.node.try_get_context("app_clients") or [
+            {"name": "premium_app_users", "scopes": [
+                self.unicorn_read_scope, self.unicorn_write_scope]}
+        ]
+        known_scopes = {self.unicorn_read_scope, self.unicorn_write_scope}
+
+        user_pool_clients = []
+        for i, app_client in enumerate(app_clients):
+            unknown_scopes = set(app_client["scopes"]) - known_scopes
+            if unknown_scopes:
+                raise ValueError(
+                    f"App client {app_client['name']} asks for unknown scopes {sorted(unknown_scopes)}")
+            user_pool_client = _cognito.UserPoolClient(
+                self,
+                # The first client keeps the id it always had, so it is not replaced
+                "AppClient" if i == 0 else f"AppClient-{app_client['name']}",
+                user_pool=self.unicorn_user_pool,
+                user_pool_client_name=app_client["name"],
+                generate_secret=True,
+                # We'll allow both Flows, Implicit and Authorization Code, and decide in the app which to use.
+                auth_flows=_cognito.AuthFlow(
+                    admin_user_password=False,
+                    custom=True,
+                    refresh_token=True,
+                    user_password=False,
+                    user_srp=True
+                ),
+                prevent_user_existence_errors=True,
+                o_auth=_cognito.OAuthSettings(
+                    flows=_cognito.OAuthFlows(
+                        authorization_code_grant=False, implicit_code_grant=False, client_credentials=True),
+                    scopes=[
+                        # https://docs.aws.amazon.com/cdk/api/latest/python/aws_cdk.aws_cognito/OAuthScope.html#aws_cdk.aws_cognito.OAuthScope
+                        _cognito.OAuthScope.custom(
+                            f"{self.unicorn_user_pool_res_srv_identifier}/{_scope}")
+                        for _scope in app_client["scopes"]
+                    ]
+                )
             )
+
+            # Add dependency so that ResourceServer is deployed before App Client
+            user_pool_client.node.add_dependency(user_pool_res_srv)
+            user_pool_clients.append(
+                (app_client, user_pool_client.user_pool_client_id))
+
+        # The functions keeping the app client secrets share one runtime,
+        # Cognito's client secret APIs need a newer boto3 than python3.7 has
+        secret_rotation = self.node.try_get_context("secret_rotation") or {}
+        secrets_fn_runtime = PerformanceProfile.lambda_runtime(
+            secret_rotation.get("runtime", "python3.12"))
+
+        # The functions ship only the modules they import, byte-compiled ahead
+        bundler = AssetBundler.from_context(
+            self.node,
+            PerformanceProfile.runtime_python_version(secrets_fn_runtime),
+            ["lambda_layers/shared"]
+        )
+        secret_retriever_asset = bundler.function(
+            "app_client_secret_retriever",
+            "cognito_identity_provider/custom_resources/cognito_app_client_secret_retriever/lambda_src",
+            "index"
         )
+        secret_rotation_asset = None
+        if secret_rotation.get("enabled", False):
+            secret_rotation_asset = bundler.function(
+                "secret_rotation",
+                "cognito_identity_provider/app_client_secret_rotation/lambda_src",
+                "secret_rotation"
+            )
 
-        # Add dependency so that ResourceServer is deployed before App Client
-        user_pool_client.node.add_dependency(user_pool_res_srv)
+        # Code shared by the functions, lazily built AWS clients, http pool etc.
+        shared_layer = _lambda.LayerVersion(
+            self,
+            "sharedLayer",
+            code=_lambda.Code.from_asset(
+                bundler.layer("shared_layer", "lambda_layers/shared")),
+            compatible_runtimes=[secrets_fn_runtime],
+            description="Code shared by the lambda functions"
+        )
 
         # Retrieve Cognito App Client Secret and Add to Secrets Manager
         app_secrets = CognitoAppClientSecretRetrieverStack(
             self,
             "appClientSecrets",
+            code=_lambda.Code.from_asset(secret_retriever_asset),
+            shared_layer=shared_layer,
+            runtime=secrets_fn_runtime,
             user_pool_id=self.unicorn_user_pool.user_pool_id,
-            user_pool_client_id=user_pool_client.user_pool_client_id,
+            user_pool_client_id=user_pool_clients[0][1],
             user_pool_oauth2_endpoint=f"https://{unicorn_users_auth_domain.domain_name}.auth.{core.Aws.REGION}.amazoncognito.com/oauth2/token",
             unicorn_user_pool_res_srv_identifier=f"{self.unicorn_user_pool_res_srv_identifier}",
             unicorn_read_scope=f"{self.unicorn_read_scope}",
-            unicorn_write_scope=f"{self.unicorn_write_scope}"
+            unicorn_write_scope=f"{self.unicorn_write_scope}",
+            # Every client with its name & scopes, in one batched secret document
+            app_clients=[
+                {
+                    "user_pool_id": self.unicorn_user_pool.user_pool_id,
+                    "user_pool_client_id": _client_id,
+                    "client_name": app_client["name"],
+                    "scopes": app_client["scopes"]
+                }
+                for app_client, _client_id in user_pool_clients
+            ]
         )
 
+        # Rotate the app client secrets, Cognito keeps the old secret valid
+        # along with the new one, the consumers never see a rejected secret
+        if secret_rotation_asset:
+            AppClientSecretRotationStack(
+                self,
+                "appClientSecretRotation",
+                secret_arn=app_secrets.response,
+                user_pool_arn=self.unicorn_user_pool.user_pool_arn,
+                code=_lambda.Code.from_asset(secret_rotation_asset),
+                shared_layer=shared_layer,
+                runtime=secrets_fn_runtime,
+                rotation_days=int(secret_rotation.get("days", 30))
+            )
+
         # Export Value
         self.unicorn_user_pool_secrets_arn = app_secrets.response
+        # Client name -> client id, a reference to each is an export of its
+        # own, onboarding a client adds an export and changes none in use
+        self.app_clients = app_clients
+        self.app_client_ids = {
+            app_client["name"]: _client_id for app_client, _client_id in user_pool_clients}
 
         ###########################################
         ################# OUTPUTS #################
@@ -165,3 +249,11 @@ class CognitoIdentityProviderStack(core.Stack):
             value=f"{app_secrets.response}",
             description="AppPoolSecretsArn"
         )
+
+        output_3 = core.CfnOutput(
+            self,
+            "AppClientIds",
+            value=core.Fn.join(
+                ",", [_client_id for _, _client_id in user_pool_clients]),
+            description="Ids of the app clients, in the order of the app_clients context"
+        )
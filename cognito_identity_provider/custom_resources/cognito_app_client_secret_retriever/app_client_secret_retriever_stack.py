@@ -6,19 +6,17 @@ from aws_cdk import core
 
 
 class CognitoAppClientSecretRetrieverStack(core.Construct):
-    def __init__(self, scope: core.Construct, id: str, ** kwargs) -> None:
-        super().__init__(scope, id)
+    """
+    Keeps the app client secrets in a `cognito_{user_pool_id}` secret per user
+    pool. Takes the `user_pool_id` & `user_pool_client_id` of an app client
+    and, optionally, more of them as `app_clients=[{"user_pool_id": ..,
+    "user_pool_client_id": ..}, ..]`. The other keyword arguments are shared
+    by every app client. The function runs `code` on `runtime`, with the
+    shared code of `shared_layer`.
+    """
 
-        # Read Lambda Function Code):
-        # Read Lambda Code
-        try:
-            with open("cognito_identity_provider/custom_resources/cognito_app_client_secret_retriever/lambda_src/index.py",
-                      encoding="utf-8",
-                      mode="r") as f:
-                cognito_app_client_secret_retriever_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
+    def __init__(self, scope: core.Construct, id: str, code, shared_layer, runtime, ** kwargs) -> None:
+        super().__init__(scope, id)
 
         # Create IAM Permission Statements that are required by the Lambda
 
@@ -33,6 +31,8 @@ class CognitoAppClientSecretRetrieverStack(core.Construct):
             effect=_iam.Effect.ALLOW,
             resources=["*"],
             actions=["secretsmanager:CreateSecret",
+                     "secretsmanager:GetSecretValue",
+                     "secretsmanager:PutSecretValue",
                      "secretsmanager:TagResource",
                      "secretsmanager:UpdateSecret",
                      "secretsmanager:DeleteSecret"]
@@ -43,15 +43,19 @@ class CognitoAppClientSecretRetrieverStack(core.Construct):
             self,
             "Singleton",
             uuid="mystique30-4ee1-11e8-9c2d-fa7ae01bbebc",
-            code=_lambda.InlineCode(
-                cognito_app_client_secret_retriever_fn_code),
+            # Shipped as an asset, the code outgrew the 4KB inline limit. It
+            # brings its own cfnresponse, CloudFormation only injects it inline
+            code=code,
+            layers=[shared_layer],
             handler="index.lambda_handler",
-            timeout=core.Duration.seconds(10),
-            runtime=_lambda.Runtime.PYTHON_3_7,
+            timeout=core.Duration.seconds(60),
+            runtime=runtime,
             reserved_concurrent_executions=1,
             environment={
                 "LOG_LEVEL": "INFO",
-                "APP_ENV": "Production"
+                "APP_ENV": "Production",
+                "DESCRIBE_CONCURRENCY": "5",
+                "UPSERT_CONCURRENCY": "5"
             }
         )
 
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: cfnresponse
+    :Actions: Report the outcome of a custom resource request to CloudFormation
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+CloudFormation only injects its `cfnresponse` module into inline(_ZipFile_)
+code, functions shipped as an asset bring their own. Same interface.
+"""
+
+import json
+import logging
+import urllib.request
+
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+
+
+def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False, reason=None):
+    body = json.dumps({
+        "Status": responseStatus,
+        "Reason": reason or f"See the details in CloudWatch Log Stream: {context.log_stream_name}",
+        "PhysicalResourceId": physicalResourceId or context.log_stream_name,
+        "StackId": event["StackId"],
+        "RequestId": event["RequestId"],
+        "LogicalResourceId": event["LogicalResourceId"],
+        "NoEcho": noEcho,
+        "Data": responseData
+    }).encode("utf-8")
+
+    req = urllib.request.Request(
+        event["ResponseURL"],
+        data=body,
+        method="PUT",
+        # The pre-signed url is signed without a content type
+        headers={"Content-Type": "", "Content-Length": str(len(body))}
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            logging.getLogger().info(f"CloudFormation answered {resp.status}")
+    except Exception as e:
+        logging.getLogger().error(f"Unable to send the response to CloudFormation: {e}")
@@ -1,119 +1,273 @@
 # -*- coding: utf-8 -*-
+"""
+.. module: index
+    :Actions: Keep the Cognito app client secrets in Secrets Manager, one secret per user pool
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
 
+The resource's own app client(`User_pool_id`, `User_pool_client_id`) comes
+first, more can be listed under `App_clients`, in any number of user pools.
+Each pool gets a `cognito_{user_pool_id}` secret with the fields of its first
+app client, and all of its clients under `app_clients` when it has several.
+
+Create and Update describe the app clients in parallel, then write a secret
+only when its content changed, so an update that changes nothing costs no
+new secret versions. The physical id never changes after Create, and an
+Update drops the secrets of the pools no longer listed. Secrets the rotation
+function gave the app clients are kept, Cognito holds them along with the
+one the client was created with.
+"""
+
+import json
 import logging as log
 import os
-import json
-import boto3
+
 import cfnresponse
+from shared.aws_clients import client
+from shared.metrics import metrics
 log.getLogger().setLevel(log.INFO)
 
-_cog_client = boto3.client("cognito-idp")
-_sec_client = boto3.client("secretsmanager")
 
+class global_args:
+    """ Global statics """
+    # Cognito throttles DescribeUserPoolClient along with the other client reads
+    DESCRIBE_CONCURRENCY = int(os.getenv("DESCRIBE_CONCURRENCY", 5))
+    UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", 5))
+
+
+# Secret field -> resource property, every app client inherits these
+_SHARED_FIELDS = {
+    "user_pool_oauth2_endpoint": "User_pool_oauth2_endpoint",
+    "unicorn_user_pool_res_srv_identifier": "Unicorn_user_pool_res_srv_identifier",
+    "unicorn_read_scope": "Unicorn_read_scope",
+    "unicorn_write_scope": "Unicorn_write_scope",
+}
+
+
+def _app_clients(props):
+    """ The app clients of the resource properties, without duplicates, in order """
+    shared = {k: props.get(p) for k, p in _SHARED_FIELDS.items()}
+    clients = []
+    if props.get("User_pool_client_id"):
+        clients.append(dict(shared,
+                            user_pool_id=props.get("User_pool_id"),
+                            user_pool_client_id=props["User_pool_client_id"]))
+    for _c in props.get("App_clients") or []:
+        clients.append(dict(shared, **_c))
+
+    # A client listed twice keeps its first position and gains the fields of
+    # the later entries, like the name & scopes of the resource's own client
+    unique = {}
+    for _c in clients:
+        _k = (_c["user_pool_id"], _c["user_pool_client_id"])
+        if _k in unique:
+            unique[_k].update(_c)
+        else:
+            unique[_k] = _c
+    return list(unique.values())
 
+
+def _map(fn, items, max_workers):
+    """ `fn` over `items` on a thread pool, results in order, raises the first failure """
+    if len(items) <= 1:
+        return [fn(i) for i in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+@metrics.timed("DescribeUserPoolClientLatency")
 def get_app_client_secret(app_client_id, user_pool_id):
-    _sec = ""
-    try:
-        _pool_info = _cog_client.describe_user_pool_client(
-            UserPoolId=user_pool_id,
-            ClientId=app_client_id
-        )
-        _sec = _pool_info.get("UserPoolClient").get("ClientSecret")
-    except Exception as e:
-        log.error(f"{str(e)}")
-    return _sec
+    _pool_info = client("cognito-idp").describe_user_pool_client(
+        UserPoolId=user_pool_id,
+        ClientId=app_client_id
+    )
+    # Clients created without a secret have none to share
+    return _pool_info["UserPoolClient"].get("ClientSecret", "")
+
+
+# Fields every entry under `app_clients` keeps, the others only when they
+# differ from the pool document's. The client id is the key of the entry.
+_CLIENT_FIELDS = ("app_client_secret", "client_name", "scopes")
+_POOL_FIELDS = ("user_pool_id", "user_pool_client_id", "app_clients")
+
+# Largest secret value Secrets Manager stores
+_MAX_SECRET_BYTES = 65536
+
 
+def _client_entry(_c, doc):
+    return {k: v for k, v in _c.items()
+            if k in _CLIENT_FIELDS or (k not in _POOL_FIELDS and doc.get(k) != v)}
 
-def _put_secret(cfn_stack_name, res_id, s):
+
+def _secret_documents(clients):
+    """
+    `{user_pool_id: secret document}`, in the order the pools first appear.
+    With several clients in a pool, `app_clients` only keeps what differs per
+    client, so a 64KB secret holds a few hundred of them.
+    """
+    docs = {}
+    for _c in clients:
+        _d = docs.get(_c["user_pool_id"])
+        if _d is None:
+            docs[_c["user_pool_id"]] = dict(_c)
+            continue
+        if "app_clients" not in _d:
+            _d["app_clients"] = {
+                _d["user_pool_client_id"]: _client_entry(_d, _d)}
+        _d["app_clients"][_c["user_pool_client_id"]] = _client_entry(_c, _d)
+    return docs
+
+
+def _client_entries(doc):
+    """ `(client id, fields)` of a secret document, the top level holds the first client's """
+    yield doc.get("user_pool_client_id"), doc
+    for _id, _e in (doc.get("app_clients") or {}).items():
+        yield _id, _e
+
+
+def _keep_rotated_secrets(doc, current):
+    """ The secrets rotated into `current`, in place of the ones just described """
+    rotated = {_id: (_e["app_client_secret"], _e["app_client_secret_id"])
+               for _id, _e in _client_entries(current) if "app_client_secret_id" in _e}
+    for _id, _e in _client_entries(doc):
+        if _id in rotated:
+            _e["app_client_secret"], _e["app_client_secret_id"] = rotated[_id]
+
+
+def _secret_name(user_pool_id):
+    return f"cognito_{user_pool_id}"
+
+
+@metrics.timed("CreateSecretLatency")
+def _create_secret(cfn_stack_name, res_id, name, doc):
+    r = client("secretsmanager").create_secret(
+        Description="User Pool Secrets",
+        Name=name,
+        SecretString=json.dumps(doc),
+        Tags=[
+            {
+                "Key": "custom:cloudformation:stack-name",
+                "Value": cfn_stack_name
+            },
+            {
+                "Key": "custom:cloudformation:logical-id",
+                "Value": res_id
+            },
+            {
+                "Key": "custom:cloudformation:created-by",
+                "Value": f"Fn-{os.environ['AWS_LAMBDA_FUNCTION_NAME']}"
+            }
+        ]
+    )
+    return r["ARN"]
+
+
+@metrics.timed("UpsertSecretLatency")
+def _upsert_secret(cfn_stack_name, res_id, name, doc):
+    """ Create the secret, or add a version when its content changed. Returns `(arn, changed)` """
+    _size = len(json.dumps(doc).encode("utf-8"))
+    if _size > _MAX_SECRET_BYTES:
+        raise ValueError(
+            f"{name} would be {_size} bytes, more than a secret holds, spread the app clients over more user pools")
+    _sm = client("secretsmanager")
     try:
-        r = _sec_client.create_secret(
-            Description="User Pool Secrets",
-            Name=f"cognito_{s['user_pool_id']}",
-            SecretString=json.dumps(s),
-            Tags=[
-                {
-                    "Key": "custom:cloudformation:stack-name",
-                    "Value": cfn_stack_name
-                },
-                {
-                    "Key": "custom:cloudformation:logical-id",
-                    "Value": res_id
-                },
-                {
-                    "Key": "custom:cloudformation:created-by",
-                    "Value": f"Fn-{os.environ['AWS_LAMBDA_FUNCTION_NAME']}"
-                }
-            ]
-        )
-        return r["ARN"]
-    except Exception as e:
-        log.error(f"{str(e)}")
-        raise
+        _cur = _sm.get_secret_value(SecretId=name)
+    except _sm.exceptions.ResourceNotFoundException:
+        return _create_secret(cfn_stack_name, res_id, name, doc), True
+    _cur_doc = json.loads(_cur["SecretString"])
+    _keep_rotated_secrets(doc, _cur_doc)
+    # Compare the documents, not the strings, key order is not a change
+    if _cur_doc == doc:
+        return _cur["ARN"], False
+    _sm.put_secret_value(SecretId=name, SecretString=json.dumps(doc))
+    return _cur["ARN"], True
 
 
-def _delete_secret(s):
+def _delete_secret(name):
+    _sm = client("secretsmanager")
     try:
-        _sec_client.delete_secret(
-            SecretId=s,
+        _sm.delete_secret(
+            SecretId=name,
             ForceDeleteWithoutRecovery=True
         )
-    except Exception as e:
-        log.error(f"{str(e)}")
-        raise
+    except _sm.exceptions.ResourceNotFoundException:
+        # Never created, a failed Create is followed by a Delete too
+        log.info(f"{name} does not exist, nothing to delete")
+
+
+def _sync_secrets(event):
+    """ Describe the app clients and upsert the secrets of their pools, returns the attributes """
+    cfn_stack_name = event.get("StackId").split("/")[-2]
+    resource_id = event.get("LogicalResourceId")
+    clients = _app_clients(event["ResourceProperties"])
+    if not clients:
+        raise ValueError("No app clients given")
 
+    _secrets = _map(
+        lambda _c: get_app_client_secret(
+            _c["user_pool_client_id"], _c["user_pool_id"]),
+        clients,
+        global_args.DESCRIBE_CONCURRENCY
+    )
+    for _c, _s in zip(clients, _secrets):
+        _c["app_client_secret"] = _s
 
+    docs = _secret_documents(clients)
+    results = _map(
+        lambda _i: _upsert_secret(
+            cfn_stack_name, resource_id, _secret_name(_i[0]), _i[1]),
+        list(docs.items()),
+        global_args.UPSERT_CONCURRENCY
+    )
+    changed = sum(1 for _, _changed in results if _changed)
+    metrics.put("SecretsChanged", changed)
+    log.info(f"{len(clients)} app clients in {len(docs)} user pools, {changed} secrets changed")
+
+    if event["RequestType"] == "Update":
+        _old_pools = {_c["user_pool_id"] for _c in _app_clients(
+            event.get("OldResourceProperties") or {})}
+        for _pool in _old_pools - set(docs):
+            _delete_secret(_secret_name(_pool))
+
+    arns = [_arn for _arn, _ in results]
+    return {
+        "user_pool_secrets_arn": arns[0],
+        "user_pool_secrets_arns": ",".join(arns)
+    }
+
+
+@metrics.instrument
 def lambda_handler(event, context):
     log.info(f"event: {event}")
-    physical_id = 'TheOnlyCustomResource'
+    # Create picks the physical id, every later request hands the same one
+    # back, a new one would make CloudFormation delete the "old" resource
+    physical_id = event.get("PhysicalResourceId") or (
+        f"{event['StackId'].split('/')[-2]}-{event['LogicalResourceId']}")
 
     try:
-        # MINE
-        sec_arn = ""
-        cfn_stack_name = event.get("StackId").split("/")[-2]
-        resource_id = event.get("LogicalResourceId")
-        user_pool_id = event["ResourceProperties"].get("User_pool_id")
-        user_pool_client_id = event["ResourceProperties"].get(
-            "User_pool_client_id")
-
-        app_secrets = {
-            "app_client_secret": "",
-            "user_pool_id": user_pool_id,
-            "user_pool_client_id": user_pool_client_id,
-            "user_pool_oauth2_endpoint": event["ResourceProperties"].get(
-                "User_pool_oauth2_endpoint"),
-            "unicorn_user_pool_res_srv_identifier": event["ResourceProperties"].get(
-                "Unicorn_user_pool_res_srv_identifier"),
-            "unicorn_read_scope": event["ResourceProperties"].get(
-                "Unicorn_read_scope"),
-            "unicorn_write_scope": event["ResourceProperties"].get(
-                "Unicorn_write_scope")
-        }
         if event["RequestType"] == "Create" and event["ResourceProperties"].get(
             "FailCreate", False
         ):
             log.info(f"FailCreate")
             raise RuntimeError("Create failure requested")
-        if event["RequestType"] == "Create":
-            app_secrets["app_client_secret"] = get_app_client_secret(
-                user_pool_client_id, user_pool_id)
-            sec_arn = _put_secret(cfn_stack_name, resource_id, app_secrets)
-        elif event["RequestType"] == "Update":
-            app_secrets["app_client_secret"] = get_app_client_secret(
-                user_pool_client_id, user_pool_id)
-            sec_arn = _put_secret(cfn_stack_name, resource_id, app_secrets)
+        if event["RequestType"] in ("Create", "Update"):
+            attributes = _sync_secrets(event)
         elif event["RequestType"] == "Delete":
-            _delete_secret(f"cognito_{app_secrets['user_pool_id']}")
+            _pools = {_c["user_pool_id"]
+                      for _c in _app_clients(event["ResourceProperties"])}
+            _map(lambda _p: _delete_secret(_secret_name(_p)),
+                 sorted(_pools), global_args.UPSERT_CONCURRENCY)
+            attributes = {}
         else:
             log.error("FAILED!")
             return cfnresponse.send(event, context, cfnresponse.FAILED, {}, physical_id)
 
-        # MINE
-        attributes = {
-            "user_pool_secrets_arn": f"{sec_arn}"
-        }
-
         cfnresponse.send(event, context, cfnresponse.SUCCESS,
                          attributes, physical_id)
     except Exception as e:
+        metrics.incr("Errors")
         log.exception(e)
-        cfnresponse.send(event, context, cfnresponse.FAILED, {}, physical_id)
+        cfnresponse.send(event, context, cfnresponse.FAILED, {}, physical_id,
+                         reason=f"{type(e).__name__}: {e}")
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: shared
+    :Actions: Code shared by the lambda functions, deployed as a lambda layer
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: api_request
+    :Actions: Typed view of API Gateway proxy events and a method/route dispatch table
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    _router = Router()
+
+    @_router.route("GET", "/home/premium")
+    def get_premium(request):
+        ...
+
+    def lambda_handler(event, context):
+        return _router.dispatch(ApiRequest.from_event(event))
+
+The event is read once into an `ApiRequest`, the handlers use its fields
+instead of walking the nested event. Routes are a dict keyed by
+`(method, resource)`, so dispatching costs one lookup however many routes
+there are. Unknown resources get a `404`, known resources called with a
+method they do not have a `405` with the `Allow` header.
+"""
+
+import base64
+import json
+
+
+def error_response(status_code, message, headers=None):
+    """ Proxy response with a `{"message": ..}` body, like API Gateway's own errors """
+    _r = {"statusCode": status_code, "body": json.dumps({"message": message})}
+    if headers:
+        _r["headers"] = headers
+    return _r
+
+
+class ApiRequest:
+    """ The fields of a proxy event the handlers use """
+    __slots__ = ("http_method", "resource", "path", "query", "body",
+                 "is_base64_encoded", "authorizer", "api_key_id", "event", "_headers",
+                 "_lower_headers")
+
+    def __init__(self, http_method, resource, path=None, headers=None, query=None,
+                 body=None, is_base64_encoded=False, authorizer=None, api_key_id=None, event=None):
+        self.http_method = http_method
+        self.resource = resource
+        self.path = path or resource
+        self.query = query or {}
+        self.body = body
+        self.is_base64_encoded = is_base64_encoded
+        self.authorizer = authorizer or {}
+        # Id of the api key API Gateway metered the request on
+        self.api_key_id = api_key_id
+        # The event the request was read from, for logging
+        self.event = event
+        self._headers = headers or {}
+        # Header names are case insensitive, lower cased on first lookup only
+        self._lower_headers = None
+
+    @classmethod
+    def from_event(cls, event):
+        _rc = event.get("requestContext") or {}
+        return cls(
+            _rc.get("httpMethod") or event.get("httpMethod"),
+            _rc.get("resourcePath") or event.get("resource"),
+            path=event.get("path"),
+            headers=event.get("headers"),
+            query=event.get("queryStringParameters"),
+            body=event.get("body"),
+            is_base64_encoded=event.get("isBase64Encoded", False),
+            authorizer=_rc.get("authorizer"),
+            api_key_id=(_rc.get("identity") or {}).get("apiKeyId"),
+            event=event
+        )
+
+    def header(self, name):
+        """ Value of the header `name`(_lower case_), `None` when absent """
+        if self._lower_headers is None:
+            self._lower_headers = {
+                k.lower(): v for k, v in self._headers.items()}
+        return self._lower_headers.get(name)
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def claims(self):
+        """ Token claims, from the Cognito authorizer or the Lambda authorizer context """
+        return self.authorizer.get("claims") or self.authorizer
+
+    def text(self):
+        """ The body as sent, base64 decoded when API Gateway encoded it """
+        if self.body and self.is_base64_encoded:
+            return base64.b64decode(self.body)
+        return self.body
+
+    def replace(self, **fields):
+        """ Copy with some fields changed, for sub-requests """
+        _r = ApiRequest(
+            fields.get("http_method", self.http_method),
+            fields.get("resource", self.resource),
+            path=fields.get("path", fields.get("resource", self.path)),
+            headers=fields.get("headers", self._headers),
+            query=fields.get("query", self.query),
+            body=fields.get("body", self.body),
+            is_base64_encoded=fields.get(
+                "is_base64_encoded", self.is_base64_encoded),
+            authorizer=fields.get("authorizer", self.authorizer),
+            api_key_id=fields.get("api_key_id", self.api_key_id),
+            event=self.event
+        )
+        return _r
+
+
+class Router:
+    """ `(method, resource) -> handler` table, filled at import time """
+
+    def __init__(self):
+        self._handlers = {}
+        # resource -> its methods, for the `Allow` header of a 405
+        self._methods = {}
+
+    def add(self, http_method, resource, handler):
+        self._handlers[(http_method, resource)] = handler
+        self._methods.setdefault(resource, set()).add(http_method)
+        return handler
+
+    def route(self, http_method, resource):
+        """ Decorator registering a handler for the route """
+        return lambda handler: self.add(http_method, resource, handler)
+
+    def match(self, http_method, resource):
+        """ The handler of a route, `None` when there is none """
+        return self._handlers.get((http_method, resource))
+
+    def unmatched(self, http_method, resource):
+        """ `405` for a resource that has other methods, `404` otherwise """
+        allowed = self._methods.get(resource)
+        if allowed:
+            return error_response(
+                405, f"Method {http_method} not allowed on {resource}", {"Allow": ", ".join(sorted(allowed))})
+        return error_response(404, f"No such route: {http_method} {resource}")
+
+    def dispatch(self, request, *args):
+        """ Response of the handler of the request's route, called with `request, *args` """
+        handler = self._handlers.get((request.http_method, request.resource))
+        if handler is None:
+            return self.unmatched(request.http_method, request.resource)
+        return handler(request, *args)
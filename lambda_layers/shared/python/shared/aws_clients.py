@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: aws_clients
+    :Actions: Lazily built boto3 clients sharing a single botocore session
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+boto3 is only imported when the first client is requested, so functions that
+never talk to AWS, or only do so on some paths, do not pay for it at init.
+Clients built from the same session share the loaded service models and
+credentials.
+"""
+
+import os
+import threading
+
+
+class global_args:
+    """ Global statics """
+    AWS_CONNECT_TIMEOUT = float(os.getenv("AWS_CONNECT_TIMEOUT", 1))
+    AWS_READ_TIMEOUT = float(os.getenv("AWS_READ_TIMEOUT", 2))
+    AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", 2))
+
+
+_session = None
+_clients = {}
+_lock = threading.Lock()
+
+
+def session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import boto3.session
+                _session = boto3.session.Session()
+    return _session
+
+
+def client(service_name, region_name=None, read_timeout=None, max_attempts=None):
+    """
+    Client for `service_name`, built on first use and reused afterwards. Calls
+    on the request path may ask for a tighter `read_timeout` & `max_attempts`,
+    they get a client of their own.
+    """
+    key = (service_name, region_name, read_timeout, max_attempts)
+    _c = _clients.get(key)
+    if _c is None:
+        _s = session()
+        from botocore.config import Config
+        with _lock:
+            _c = _clients.get(key)
+            if _c is None:
+                _c = _s.client(
+                    service_name,
+                    region_name=region_name,
+                    config=Config(
+                        connect_timeout=global_args.AWS_CONNECT_TIMEOUT,
+                        read_timeout=global_args.AWS_READ_TIMEOUT if read_timeout is None else read_timeout,
+                        retries={"max_attempts": global_args.AWS_MAX_ATTEMPTS if max_attempts is None else max_attempts}
+                    )
+                )
+                _clients[key] = _c
+    return _c
+
+
+def reset():
+    """ Drop the session and every client, the next call rebuilds them """
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: compression
+    :Actions: Accept-Encoding negotiation and gzip/brotli encoding of lambda proxy responses
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    response = encode_response(response, _header(event, "accept-encoding"))
+
+Bodies below `COMPRESSION_MIN_BYTES` are sent as they are, compressing them
+costs more CPU than the bytes it saves. Brotli is used when the `brotli`
+package is on the path(_it is not part of the lambda runtime_) and the
+client prefers it, gzip otherwise. Encoded bodies are returned base64 with
+`isBase64Encoded`, so the API needs binary media types for API Gateway to
+decode them.
+"""
+
+import base64
+import os
+import zlib
+
+
+class global_args:
+    """ Global statics """
+    # About one TCP segment, smaller bodies go out in one packet either way
+    COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", 1400))
+    GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+    BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 5))
+
+
+_brotli = None
+
+
+def _brotli_module():
+    """ The `brotli` package, or `False` when it is not installed """
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = False
+    return _brotli
+
+
+def supported_encodings():
+    """ Codings this container can produce and read, most preferred first """
+    return ("br", "gzip") if _brotli_module() else ("gzip",)
+
+
+def negotiate(accept_encoding, supported=None):
+    """
+    Best coding of `supported` acceptable to an `Accept-Encoding` header, `None`
+    for identity. Honours q-values, `q=0` rules a coding out, `*` matches any.
+    """
+    if not accept_encoding:
+        return None
+    supported = supported or supported_encodings()
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip()] = q
+    best, best_q = None, 0.0
+    for coding in supported:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(body, coding):
+    if coding == "gzip":
+        # zlib writes the gzip header with a zero mtime, so the same body
+        # always encodes to the same bytes
+        _z = zlib.compressobj(global_args.GZIP_LEVEL,
+                              zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return _z.compress(body) + _z.flush()
+    if coding == "br":
+        return _brotli_module().compress(body, quality=global_args.BROTLI_QUALITY)
+    raise ValueError(f"Unsupported content coding: {coding}")
+
+
+def decompress(body, coding):
+    if not coding or coding == "identity":
+        return body
+    if coding == "gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if coding == "br":
+        return _brotli_module().decompress(body)
+    raise ValueError(f"Unsupported content coding: {coding}")
+
+
+def coding_etag(etag, coding):
+    """ Strong ETags differ per content coding, `"abc"` -> `"abc-gzip"` """
+    if not etag or not coding:
+        return etag
+    return f'{etag[:-1]}-{coding}"'
+
+
+def encoded_body(body, coding):
+    """ base64 of the `coding` encoded `body`, as API Gateway wants binary bodies """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return base64.b64encode(compress(body, coding)).decode("ascii")
+
+
+def encode_response(response, accept_encoding, min_size=None, encoded=None):
+    """
+    Compress the body of a lambda proxy `response` in place when the client
+    accepts it and the body is large enough. Always adds `Vary: Accept-Encoding`.
+    `encoded` is an optional coding -> encoded body dict, to reuse the
+    compressed bodies of cached responses.
+    """
+    headers = response.setdefault("headers", {})
+    headers["Vary"] = "Accept-Encoding"
+    body = response.get("body")
+    if min_size is None:
+        min_size = global_args.COMPRESSION_MIN_BYTES
+    if not body or response.get("isBase64Encoded") or "Content-Encoding" in headers:
+        return response
+    if len(body) < min_size:
+        return response
+    coding = negotiate(accept_encoding)
+    if coding is None:
+        return response
+    if encoded is None:
+        response["body"] = encoded_body(body, coding)
+    else:
+        if coding not in encoded:
+            encoded[coding] = encoded_body(body, coding)
+        response["body"] = encoded[coding]
+    response["isBase64Encoded"] = True
+    headers["Content-Encoding"] = coding
+    if "ETag" in headers:
+        headers["ETag"] = coding_etag(headers["ETag"], coding)
+    return response
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: http_client
+    :Actions: Pooled keep-alive HTTP client shared across warm lambda invocations
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+import base64
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger()
+
+
+class global_args:
+    """ Global statics """
+    HTTP_NUM_POOLS = int(os.getenv("HTTP_NUM_POOLS", 4))
+    HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 10))
+    # Keep connect + read well inside the 3 second function timeout
+    HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 0.5))
+    HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 2.0))
+    HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+
+def _enable_http2():
+    """ HTTP/2 needs urllib3>=2.3 with the `h2` package, fall back to HTTP/1.1 otherwise """
+    try:
+        import urllib3.http2
+        urllib3.http2.inject_into_urllib3()
+        return True
+    except Exception as e:
+        logger.warning("HTTP/2 unavailable, using HTTP/1.1: %s", e)
+        return False
+
+
+def _new_pool():
+    import urllib3
+    if global_args.HTTP2_ENABLED:
+        _enable_http2()
+    return urllib3.PoolManager(
+        num_pools=global_args.HTTP_NUM_POOLS,
+        maxsize=global_args.HTTP_POOL_MAXSIZE,
+        block=False,
+        timeout=urllib3.Timeout(
+            connect=global_args.HTTP_CONNECT_TIMEOUT,
+            read=global_args.HTTP_READ_TIMEOUT
+        ),
+        retries=False
+    )
+
+
+# Connections stay open in the pool between warm invocations, so the TLS
+# handshake with Cognito and the premium API is paid once per container.
+# The pool, and urllib3 itself, are only loaded on the first request.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _new_pool()
+    return _pool
+
+
+def basic_auth(username, password):
+    _creds = base64.b64encode(f"{username}:{password}".encode("utf-8"))
+    return f"Basic {_creds.decode('ascii')}"
+
+
+def request(method, url, headers=None, body=None, fields=None, timeout=None, preload_content=True):
+    """
+    Issue a request over the shared pool.
+
+    `fields` are sent form url-encoded, `body` is sent as is. `timeout` is an
+    optional total budget in seconds, capped by the configured timeouts. With
+    `preload_content=False` the body is left on the connection, to be read
+    with `resp.read()` or `resp.stream()` and handed back with `resp.release_conn()`.
+    """
+    _p = pool()
+    kwargs = {"headers": headers, "preload_content": preload_content}
+    if timeout is not None:
+        import urllib3
+        kwargs["timeout"] = urllib3.Timeout(
+            connect=min(global_args.HTTP_CONNECT_TIMEOUT, timeout),
+            read=min(global_args.HTTP_READ_TIMEOUT, timeout)
+        )
+    if fields is not None:
+        return _p.request(
+            method, url, fields=fields, encode_multipart=False, **kwargs)
+    return _p.request(method, url, body=body, **kwargs)
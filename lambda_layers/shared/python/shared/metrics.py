@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: metrics
+    :Actions: Latency timers and counters emitted as CloudWatch Embedded Metric Format
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    from shared.metrics import metrics
+
+    @metrics.instrument
+    def lambda_handler(event, context):
+        with metrics.timer("PremiumApiLatency"):
+            ...
+        metrics.put("TokenCacheHit", 1)
+
+Metrics are buffered during an invocation and written as a single EMF
+document to stdout when the handler returns, CloudWatch turns it into
+metrics without any API call. `METRICS_SAMPLE_RATE` decides per invocation
+whether anything is recorded, unsampled invocations only pay for an
+attribute check per timer.
+"""
+
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+
+class global_args:
+    """ Global statics """
+    METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ServerlessApiAuthorizer")
+    METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", 1.0))
+    SERVICE_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+
+class _NoopTimer:
+    """ Returned by `timer` when the invocation is not sampled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.put(
+            self.name, (time.perf_counter() - self.started) * 1000, "Milliseconds")
+        return False
+
+
+class Metrics:
+    """ Per invocation buffer of metric values, flushed as one EMF record """
+
+    def __init__(self, namespace, dimensions=None, sample_rate=1.0, stream=None):
+        self.namespace = namespace
+        self.dimensions = dict(dimensions or {})
+        self.sample_rate = sample_rate
+        self.stream = stream or sys.stdout
+        self.active = sample_rate >= 1.0
+        self._values = {}
+        self._units = {}
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """ Start an invocation, decides whether it is sampled """
+        self.active = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def put(self, name, value, unit="Count"):
+        if not self.active or value is None:
+            return
+        with self._lock:
+            self._values.setdefault(name, []).append(value)
+            self._units[name] = unit
+
+    def incr(self, name, n=1):
+        self.put(name, n, "Count")
+
+    def timer(self, name):
+        """ Context manager recording the elapsed milliseconds as `name` """
+        if not self.active:
+            return _NOOP_TIMER
+        return _Timer(self, name)
+
+    def timed(self, name):
+        """ Decorator flavour of `timer` """
+        def _decorator(fn):
+            @functools.wraps(fn)
+            def _wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+            return _wrapper
+        return _decorator
+
+    def instrument(self, handler):
+        """ Wrap a lambda handler: sample, count errors and flush on the way out """
+        @functools.wraps(handler)
+        def _wrapper(event, context):
+            self.begin()
+            try:
+                return handler(event, context)
+            except Exception:
+                self.incr("Errors")
+                raise
+            finally:
+                self.flush()
+        return _wrapper
+
+    def flush(self):
+        with self._lock:
+            values, units = self._values, self._units
+            self._values, self._units = {}, {}
+        if not values:
+            return
+        doc = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(self.dimensions)],
+                    "Metrics": [{"Name": n, "Unit": units[n]} for n in values]
+                }]
+            }
+        }
+        doc.update(self.dimensions)
+        for n, v in values.items():
+            doc[n] = v[0] if len(v) == 1 else v
+        self.stream.write(json.dumps(doc, separators=(",", ":")) + "\n")
+        self.stream.flush()
+
+
+metrics = Metrics(
+    global_args.METRICS_NAMESPACE,
+    dimensions={"service": global_args.SERVICE_NAME},
+    sample_rate=global_args.METRICS_SAMPLE_RATE
+)
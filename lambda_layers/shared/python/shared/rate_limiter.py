@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: rate_limiter
+    :Actions: Per client & route request rate limits, shared by the containers of a function
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    _limiter = RateLimiter(
+        {"POST /home/premium": {"rate_limit": 2, "burst_limit": 5}},
+        store=bucket_store_from_uri("dynamodb:rate-limits"))
+    retry_after = _limiter.check(client_id, "POST", "/home/premium")
+
+A token bucket of `burst_limit` tokens refilled at `rate_limit` a second,
+kept as a single "theoretical arrival time"(_GCRA_). Taking tokens is one
+conditional write, there is no read-modify-write to race on, so the limit
+holds however many containers take from the same bucket.
+
+To keep the store off the hot path, a container takes up to a second of the
+refill at once and hands it out locally, and remembers a denial until the
+bucket refills, a client over its limit is turned away without any I/O.
+"""
+
+import abc
+import logging
+import os
+import threading
+import time
+
+from shared import aws_clients
+
+
+class global_args:
+    """ Global statics """
+    # How long a container keeps the tokens it took ahead
+    RATE_LIMIT_LEASE_SECONDS = float(
+        os.getenv("RATE_LIMIT_LEASE_SECONDS", 1.0))
+    RATE_LIMIT_MAX_LEASE = int(os.getenv("RATE_LIMIT_MAX_LEASE", 10))
+
+
+logger = logging.getLogger()
+
+
+def _error_code(e):
+    """ Error code of a botocore `ClientError`, without importing botocore """
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+
+def _number(v):
+    """ DynamoDB number, never in exponent notation """
+    return str(v) if isinstance(v, int) else "%.6f" % v
+
+
+class BucketStore(abc.ABC):
+    """ Where the buckets are kept """
+
+    @abc.abstractmethod
+    def take(self, key, cost, interval, tolerance, now):
+        """
+        Take `cost` tokens from the bucket `key`. Returns 0 when they were
+        taken, otherwise the seconds until the bucket holds them.
+        """
+
+
+class InMemoryBucketStore(BucketStore):
+    """ Buckets of this container only """
+
+    def __init__(self):
+        self._tats = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, interval, tolerance, now):
+        with self._lock:
+            _tat = max(self._tats.get(key, now), now) + cost * interval
+            wait = _tat - now - tolerance
+            if wait > 0:
+                return wait
+            self._tats[key] = _tat
+            return 0
+
+
+class SqliteBucketStore(BucketStore):
+    """ Buckets shared by the processes on one host, for local runs """
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self._conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tat REAL)")
+
+    def take(self, key, cost, interval, tolerance, now):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                _r = self._conn.execute(
+                    "SELECT tat FROM buckets WHERE key = ?", (key,)).fetchone()
+                _tat = max(_r[0] if _r else now, now) + cost * interval
+                wait = _tat - now - tolerance
+                if wait <= 0:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO buckets VALUES (?, ?)", (key, _tat))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return max(wait, 0)
+
+
+class DynamoDBBucketStore(BucketStore):
+    """
+    Buckets as items of one table, partition key `pk`. A full bucket is
+    taken from with `tat = now + cost`, a partly drained one with
+    `tat = tat + cost`, each conditional on the bucket being in that state
+    with room left. Which to try first comes from the last write of this
+    container, so a busy bucket usually costs one write. The `ttl` attribute
+    lets DynamoDB delete the buckets that refilled.
+    """
+
+    _MAX_ATTEMPTS = 3
+
+    def __init__(self, table_name, client_factory=None):
+        self.table_name = table_name
+        self._client_factory = client_factory or (
+            lambda: aws_clients.client("dynamodb"))
+        # Bucket -> when it is expected to be full again
+        self._busy_until = {}
+
+    @property
+    def client(self):
+        return self._client_factory()
+
+    def _update(self, key, expression, condition, values):
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={"pk": {"S": f"bucket#{key}"}},
+                UpdateExpression=expression,
+                ConditionExpression=condition,
+                ExpressionAttributeNames={"#ttl": "ttl"},
+                ExpressionAttributeValues={
+                    k: {"N": _number(v)} for k, v in values.items()}
+            )
+        except Exception as e:
+            if _error_code(e) == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def _tat(self, key):
+        _i = self.client.get_item(
+            TableName=self.table_name,
+            Key={"pk": {"S": f"bucket#{key}"}},
+            ConsistentRead=True,
+            ProjectionExpression="tat"
+        ).get("Item")
+        return float(_i["tat"]["N"]) if _i and "tat" in _i else None
+
+    def take(self, key, cost, interval, tolerance, now):
+        inc = cost * interval
+        if inc > tolerance:
+            return inc - tolerance
+        # The bucket is refilled by the time a drained one would be
+        _ttl = int(now + tolerance) + 60
+        busy = self._busy_until.get(key, 0) > now
+        for _ in range(self._MAX_ATTEMPTS):
+            if not busy and self._update(
+                    key,
+                    "SET tat = :new, #ttl = :ttl",
+                    "attribute_not_exists(tat) OR tat < :now",
+                    {":new": now + inc, ":now": now, ":ttl": _ttl}):
+                self._busy_until[key] = now + inc
+                return 0
+            if self._update(
+                    key,
+                    "SET tat = tat + :inc, #ttl = :ttl",
+                    "tat BETWEEN :now AND :limit",
+                    {":inc": inc, ":now": now, ":limit": now + tolerance - inc, ":ttl": _ttl}):
+                self._busy_until[key] = now + inc
+                return 0
+            # Either out of tokens, or refilled in between by the clock
+            _tat = self._tat(key)
+            if _tat is not None and _tat >= now:
+                self._busy_until[key] = _tat
+                wait = _tat + inc - now - tolerance
+                if wait > 0:
+                    return wait
+            busy = False
+        # Lost every race for the bucket, so it is hardly short of takers
+        return inc
+
+
+class RateLimit:
+    """ Token bucket settings of one route """
+    __slots__ = ("route", "rate_limit", "burst_limit",
+                 "interval", "tolerance", "lease")
+
+    def __init__(self, route, rate_limit, burst_limit, lease_seconds, max_lease):
+        if rate_limit <= 0 or burst_limit < 1:
+            raise ValueError(
+                f"{route}: rate_limit must be positive and burst_limit at least 1")
+        self.route = route
+        self.rate_limit = float(rate_limit)
+        self.burst_limit = int(burst_limit)
+        self.interval = 1 / self.rate_limit
+        self.tolerance = self.burst_limit * self.interval
+        # Never more than the bucket refills while the lease lasts, idle
+        # leased tokens are tokens the other containers can not have
+        self.lease = max(1, min(max_lease, self.burst_limit,
+                                int(self.rate_limit * lease_seconds)))
+
+
+class RateLimiter:
+    """
+    Limits of `{"METHOD /path": {"rate_limit": .., "burst_limit": ..}}`, for
+    each client on its own. `"*"` is the limit of the routes not listed.
+    """
+
+    def __init__(self, limits, store=None, lease_seconds=None, max_lease=None):
+        self.lease_seconds = global_args.RATE_LIMIT_LEASE_SECONDS if lease_seconds is None else lease_seconds
+        max_lease = global_args.RATE_LIMIT_MAX_LEASE if max_lease is None else max_lease
+        self.limits = {
+            route: RateLimit(route, _l["rate_limit"], _l["burst_limit"],
+                             self.lease_seconds, max_lease)
+            for route, _l in (limits or {}).items()
+        }
+        self.store = store or InMemoryBucketStore()
+        # Bucket -> [tokens left, valid until]
+        self._leases = {}
+        # Bucket -> denied until
+        self._denied = {}
+        self._lock = threading.Lock()
+
+    def limit_for(self, http_method, resource):
+        return self.limits.get(f"{http_method} {resource}") or self.limits.get("*")
+
+    def check(self, client_id, http_method, resource):
+        """ 0 when the request may go ahead, the seconds until it may otherwise """
+        if not self.limits or not client_id:
+            return 0
+        _l = self.limit_for(http_method, resource)
+        if _l is None:
+            return 0
+        key = f"{client_id}:{_l.route}"
+        now = time.time()
+        with self._lock:
+            _d = self._denied.get(key)
+            if _d is not None and _d > now:
+                return _d - now
+            _lease = self._leases.get(key)
+            if _lease is not None and _lease[0] > 0 and _lease[1] > now:
+                _lease[0] -= 1
+                return 0
+
+        n = _l.lease
+        try:
+            wait = self.store.take(key, n, _l.interval, _l.tolerance, now)
+            if wait and n > 1:
+                # No room for a lease, maybe for this one request
+                n = 1
+                wait = self.store.take(key, n, _l.interval, _l.tolerance, now)
+        except Exception as e:
+            # The limits protect the api, an outage of their store must not
+            # take it down, fail open
+            logger.warning("Rate limit store unavailable: %s", e)
+            return 0
+
+        with self._lock:
+            if wait:
+                self._denied[key] = now + wait
+                return wait
+            self._leases[key] = [n - 1, now + self.lease_seconds]
+        return 0
+
+
+def bucket_store_from_uri(uri):
+    """ `memory`(_or empty_), `sqlite:/path/to.db` or `dynamodb:table-name` """
+    if not uri or uri == "memory":
+        return InMemoryBucketStore()
+    scheme, _, target = uri.partition(":")
+    if scheme == "sqlite":
+        return SqliteBucketStore(target)
+    if scheme == "dynamodb":
+        return DynamoDBBucketStore(target)
+    raise ValueError(f"Unsupported rate limit store: {uri}")
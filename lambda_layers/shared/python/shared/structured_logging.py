@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: structured_logging
+    :Actions: Sampled, redacted JSON logging on top of the standard logging module
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    logger = set_logging("INFO", sample_rates="DEBUG=0.01,INFO=0.1")
+    logger.info("received_event", extra=log_fields(event=lambda: event_summary(event)))
+
+- Records below the logger level are dropped by `logging` before any
+  formatting happens, keep messages as `%s` templates with arguments instead
+  of f-strings so that holds.
+- Field values may be callables, they are only called when the record is
+  actually written.
+- `LOG_SAMPLE_RATES` keeps only a fraction of the records of a level.
+- Keys that look like credentials are redacted at any depth, and API Gateway
+  events are reduced to an allow-list of fields by `event_summary`.
+"""
+
+import json
+import logging
+import random
+import sys
+
+
+REDACTED = "***REDACTED***"
+
+SENSITIVE_KEYS = frozenset({
+    "authorization",
+    "x-api-key",
+    "cookie",
+    "set-cookie",
+    "access_token",
+    "id_token",
+    "refresh_token",
+    "token",
+    "authorizationtoken",
+    "client_secret",
+    "app_client_secret",
+    "secretstring",
+    "password",
+})
+
+# Fields of an API Gateway proxy event that are worth logging
+EVENT_FIELDS = ("httpMethod", "resource", "path")
+EVENT_REQUEST_CONTEXT_FIELDS = ("requestId", "resourcePath", "httpMethod", "stage")
+
+
+def redact(value):
+    """ Copy of `value` with every sensitive key masked, at any depth """
+    if isinstance(value, dict):
+        return {
+            k: REDACTED if str(k).lower() in SENSITIVE_KEYS else redact(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+def event_summary(event, fields=EVENT_FIELDS, request_context_fields=EVENT_REQUEST_CONTEXT_FIELDS):
+    """ Allow-listed fields of an API Gateway event, instead of the multi-KB event """
+    _s = {k: event[k] for k in fields if k in event}
+    _rc = event.get("requestContext") or {}
+    for k in request_context_fields:
+        if k in _rc:
+            _s[f"requestContext.{k}"] = _rc[k]
+    return _s
+
+
+def log_fields(**fields):
+    """ `extra` argument carrying structured fields for a log call """
+    return {"fields": fields}
+
+
+def parse_sample_rates(spec):
+    """ "DEBUG=0.01,INFO=0.1" -> {10: 0.01, 20: 0.1} """
+    rates = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        level, rate = item.split("=", 1)
+        rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """ Keep `rate` of the records of each level, levels not listed are all kept """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON document per record, structured fields redacted """
+
+    def format(self, record):
+        _d = {
+            "timestamp": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            for k, v in fields.items():
+                if callable(v):
+                    v = v()
+                _d[k] = REDACTED if k.lower() in SENSITIVE_KEYS else redact(v)
+        if record.exc_info:
+            _d["exception"] = self.formatException(record.exc_info)
+        return json.dumps(_d, default=str, separators=(",", ":"))
+
+
+def set_logging(lv="INFO", sample_rates=None):
+    """ Helper to enable structured logging on the root logger """
+    logger = logging.getLogger()
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler(sys.stdout))
+    rates = parse_sample_rates(sample_rates) if isinstance(
+        sample_rates, str) else (sample_rates or {})
+    for h in logger.handlers:
+        h.setFormatter(JsonFormatter())
+        for f in [f for f in h.filters if isinstance(f, SamplingFilter)]:
+            h.removeFilter(f)
+        if rates:
+            h.addFilter(SamplingFilter(rates))
+    logger.setLevel(lv)
+    return logger
@@ -0,0 +1,189 @@
+from aws_cdk import aws_applicationautoscaling as _appscaling
+from aws_cdk import aws_lambda as _lambda
+from aws_cdk import core
+
+
+class PerformanceProfile:
+    """
+    Memory, architecture, concurrency and API throttling settings of a deployment.
+
+    Profiles are declared under `performance_profiles` in the `cdk.json` context
+    and selected with the `performance_profile` context value, for example
+    `cdk deploy -c performance_profile=standard`.
+
+    The API stage throttling is checked against what the function concurrency
+    can actually serve: `reserved_concurrency` executions, each busy for
+    `expected_latency_ms`, handle at most `reserved_concurrency * 1000 /
+    expected_latency_ms` requests per second. A burst arrives at once, so
+    `throttling_burst_limit` may not be more than `reserved_concurrency`, the
+    requests past it would be throttled by Lambda instead of API Gateway.
+    When the throttling limits are left out they are derived from that
+    capacity.
+
+    `runtime` is a runtime name, `python3.8` etc. Runtimes newer than the
+    CDK release knows of are accepted too, arm64 needs `python3.8` or newer.
+    """
+
+    ARCHITECTURES = ("x86_64", "arm64")
+
+    def __init__(
+        self,
+        name,
+        memory_size=128,
+        architecture="x86_64",
+        reserved_concurrency=None,
+        provisioned_concurrency=0,
+        max_provisioned_concurrency=None,
+        target_utilization=0.7,
+        expected_latency_ms=100,
+        throttling_rate_limit=None,
+        throttling_burst_limit=None,
+        runtime="python3.7"
+    ):
+        self.name = name
+        self.memory_size = int(memory_size)
+        self.architecture = architecture
+        self.reserved_concurrency = reserved_concurrency
+        self.provisioned_concurrency = int(provisioned_concurrency)
+        self.max_provisioned_concurrency = int(
+            max_provisioned_concurrency or self.provisioned_concurrency)
+        self.target_utilization = float(target_utilization)
+        self.expected_latency_ms = float(expected_latency_ms)
+        self.runtime = self.lambda_runtime(runtime)
+
+        if throttling_rate_limit is None:
+            throttling_rate_limit = self.max_rps if self.max_rps is not None else 10
+        self.throttling_rate_limit = float(throttling_rate_limit)
+        if throttling_burst_limit is None:
+            throttling_burst_limit = self.reserved_concurrency or max(
+                int(self.throttling_rate_limit), 1)
+        self.throttling_burst_limit = int(throttling_burst_limit)
+
+        self.validate()
+
+    @staticmethod
+    def lambda_runtime(runtime):
+        """ `_lambda.Runtime` of a runtime name, passed through when it is one already """
+        if isinstance(runtime, _lambda.Runtime):
+            return runtime
+        if not str(runtime).startswith("python3."):
+            raise ValueError(f"Unsupported runtime {runtime}, use python3.x")
+        for _r in _lambda.Runtime.ALL:
+            if _r.name == runtime:
+                return _r
+        return _lambda.Runtime(runtime, _lambda.RuntimeFamily.PYTHON, supports_inline_code=True)
+
+    @staticmethod
+    def runtime_python_version(runtime):
+        """ `(3, 8)` for `python3.8` """
+        return tuple(int(_v) for _v in runtime.name[len("python"):].split("."))
+
+    @property
+    def python_version(self):
+        return self.runtime_python_version(self.runtime)
+
+    @property
+    def max_rps(self):
+        """ Requests per second the reserved concurrency can serve, `None` when unreserved """
+        if self.reserved_concurrency is None:
+            return None
+        return self.reserved_concurrency * 1000 / self.expected_latency_ms
+
+    def validate(self):
+        if self.architecture not in self.ARCHITECTURES:
+            raise ValueError(
+                f"{self.name}: architecture must be one of {self.ARCHITECTURES}")
+        if self.architecture == "arm64" and self.python_version < (3, 8):
+            raise ValueError(
+                f"{self.name}: arm64 needs python3.8 or newer, not {self.runtime.name}")
+        if not 128 <= self.memory_size <= 10240:
+            raise ValueError(
+                f"{self.name}: memory_size must be between 128 and 10240 MB")
+        if self.max_provisioned_concurrency < self.provisioned_concurrency:
+            raise ValueError(
+                f"{self.name}: max_provisioned_concurrency is below provisioned_concurrency")
+        if self.reserved_concurrency is not None:
+            if self.max_provisioned_concurrency > self.reserved_concurrency:
+                raise ValueError(
+                    f"{self.name}: provisioned concurrency can not exceed reserved_concurrency")
+            if self.throttling_rate_limit > self.max_rps:
+                raise ValueError(
+                    f"{self.name}: throttling_rate_limit {self.throttling_rate_limit:.0f} rps is more than "
+                    f"{self.reserved_concurrency} executions at {self.expected_latency_ms:.0f} ms can serve "
+                    f"({self.max_rps:.0f} rps)")
+            if self.throttling_burst_limit > self.reserved_concurrency:
+                raise ValueError(
+                    f"{self.name}: throttling_burst_limit {self.throttling_burst_limit} is more than "
+                    f"the {self.reserved_concurrency} reserved executions can serve at once")
+        if not 0.1 <= self.target_utilization <= 0.9:
+            raise ValueError(
+                f"{self.name}: target_utilization must be between 0.1 and 0.9")
+
+    @classmethod
+    def from_context(cls, node):
+        """ The profile selected by the `performance_profile` context value """
+        name = node.try_get_context("performance_profile") or "starter"
+        profiles = node.try_get_context("performance_profiles") or {}
+        if name not in profiles:
+            raise ValueError(
+                f"Unknown performance profile {name}, choose from {sorted(profiles)}")
+        return cls(name, **profiles[name])
+
+    def function_props(self):
+        """ Keyword arguments for `_lambda.Function` """
+        return {
+            "runtime": self.runtime,
+            "memory_size": self.memory_size,
+            "reserved_concurrent_executions": self.reserved_concurrency,
+        }
+
+    def stage_throttling(self):
+        """ Keyword arguments for `_apigw.StageOptions` """
+        return {
+            "throttling_rate_limit": self.throttling_rate_limit,
+            "throttling_burst_limit": self.throttling_burst_limit,
+        }
+
+    def set_architecture(self, fn):
+        """ CDK 1.x has no `architecture` prop, set it on the underlying `CfnFunction` """
+        if self.architecture != "x86_64":
+            fn.node.default_child.add_property_override(
+                "Architectures", [self.architecture])
+
+    def apply(self, scope, fn, alias_name="live"):
+        """
+        Set the architecture of `fn` and, with provisioned concurrency, publish
+        an alias that keeps it warm and scales on utilization. Returns what the
+        API should invoke: the alias when there is one, else the function.
+        """
+        self.set_architecture(fn)
+
+        if not self.provisioned_concurrency:
+            return fn
+
+        alias = _lambda.Alias(
+            scope,
+            f"{fn.node.id}LiveAlias",
+            alias_name=alias_name,
+            version=fn.current_version,
+            provisioned_concurrent_executions=self.provisioned_concurrency
+        )
+        if self.max_provisioned_concurrency > self.provisioned_concurrency:
+            target = _appscaling.ScalableTarget(
+                scope,
+                f"{fn.node.id}ProvisionedConcurrencyTarget",
+                service_namespace=_appscaling.ServiceNamespace.LAMBDA,
+                resource_id=f"function:{fn.function_name}:{alias_name}",
+                scalable_dimension="lambda:function:ProvisionedConcurrency",
+                min_capacity=self.provisioned_concurrency,
+                max_capacity=self.max_provisioned_concurrency
+            )
+            target.node.add_dependency(alias)
+            target.scale_to_track_metric(
+                "provisionedConcurrencyUtilization",
+                target_value=self.target_utilization,
+                predefined_metric=_appscaling.PredefinedMetric.LAMBDA_PROVISIONED_CONCURRENCY_UTILIZATION,
+                scale_in_cooldown=core.Duration.minutes(3),
+                scale_out_cooldown=core.Duration.seconds(30)
+            )
+        return alias
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: api_authorizer
+    :Actions: Authorize premium api requests by verifying Cognito access tokens locally
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+import hashlib
+import os
+import time
+
+from decision_cache import Decision, DecisionCache
+from jwt_verifier import JwksCache, JwtVerificationError, JwtVerifier
+from revocation import revocation_list_from_uri
+from route_policy import CompiledRoutePolicy
+from shared.structured_logging import log_fields, set_logging
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class global_args:
+    """ Global statics """
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "api_authorizer"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+    USER_POOL_ID = os.getenv("USER_POOL_ID")
+    USER_POOL_REGION = os.getenv("USER_POOL_REGION", os.getenv("AWS_REGION"))
+    ALLOWED_CLIENT_IDS = [
+        c for c in os.getenv("ALLOWED_CLIENT_IDS", "").split(",") if c]
+    ROUTE_POLICY = os.getenv("ROUTE_POLICY", "{}")
+    REVOCATION_STORE = os.getenv("REVOCATION_STORE", "")
+    REVOCATION_REFRESH_SECONDS = float(
+        os.getenv("REVOCATION_REFRESH_SECONDS", 10))
+    # "aggregated", one policy over every route the token's scopes allow,
+    # or "method", a policy for the method called only
+    AUTHORIZER_POLICY = os.getenv("AUTHORIZER_POLICY", "aggregated")
+    DECISION_CACHE_MAX_ENTRIES = int(
+        os.getenv("DECISION_CACHE_MAX_ENTRIES", 1024))
+    ISSUER = f"https://cognito-idp.{USER_POOL_REGION}.amazonaws.com/{USER_POOL_ID}"
+
+
+# Initial some defaults in global context to reduce lambda start time, when re-using container
+logger = set_logging(global_args.LOG_LEVEL, global_args.LOG_SAMPLE_RATES)
+
+if not global_args.ALLOWED_CLIENT_IDS:
+    # Fail closed, any app client of the pool would pass otherwise
+    logger.warning("ALLOWED_CLIENT_IDS is empty, every token is rejected")
+
+_verifier = JwtVerifier(
+    global_args.ISSUER,
+    JwksCache(f"{global_args.ISSUER}/.well-known/jwks.json"),
+    client_ids=global_args.ALLOWED_CLIENT_IDS
+)
+
+_route_policy = CompiledRoutePolicy.from_json(global_args.ROUTE_POLICY)
+
+_decisions = DecisionCache(
+    max_entries=global_args.DECISION_CACHE_MAX_ENTRIES)
+
+_revocations = revocation_list_from_uri(
+    global_args.REVOCATION_STORE,
+    refresh_interval=global_args.REVOCATION_REFRESH_SECONDS
+)
+
+
+def _parse_method_arn(method_arn):
+    """ arn:aws:execute-api:{region}:{account}:{api_id}/{stage}/{method}/{resource} """
+    _arn_prefix, _api_path = method_arn.rsplit(":", 1)
+    api_id, stage, http_method, resource = _api_path.split("/", 3)
+    return f"{_arn_prefix}:{api_id}/{stage}", http_method, f"/{resource}"
+
+
+def _policy(principal_id, effect, resources, context=None, usage_identifier_key=None):
+    _p = {
+        "principalId": principal_id,
+        "policyDocument": {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Action": "execute-api:Invoke",
+                    "Effect": effect,
+                    "Resource": resources
+                }
+            ]
+        }
+    }
+    if context:
+        _p["context"] = context
+    if usage_identifier_key:
+        # The api key of the usage plan to meter & throttle the request on
+        _p["usageIdentifierKey"] = usage_identifier_key
+    return _p
+
+
+def _aggregated_resources(stage_arn, granted_mask):
+    """ Every method the scopes allow, the whole stage when they allow them all """
+    allowed = _route_policy.allowed_routes(granted_mask)
+    if len(allowed) == len(_route_policy.route_masks):
+        return [f"{stage_arn}/*"]
+    return [f"{stage_arn}/{http_method}{resource}" for http_method, resource in allowed]
+
+
+def _decide(claims, method_arn):
+    stage_arn, http_method, resource = _parse_method_arn(method_arn)
+    granted_mask = _route_policy.scope_mask(claims.get("scope", ""))
+    if global_args.AUTHORIZER_POLICY == "aggregated":
+        resources = _aggregated_resources(stage_arn, granted_mask)
+        effect = "Allow" if resources else "Deny"
+        resources = resources or [f"{stage_arn}/*"]
+    else:
+        effect = "Deny"
+        if _route_policy.is_allowed(http_method, resource, granted_mask):
+            effect = "Allow"
+        resources = method_arn
+
+    return _policy(
+        claims.get("client_id", claims.get("sub")),
+        effect,
+        resources,
+        context={
+            "client_id": claims.get("client_id", ""),
+            "scope": claims.get("scope", ""),
+            # The function checks revocations & expiry again, a cached Allow outlives them
+            "jti": claims.get("jti", ""),
+            "iat": claims.get("iat", 0),
+            "exp": claims.get("exp", 0)
+        },
+        # Each app client's api key is its client id, so the key comes from
+        # the verified token instead of a header the caller could pick
+        usage_identifier_key=claims.get("client_id")
+    )
+
+
+def lambda_handler(event, context):
+    method_arn = event["methodArn"]
+    _t = event.get("authorizationToken", "")
+    if _t.startswith("Bearer "):
+        _t = _t[7:]
+
+    # An aggregated policy does not depend on the method, one decision serves the stage
+    policy_scope = method_arn
+    if global_args.AUTHORIZER_POLICY == "aggregated":
+        policy_scope = _parse_method_arn(method_arn)[0]
+    decision_key = (hashlib.sha256(_t.encode("utf-8")).digest(), policy_scope)
+    decision = _decisions.get(decision_key, time.time())
+
+    if decision is None:
+        try:
+            claims = _verifier.verify(_t)
+        except JwtVerificationError as e:
+            logger.info("Token rejected", extra=log_fields(reason=str(e)))
+            # API Gateway answers 401 for this exact message
+            raise Exception("Unauthorized")
+        decision = _decisions.put(
+            decision_key, Decision(claims, _decide(claims, method_arn), claims["exp"]))
+
+    if _revocations is not None:
+        reason = _revocations.is_revoked(decision.claims)
+        if reason:
+            logger.info("Token revoked", extra=log_fields(
+                reason=reason, client_id=decision.claims.get("client_id")))
+            raise Exception("Unauthorized")
+
+    return decision.response
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: content_cache
+    :Actions: In-process LRU cache of serialised responses with strong ETags
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+_CODING_SUFFIX = re.compile(r'-(gzip|br)"$')
+
+
+class CachedResponse:
+    """
+    Serialised response body, its strong ETag and absolute expiry time.
+    `encoded` keeps the compressed variants of the body, per content coding.
+    """
+    __slots__ = ("body", "etag", "expires_at", "encoded")
+
+    def __init__(self, body, etag, expires_at):
+        self.body = body
+        self.etag = etag
+        self.expires_at = expires_at
+        self.encoded = {}
+
+
+def strong_etag(body):
+    """ Strong validator, the quoted digest of the exact response bytes """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    `If-None-Match` comparison, RFC 7232 uses the weak comparison here so
+    `W/` prefixes are ignored. `*` matches any current representation, and
+    the ETag of a compressed variant(`"abc-gzip"`) matches its identity `"abc"`.
+    """
+    if not if_none_match:
+        return False
+    for _t in if_none_match.split(","):
+        _t = _t.strip()
+        if _t == "*":
+            return True
+        if _t.startswith("W/"):
+            _t = _t[2:]
+        if _t == etag or _CODING_SUFFIX.sub('"', _t) == etag:
+            return True
+    return False
+
+
+class ContentCache:
+    """
+    LRU of responses keyed by `(resource, variant)`, entries live for `ttl`
+    seconds and the least recently used go once there are `max_entries`.
+
+    `variant` is whatever the response varies by, the caller's scope for the
+    premium content. `invalidate(resource)` drops every variant of a resource,
+    it only reaches this container, other containers expire theirs after `ttl`.
+    """
+
+    def __init__(self, max_entries=256, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, resource, variant=""):
+        key = (resource, variant)
+        with self._lock:
+            _c = self._entries.get(key)
+            if _c is None:
+                return None
+            if time.time() >= _c.expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return _c
+
+    def put(self, resource, variant, body):
+        _c = CachedResponse(body, strong_etag(body), time.time() + self.ttl)
+        if self.ttl <= 0:
+            return _c
+        with self._lock:
+            self._entries[(resource, variant)] = _c
+            self._entries.move_to_end((resource, variant))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return _c
+
+    def invalidate(self, resource=None):
+        with self._lock:
+            if resource is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[0] == resource]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
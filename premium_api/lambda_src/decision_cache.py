@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: decision_cache
+    :Actions: In-process LRU of authorizer decisions, keyed by token digest
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class Decision:
+    """ Authorizer response for a token, the claims it was made on & when it lapses """
+    __slots__ = ("claims", "response", "expires_at")
+
+    def __init__(self, claims, response, expires_at):
+        self.claims = claims
+        self.response = response
+        self.expires_at = expires_at
+
+
+class DecisionCache:
+    """
+    LRU of `Decision`s keyed by `(token digest, policy scope)`, the policy
+    scope being the method ARN, or the stage ARN for aggregated policies. A
+    decision lives until its token expires, the least recently used go once
+    there are `max_entries`.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        with self._lock:
+            _d = self._entries.get(key)
+            if _d is None:
+                return None
+            if _d.expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return _d
+
+    def put(self, key, decision):
+        if not self.max_entries:
+            return decision
+        with self._lock:
+            self._entries[key] = decision
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return decision
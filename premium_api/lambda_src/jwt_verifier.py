@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: jwt_verifier
+    :Actions: Verify Cognito issued JWT access tokens locally against a cached JWKS
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Only the standard library is used, so the module can be imported on its own
+(in an authorizer, a benchmark or a shell) without any packaging step.
+"""
+
+import base64
+import collections
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+# ASN.1 DigestInfo prefix for SHA-256, RFC 8017 section 9.2
+_SHA256_DIGEST_INFO = bytes.fromhex("3031300d060960864801650304020105000420")
+
+
+class JwtVerificationError(Exception):
+    """ Raised when a token is malformed, badly signed or fails a claim check """
+    pass
+
+
+def b64url_decode(s):
+    if isinstance(s, str):
+        s = s.encode("ascii")
+    return base64.urlsafe_b64decode(s + b"=" * (-len(s) % 4))
+
+
+def _b64url_uint(s):
+    return int.from_bytes(b64url_decode(s), "big")
+
+
+class RsaPublicKey:
+    """
+    RSA public key with everything needed for RS256 verification precomputed,
+    so a verification is a single modular exponentiation and a byte compare.
+    """
+    __slots__ = ("kid", "n", "e", "size")
+
+    def __init__(self, kid, n, e):
+        self.kid = kid
+        self.n = n
+        self.e = e
+        self.size = (n.bit_length() + 7) // 8
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        return cls(jwk["kid"], _b64url_uint(jwk["n"]), _b64url_uint(jwk["e"]))
+
+    def verify_rs256(self, signing_input, signature):
+        """ RSASSA-PKCS1-v1_5 with SHA-256 """
+        if len(signature) != self.size:
+            return False
+        s = int.from_bytes(signature, "big")
+        if s >= self.n:
+            return False
+        em = pow(s, self.e, self.n).to_bytes(self.size, "big")
+        t = _SHA256_DIGEST_INFO + hashlib.sha256(signing_input).digest()
+        expected = b"\x00\x01" + b"\xff" * \
+            (self.size - len(t) - 3) + b"\x00" + t
+        return hmac.compare_digest(em, expected)
+
+
+class JwksCache:
+    """
+    Signing keys of an issuer, fetched once and kept for the container life.
+
+    A token signed with an unknown `kid` triggers a re-fetch, which is how key
+    rotation is picked up. Re-fetches are rate limited to one every
+    `min_refresh_interval` seconds so garbage `kid`s cannot hammer the issuer.
+    """
+
+    def __init__(self, jwks_url, min_refresh_interval=60, fetch_timeout=2):
+        self.jwks_url = jwks_url
+        self.min_refresh_interval = min_refresh_interval
+        self.fetch_timeout = fetch_timeout
+        self._keys = {}
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+
+    def load(self, jwks):
+        """ Replace the key set from an already parsed JWKS document """
+        self._keys = {
+            k["kid"]: RsaPublicKey.from_jwk(k)
+            for k in jwks.get("keys", [])
+            if k.get("kty") == "RSA"
+        }
+        self._fetched_at = time.time()
+
+    def get(self, kid):
+        key = self._keys.get(kid)
+        if key is None:
+            with self._lock:
+                key = self._keys.get(kid)
+                if key is None and time.time() - self._fetched_at >= self.min_refresh_interval:
+                    self._refresh()
+                    key = self._keys.get(kid)
+        return key
+
+    def _refresh(self):
+        # Deferred, urllib.request alone is a good part of the module import time
+        import urllib.request
+        logger.info("Fetching signing keys from %s", self.jwks_url)
+        with urllib.request.urlopen(self.jwks_url, timeout=self.fetch_timeout) as r:
+            self.load(json.loads(r.read()))
+
+
+class JwtVerifier:
+    """
+    Verify Cognito access tokens: RS256 signature, `exp`, `iss`, `token_use`
+    and, when `client_ids` is given, `client_id`. An empty `client_ids`
+    allows no client at all.
+
+    Verified tokens are remembered by their SHA-256 digest until they expire, so
+    a token presented again costs one hash and a dict lookup.
+    """
+
+    def __init__(self, issuer, jwks, client_ids=None, token_use="access", leeway=0, cache_size=1024):
+        self.issuer = issuer
+        self.jwks = jwks
+        self.client_ids = frozenset(client_ids) if client_ids is not None else None
+        self.token_use = token_use
+        self.leeway = leeway
+        self.cache_size = cache_size
+        self._verified = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def verify(self, token):
+        """ Return the token claims, raise `JwtVerificationError` when not valid """
+        if isinstance(token, str):
+            token = token.encode("ascii")
+        digest = hashlib.sha256(token).digest()
+        now = time.time()
+
+        claims = self._cached(digest, now)
+        if claims is not None:
+            return claims
+
+        claims = self._verify(token, now)
+        if self.cache_size:
+            with self._lock:
+                self._verified[digest] = claims
+                if len(self._verified) > self.cache_size:
+                    self._verified.popitem(last=False)
+        return claims
+
+    def _cached(self, digest, now):
+        claims = self._verified.get(digest)
+        if claims is None:
+            return None
+        if now >= claims["exp"] + self.leeway:
+            with self._lock:
+                self._verified.pop(digest, None)
+            raise JwtVerificationError("Token expired")
+        return claims
+
+    def _verify(self, token, now):
+        try:
+            header_b64, payload_b64, signature_b64 = token.split(b".")
+            header = json.loads(b64url_decode(header_b64))
+            claims = json.loads(b64url_decode(payload_b64))
+            signature = b64url_decode(signature_b64)
+        except Exception:
+            raise JwtVerificationError("Malformed token")
+
+        if header.get("alg") != "RS256":
+            raise JwtVerificationError(
+                f"Unsupported algorithm: {header.get('alg')}")
+        key = self.jwks.get(header.get("kid"))
+        if key is None:
+            raise JwtVerificationError(f"Unknown signing key: {header.get('kid')}")
+        if not key.verify_rs256(header_b64 + b"." + payload_b64, signature):
+            raise JwtVerificationError("Invalid signature")
+
+        if not isinstance(claims.get("exp"), (int, float)) or now >= claims["exp"] + self.leeway:
+            raise JwtVerificationError("Token expired")
+        if claims.get("iss") != self.issuer:
+            raise JwtVerificationError(f"Invalid issuer: {claims.get('iss')}")
+        if claims.get("token_use") != self.token_use:
+            raise JwtVerificationError(
+                f"Invalid token_use: {claims.get('token_use')}")
+        if self.client_ids is not None and claims.get("client_id") not in self.client_ids:
+            raise JwtVerificationError(
+                f"Invalid client_id: {claims.get('client_id')}")
+        return claims
+
+
+def token_scopes(claims):
+    """ The space separated `scope` claim as a set """
+    return frozenset(claims.get("scope", "").split())
+
+
+def claim_time(value):
+    """
+    Epoch seconds of a time claim(`exp`, `iat`..). The Cognito authorizer of
+    a REST API hands them over as dates, `Wed Jun 24 12:00:00 UTC 2020`.
+    """
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return _claim_date(value)
+
+
+@functools.lru_cache(maxsize=256)
+def _claim_date(value):
+    # strptime is slow, and the tokens of a client come back again and again
+    import calendar
+    return float(calendar.timegm(time.strptime(value, "%a %b %d %H:%M:%S %Z %Y")))
@@ -7,10 +7,20 @@
 .. contactauthor:: miztiik@github issues
 """
 
-import boto3
 import json
-import logging
+import math
 import os
+import time
+
+from content_cache import ContentCache, etag_matches
+from jwt_verifier import claim_time
+from revocation import revocation_list_from_uri
+from route_policy import CompiledRoutePolicy
+from shared.api_request import ApiRequest, Router, error_response
+from shared.compression import encode_response
+from shared.metrics import metrics
+from shared.rate_limiter import RateLimiter, bucket_store_from_uri
+from shared.structured_logging import event_summary, log_fields, set_logging
 
 
 __author__ = "Mystique"
@@ -25,56 +35,232 @@ class global_args:
     ENVIRONMENT = "production"
     MODULE_NAME = "content_consumers"
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+    CONTENT_CACHE_TTL_SECONDS = int(os.getenv("CONTENT_CACHE_TTL_SECONDS", 60))
+    CONTENT_CACHE_MAX_ENTRIES = int(
+        os.getenv("CONTENT_CACHE_MAX_ENTRIES", 256))
+    ROUTE_POLICY = os.getenv("ROUTE_POLICY", "{}")
+    BATCH_RESOURCE = "/home/premium/batch"
+    MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", 50))
+    # {"METHOD /path": {"rate_limit": .., "burst_limit": ..}}, per app client
+    RATE_LIMITS = os.getenv("RATE_LIMITS", "{}")
+    RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "")
+    REVOCATION_STORE = os.getenv("REVOCATION_STORE", "")
+    REVOCATION_REFRESH_SECONDS = float(
+        os.getenv("REVOCATION_REFRESH_SECONDS", 10))
+    # [[api key id, app client id], ..], the key each app client is metered on
+    API_KEY_CLIENTS = os.getenv("API_KEY_CLIENTS", "[]")
 
 
-def set_logging(lv=global_args.LOG_LEVEL):
-    """ Helper to enable logging """
-    logging.basicConfig(level=lv)
-    logger = logging.getLogger()
-    logger.setLevel(lv)
-    return logger
+# Initial some defaults in global context to reduce lambda start time, when re-using container
+logger = set_logging(global_args.LOG_LEVEL, global_args.LOG_SAMPLE_RATES)
 
+_content_cache = ContentCache(
+    max_entries=global_args.CONTENT_CACHE_MAX_ENTRIES,
+    ttl=global_args.CONTENT_CACHE_TTL_SECONDS
+)
 
-# Initial some defaults in global context to reduce lambda start time, when re-using container
-logger = set_logging(logging.INFO)
+_route_policy = CompiledRoutePolicy.from_json(global_args.ROUTE_POLICY)
+
+_rate_limiter = RateLimiter(
+    json.loads(global_args.RATE_LIMITS),
+    store=bucket_store_from_uri(global_args.RATE_LIMIT_STORE)
+)
+
+_router = Router()
+
+# Api key id -> the app client it belongs to
+_api_key_clients = {
+    key_id: client_id for key_id, client_id in json.loads(global_args.API_KEY_CLIENTS)}
+
+# The Cognito authorizer knows nothing of revocations, so they are enforced here
+_revocations = revocation_list_from_uri(
+    global_args.REVOCATION_STORE,
+    refresh_interval=global_args.REVOCATION_REFRESH_SECONDS
+)
+
+
+def _caller_scope(request):
+    return request.claims.get("scope", "")
+
+
+def _caller_client_id(request):
+    """ App client the access token was issued to """
+    return request.claims.get("client_id", "")
+
+
+def _token_rejected(request):
+    """
+    401 when the caller's token expired or was revoked, `None` otherwise.
+    The authorizer decision API Gateway cached for the token can outlive both.
+    """
+    claims = request.claims
+    if claims.get("exp") and claim_time(claims["exp"]) <= time.time():
+        metrics.incr("ExpiredTokens")
+        return error_response(401, "Unauthorized")
+    if _revocations is not None and _revocations.is_revoked(claims):
+        metrics.incr("RevokedTokens")
+        return error_response(401, "Unauthorized")
+    return None
+
+
+def _api_key_rejected(request):
+    """
+    403 when the request was metered on another app client's api key, `None`
+    otherwise. The Cognito authorizer takes the key from `x-api-key`, which
+    the caller picks.
+    """
+    if not _api_key_clients:
+        return None
+    if _api_key_clients.get(request.api_key_id) == _caller_client_id(request):
+        return None
+    metrics.incr("ApiKeyMismatch")
+    logger.warning("Api key of another app client", extra=log_fields(
+        api_key_id=request.api_key_id, client_id=_caller_client_id(request)))
+    return error_response(403, "Forbidden")
+
+
+def _rate_limited(request):
+    """ 429 when the caller is over its limit for the route, `None` otherwise """
+    _wait = _rate_limiter.check(
+        _caller_client_id(request), request.http_method, request.resource)
+    if not _wait:
+        return None
+    metrics.incr("RateLimited")
+    return error_response(429, "Too Many Requests", {"Retry-After": str(int(math.ceil(_wait)))})
 
 
-def get_premium_content(e):
+@metrics.timed("GetPremiumContentLatency")
+def get_premium_content(request):
     data = f"Premium Content: OAuth Scope: Read"
-    logger.info(data)
+    logger.debug(data)
     return data
 
 
-def post_premium_content(e):
+@metrics.timed("PostPremiumContentLatency")
+def post_premium_content(request):
     data = f"Premium Content: OAuth Scope: Write"
-    logger.info(data)
+    logger.debug(data)
     return data
 
 
-def lambda_handler(event, context):
-    logger.info(f"received_event:{event}")
-    # event['httpMethod']
-    try:
-        data = ""
-        http_method = event["requestContext"]["httpMethod"]
+def _get_cached_content(request):
+    """ Serialised GET response for the caller's scope, from the cache when fresh """
+    scope = _caller_scope(request)
+    _c = _content_cache.get(request.resource, scope)
+    # Hits are 1 and misses 0, so the Average statistic is the hit ratio
+    metrics.put("ContentCacheHit", 0 if _c is None else 1)
+    if _c is None:
+        _c = _content_cache.put(
+            request.resource,
+            scope,
+            json.dumps({"message": get_premium_content(request)})
+        )
+    return _c
+
+
+@_router.route("GET", "/home/premium")
+def _get(request):
+    _c = _get_cached_content(request)
+    headers = {
+        "ETag": _c.etag,
+        "Cache-Control": f"private, max-age={global_args.CONTENT_CACHE_TTL_SECONDS}"
+    }
+    if etag_matches(request.header("if-none-match"), _c.etag):
+        metrics.incr("NotModified")
+        return {"statusCode": 304, "headers": headers, "body": ""}
+    # The compressed body is cached along with the content
+    return encode_response(
+        {"statusCode": 200, "headers": headers, "body": _c.body},
+        request.header("accept-encoding"),
+        encoded=_c.encoded
+    )
 
-        logger.info(f"http_method:{http_method}")
 
-        if http_method == "GET":
-            data = get_premium_content(event)
-        elif http_method == "POST":
-            data = post_premium_content(event)
-        else:
-            data = ValueError(f"Unsupported method: {http_method}")
+@_router.route("POST", "/home/premium")
+def _post(request):
+    data = post_premium_content(request)
+    # Readers of this resource must not be served the old content
+    _content_cache.invalidate(request.resource)
+    return {"statusCode": 200, "body": json.dumps({"message": data})}
 
+
+def _handle(request):
+    try:
+        return _router.dispatch(request)
     except Exception as e:
-        logger.error(f"{str(e)}")
+        metrics.incr("Errors")
+        logger.error("%s", e)
+    return error_response(500, "Something Obviously went wrong, Let me check")
+
+
+def _batch_item(request, item, granted_mask):
+    """ Response of one batch item, authorized against the scopes of the batch token """
+    if not isinstance(item, dict):
+        item = {}
+    _id = item.get("id")
+    http_method = str(item.get("method", "GET")).upper()
+    resource = item.get("path")
 
-    if not data:
-        data = "Something Obviously went wrong, Let me check"
+    if not resource or resource == global_args.BATCH_RESOURCE:
+        resp = error_response(400, "Each item needs a method and a premium content path")
+    elif _route_policy.required_mask(http_method, resource) is None:
+        resp = _router.unmatched(http_method, resource)
+    elif not _route_policy.is_allowed(http_method, resource, granted_mask):
+        resp = error_response(403, "Unauthorized")
+    else:
+        _item = request.replace(
+            http_method=http_method,
+            resource=resource,
+            headers={"If-None-Match": item["if_none_match"]} if item.get("if_none_match") else {},
+            body=json.dumps(item["body"]) if "body" in item else None,
+            is_base64_encoded=False
+        )
+        resp = _rate_limited(_item) or _handle(_item)
+
+    # The item bodies are JSON already, splice them in instead of re-encoding
+    return '{"id":%s,"status":%d,"headers":%s,"body":%s}' % (
+        json.dumps(_id),
+        resp["statusCode"],
+        json.dumps(resp.get("headers") or {}),
+        resp["body"] or "null"
+    )
+
+
+@_router.route("POST", global_args.BATCH_RESOURCE)
+@metrics.timed("BatchLatency")
+def _handle_batch(request):
+    """
+    Serve a list of item requests under the single authorization of the batch
+    call, answering 207 with a status per item.
+    """
+    try:
+        items = json.loads(request.text() or "{}")["items"]
+        if not isinstance(items, list):
+            raise TypeError("items is not a list")
+    except (ValueError, KeyError, TypeError) as err:
+        logger.info("Malformed batch request: %s", err)
+        return error_response(400, "Expected a JSON body with a list of items")
+    if len(items) > global_args.MAX_BATCH_ITEMS:
+        return error_response(413, f"At most {global_args.MAX_BATCH_ITEMS} items per batch")
+
+    metrics.put("BatchItems", len(items))
+    granted_mask = _route_policy.scope_mask(_caller_scope(request))
     return {
-        "statusCode": 200,
-        "body": json.dumps({
-            "message": data
-        })
+        "statusCode": 207,
+        "headers": {"Content-Type": "application/json"},
+        "body": '{"responses":[%s]}' % ",".join(
+            _batch_item(request, item, granted_mask) for item in items)
     }
+
+
+@metrics.instrument
+def lambda_handler(event, context):
+    logger.info("received_event", extra=log_fields(
+        event=lambda: event_summary(event)))
+    request = ApiRequest.from_event(event)
+    response = _token_rejected(request) or _api_key_rejected(
+        request) or _rate_limited(request)
+    if response is None:
+        response = _handle(request)
+    return encode_response(response, request.header("accept-encoding"))
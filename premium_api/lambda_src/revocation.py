@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: revocation
+    :Actions: Deny list of revoked access tokens, by `jti`, `client_id` or issue time
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+Usage:
+    _revocations = revocation_list_from_uri("dynamodb:revocations")
+    if _revocations.is_revoked(claims):
+        raise Exception("Unauthorized")
+
+Revocations are written to a shared store and read into an exact in-memory
+index, a lookup is a couple of dict probes however many entries there are.
+The index is refreshed every `refresh_interval` seconds with the entries
+written since the last refresh, and rebuilt from all of them every
+`full_sync_interval` seconds, which drops the entries deleted from the store.
+
+Three kinds of entries,
+    jti            - one token, kept until the token expires
+    client_id      - every token of an app client, until `expires_at` if set
+    issued_before  - the tokens issued before a time, of one client or of all,
+                     until `expires_at` if set
+
+The refresh is a query on the request path, of the one request per container
+and `refresh_interval` that finds the list stale. Its client gives up after
+`DynamoDBRevocationStore.READ_TIMEOUT`, a refresh that fails keeps the list
+it had.
+
+Only the standard library is needed, boto3 only by the DynamoDB store.
+"""
+
+import abc
+import logging
+import os
+import threading
+import time
+
+from jwt_verifier import claim_time
+
+
+logger = logging.getLogger()
+
+KINDS = ("jti", "client_id", "issued_before")
+
+
+class Revocation:
+    """ One deny list entry """
+    __slots__ = ("kind", "value", "client_id", "expires_at", "revoked_at", "entry_id")
+
+    def __init__(self, kind, value, client_id=None, expires_at=None, revoked_at=None, entry_id=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown revocation kind {kind}, choose from {KINDS}")
+        self.kind = kind
+        # The jti, the client id or the issued before time
+        self.value = value
+        # The client an `issued_before` entry is limited to
+        self.client_id = client_id
+        # When the entry stops mattering, `None` for never
+        self.expires_at = expires_at
+        self.revoked_at = time.time() if revoked_at is None else revoked_at
+        self.entry_id = entry_id or os.urandom(8).hex()
+
+
+class DenyList:
+    """ Exact index of the revocations, by kind """
+
+    def __init__(self, revocations=()):
+        # jti -> expires at
+        self._jtis = {}
+        # client id -> expires at, `None` for never
+        self._clients = {}
+        # client id, "" for all of them -> {issued before: expires at}, the
+        # tokens issued before the latest cutoff not expired are revoked
+        self._issued_before = {}
+        for _r in revocations:
+            self.add(_r)
+
+    def __len__(self):
+        return len(self._jtis) + len(self._clients) + sum(
+            len(_c) for _c in self._issued_before.values())
+
+    def add(self, r):
+        if r.kind == "jti":
+            self._jtis[r.value] = r.expires_at
+        elif r.kind == "client_id":
+            self._clients[r.value] = r.expires_at
+        else:
+            _c = self._issued_before.setdefault(r.client_id or "", {})
+            _e = _c.get(float(r.value), 0)
+            # The same cutoff written twice lasts as long as the later one
+            _c[float(r.value)] = None if _e is None or r.expires_at is None else max(
+                _e, r.expires_at)
+
+    def prune(self, now):
+        """ Drop the entries of tokens that expired anyway """
+        self._jtis = {k: v for k, v in self._jtis.items()
+                      if v is None or v > now}
+        self._clients = {k: v for k, v in self._clients.items()
+                         if v is None or v > now}
+        _issued_before = {}
+        for k, cutoffs in self._issued_before.items():
+            _c = {c: e for c, e in cutoffs.items() if e is None or e > now}
+            if _c:
+                _issued_before[k] = _c
+        self._issued_before = _issued_before
+
+    def _cutoff(self, client_id, now):
+        """ Latest issued before time of `client_id` still in force, 0 for none """
+        return max((c for c, e in self._issued_before.get(client_id, {}).items()
+                    if e is None or e > now), default=0)
+
+    def is_revoked(self, claims, now=None):
+        """ Why the token with these claims is revoked, `None` when it is not """
+        if not (self._jtis or self._clients or self._issued_before):
+            return None
+        if claims.get("jti") in self._jtis:
+            return "jti"
+        now = now or time.time()
+        client_id = claims.get("client_id")
+        if client_id in self._clients:
+            _e = self._clients[client_id]
+            if _e is None or _e > now:
+                return "client_id"
+        if self._issued_before:
+            _cutoff = max(self._cutoff("", now), self._cutoff(client_id, now))
+            if _cutoff and claim_time(claims.get("iat")) < _cutoff:
+                return "issued_before"
+        return None
+
+
+class RevocationStore(abc.ABC):
+    """ Where the revocations are shared """
+
+    @abc.abstractmethod
+    def put(self, revocation):
+        """ Share a `Revocation` with every container """
+
+    @abc.abstractmethod
+    def since(self, revoked_after=None):
+        """ The revocations written after `revoked_after`, all of them for `None` """
+
+
+class InMemoryRevocationStore(RevocationStore):
+    """ Process local stand-in, for tests and local runs """
+
+    def __init__(self):
+        self._revocations = []
+        self._lock = threading.Lock()
+
+    def put(self, revocation):
+        with self._lock:
+            self._revocations.append(revocation)
+
+    def since(self, revoked_after=None):
+        with self._lock:
+            return [_r for _r in self._revocations
+                    if revoked_after is None or _r.revoked_at > revoked_after]
+
+
+class DynamoDBRevocationStore(RevocationStore):
+    """
+    Revocations as items of one partition, sorted by when they were written,
+    `sk` is `{revoked_at}#{entry_id}`. Reading the new ones is a single query
+    on the sort key. The `ttl` attribute lets DynamoDB delete the entries
+    that stopped mattering.
+    """
+
+    _PARTITION = "revocations"
+    # The refresh runs on the request path, it is not worth a slow request
+    READ_TIMEOUT = 0.5
+
+    def __init__(self, table_name, client_factory=None):
+        self.table_name = table_name
+        self._client_factory = client_factory
+
+    @property
+    def client(self):
+        if self._client_factory is None:
+            from shared import aws_clients
+            self._client_factory = lambda: aws_clients.client(
+                "dynamodb", read_timeout=self.READ_TIMEOUT, max_attempts=1)
+        return self._client_factory()
+
+    @staticmethod
+    def _sort_key(revoked_at, entry_id=""):
+        # Fixed width, so the string order is the time order
+        return f"{revoked_at:017.6f}#{entry_id}"
+
+    def put(self, revocation):
+        _r = revocation
+        item = {
+            "pk": {"S": self._PARTITION},
+            "sk": {"S": self._sort_key(_r.revoked_at, _r.entry_id)},
+            "kind": {"S": _r.kind},
+            "value": {"S": str(_r.value)},
+        }
+        if _r.client_id:
+            item["client_id"] = {"S": _r.client_id}
+        if _r.expires_at is not None:
+            item["expires_at"] = {"N": str(_r.expires_at)}
+            item["ttl"] = {"N": str(int(_r.expires_at) + 60)}
+        self.client.put_item(TableName=self.table_name, Item=item)
+
+    def since(self, revoked_after=None):
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "pk = :pk",
+            "ExpressionAttributeValues": {":pk": {"S": self._PARTITION}},
+        }
+        if revoked_after is not None:
+            kwargs["KeyConditionExpression"] = "pk = :pk AND sk > :sk"
+            kwargs["ExpressionAttributeValues"][":sk"] = {
+                "S": self._sort_key(max(revoked_after, 0))}
+        revocations = []
+        while True:
+            resp = self.client.query(**kwargs)
+            for _i in resp.get("Items", []):
+                _revoked_at, _, _entry_id = _i["sk"]["S"].partition("#")
+                revocations.append(Revocation(
+                    _i["kind"]["S"],
+                    _i["value"]["S"],
+                    client_id=_i.get("client_id", {}).get("S"),
+                    expires_at=float(_i["expires_at"]["N"]) if "expires_at" in _i else None,
+                    revoked_at=float(_revoked_at),
+                    entry_id=_entry_id
+                ))
+            if "LastEvaluatedKey" not in resp:
+                return revocations
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+class RevocationList:
+    """
+    `DenyList` kept in sync with a `RevocationStore`. A refresh runs on the
+    request that finds the list stale, one request at a time, the others
+    check against the list they have. A failed refresh keeps the list as it
+    was and is tried again after `refresh_interval`.
+    """
+
+    def __init__(self, store, refresh_interval=10, full_sync_interval=300, overlap=60):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.full_sync_interval = full_sync_interval
+        # Writers' clocks differ, the incremental reads look back this far
+        self.overlap = overlap
+        self._deny_list = DenyList()
+        self._cursor = None
+        self._next_refresh = 0
+        self._next_full_sync = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._deny_list)
+
+    def is_revoked(self, claims):
+        now = time.time()
+        if now >= self._next_refresh:
+            self.refresh(now)
+        return self._deny_list.is_revoked(claims, now)
+
+    def refresh(self, now=None):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            now = now or time.time()
+            full = now >= self._next_full_sync
+            try:
+                revocations = self.store.since(
+                    None if full else self._cursor - self.overlap)
+            except Exception as e:
+                logger.warning("Unable to refresh the revocations: %s", e)
+                self._next_refresh = now + self.refresh_interval
+                return
+            if full:
+                # Built aside and swapped in, the requests in flight keep the old one
+                _d = DenyList(revocations)
+                _d.prune(now)
+                self._deny_list = _d
+                self._next_full_sync = now + self.full_sync_interval
+            else:
+                for _r in revocations:
+                    self._deny_list.add(_r)
+            self._cursor = max([self._cursor or 0] + [_r.revoked_at for _r in revocations])
+            self._next_refresh = now + self.refresh_interval
+        finally:
+            self._lock.release()
+
+
+def revocation_store_from_uri(uri):
+    """ `memory` or `dynamodb:table-name`, `None` when empty """
+    if not uri:
+        return None
+    if uri == "memory":
+        return InMemoryRevocationStore()
+    scheme, _, target = uri.partition(":")
+    if scheme == "dynamodb":
+        return DynamoDBRevocationStore(target)
+    raise ValueError(f"Unsupported revocation store: {uri}")
+
+
+def revocation_list_from_uri(uri, **kwargs):
+    """ `RevocationList` over the store of `uri`, `None` when revocation is off """
+    store = revocation_store_from_uri(uri)
+    return RevocationList(store, **kwargs) if store is not None else None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Revoke premium api access tokens")
+    parser.add_argument("--table", required=True,
+                        help="Revocation table, the RevocationTableName stack output")
+    _kind = parser.add_mutually_exclusive_group(required=True)
+    _kind.add_argument("--jti", help="Revoke one token")
+    _kind.add_argument("--client-id", help="Revoke every token of an app client")
+    _kind.add_argument("--issued-before", type=float,
+                       help="Revoke the tokens issued before this epoch time, of --for-client or of all clients")
+    parser.add_argument("--for-client", help="Client an --issued-before revocation is limited to")
+    parser.add_argument("--expires-at", type=float,
+                        help="Epoch time the entry stops mattering, the token's `exp` for --jti, "
+                             "a day after the cutoff for --issued-before")
+    args = parser.parse_args()
+
+    if args.jti:
+        # Cognito access tokens live a day at most
+        _r = Revocation("jti", args.jti,
+                        expires_at=args.expires_at or time.time() + 86400)
+    elif args.client_id:
+        _r = Revocation("client_id", args.client_id, expires_at=args.expires_at)
+    else:
+        # The tokens issued before the cutoff are all expired a day later
+        _r = Revocation("issued_before", args.issued_before, client_id=args.for_client,
+                        expires_at=args.expires_at or args.issued_before + 86400)
+    import boto3
+    DynamoDBRevocationStore(
+        args.table, client_factory=lambda: boto3.client("dynamodb")).put(_r)
+    print(f"Revoked {_r.kind} {_r.value}")
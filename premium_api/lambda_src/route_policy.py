@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+.. module: route_policy
+    :Actions: Compile the premium api route to scope policy for deploy and run time
+    :copyright: (c) 2020 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+
+The policy is declared once as `(method, resource, [scopes])` rows. The CDK
+stack uses it to set `authorization_scopes` on every API Gateway method and
+ships `to_json()` to the functions, which rebuild it with `from_json()`.
+At run time every scope is a bit and every route a bitmask, so a check is a
+dict lookup and an AND.
+
+A route listing several scopes is allowed with any one of them, like API
+Gateway treats `authorization_scopes`, a route listing none is open to every
+token.
+"""
+
+import functools
+import json
+from types import MappingProxyType
+
+
+class CompiledRoutePolicy:
+    """ Frozen (method, resource) -> required scope bitmask index """
+    __slots__ = ("scopes", "scope_bits", "route_masks", "_scope_mask", "_allowed_routes")
+
+    def __init__(self, routes):
+        scope_bits = {}
+        route_masks = {}
+        for http_method, resource, scopes in routes:
+            mask = 0
+            for scope in scopes:
+                if scope not in scope_bits:
+                    scope_bits[scope] = 1 << len(scope_bits)
+                mask |= scope_bits[scope]
+            route_masks[(http_method.upper(), resource)] = mask
+        self.scopes = tuple(scope_bits)
+        self.scope_bits = MappingProxyType(scope_bits)
+        self.route_masks = MappingProxyType(route_masks)
+        # Tokens of a client carry the same scope claim, parse each one once
+        self._scope_mask = functools.lru_cache(maxsize=256)(self._parse_scope_claim)
+        # There are only as many masks as scope combinations
+        self._allowed_routes = functools.lru_cache(maxsize=256)(self._routes_for_mask)
+
+    def _parse_scope_claim(self, scope_claim):
+        mask = 0
+        for scope in scope_claim.split():
+            mask |= self.scope_bits.get(scope, 0)
+        return mask
+
+    def scope_mask(self, scope_claim):
+        """ Bitmask of the known scopes in a space separated `scope` claim """
+        return self._scope_mask(scope_claim)
+
+    def required_mask(self, http_method, resource):
+        """ Required bitmask of a route, `None` for routes not in the policy """
+        return self.route_masks.get((http_method, resource))
+
+    @staticmethod
+    def _grants(required, granted_mask):
+        return not required or required & granted_mask != 0
+
+    def is_allowed(self, http_method, resource, granted_mask):
+        required = self.route_masks.get((http_method, resource))
+        return required is not None and self._grants(required, granted_mask)
+
+    def _routes_for_mask(self, granted_mask):
+        return tuple(route for route, required in self.route_masks.items()
+                     if self._grants(required, granted_mask))
+
+    def allowed_routes(self, granted_mask):
+        """ Every (method, resource) the scopes of `granted_mask` allow, in declaration order """
+        return self._allowed_routes(granted_mask)
+
+    def scopes_for(self, http_method, resource):
+        """ Scope names of a route, any one of them allows it, in declaration order """
+        mask = self.route_masks[(http_method.upper(), resource)]
+        return [s for s in self.scopes if self.scope_bits[s] & mask]
+
+    def routes(self):
+        return list(self.route_masks)
+
+    def to_json(self):
+        return json.dumps({
+            "scopes": list(self.scopes),
+            "routes": [[m, r, mask] for (m, r), mask in self.route_masks.items()]
+        }, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, doc):
+        _d = json.loads(doc) if isinstance(doc, str) else doc
+        scopes = _d.get("scopes", [])
+        return cls(
+            (m, r, [s for i, s in enumerate(scopes) if mask & (1 << i)])
+            for m, r, mask in _d.get("routes", [])
+        )
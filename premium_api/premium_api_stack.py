@@ -1,10 +1,15 @@
 from aws_cdk import aws_apigateway as _apigw
+from aws_cdk import aws_dynamodb as _dynamodb
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk import aws_logs as _logs
 from aws_cdk import core
 
+import json
 import os
 
+from bundling.lambda_bundle import AssetBundler
+from premium_api.lambda_src.route_policy import CompiledRoutePolicy
+
 
 class PremiumApiStack(core.Stack):
 
@@ -16,34 +21,173 @@ class PremiumApiStack(core.Stack):
         unicorn_user_pool_res_srv_identifier,
         unicorn_read_scope,
         unicorn_write_scope,
+        app_clients,
+        app_client_ids,
+        perf_profile,
         **kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
 
-        # Create Serverless Event Processor using Lambda):
-        # Read Lambda Code
-        try:
-            with open("premium_api/lambda_src/premium_content.py", mode="r") as f:
-                premium_content_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
+        # Choose who validates the access tokens, "cognito" (default) or "lambda"
+        authorizer_mode = self.node.try_get_context(
+            "api_authorizer_mode") or "cognito"
+
+        # The Lambda authorizer answers with one policy over all the routes a
+        # token may call("aggregated") or for the method called only("method")
+        lambda_authorizer = self.node.try_get_context("lambda_authorizer") or {}
+        authorizer_policy = lambda_authorizer.get("policy", "aggregated")
+        if authorizer_policy not in ("aggregated", "method"):
+            raise ValueError(
+                f"Unsupported lambda_authorizer policy: {authorizer_policy}")
+        # An aggregated decision holds for every call made with the token, so
+        # API Gateway can keep it as long as the token lives(_at most an hour_).
+        # The function rejects the tokens that expired or were revoked since.
+        authorizer_results_ttl = 15
+        if authorizer_policy == "aggregated":
+            authorizer_results_ttl = min(
+                3600, int(lambda_authorizer.get("access_token_validity_seconds", 3600)))
+
+        # Opt-in API Gateway response cache in front of the GET methods
+        api_cache = self.node.try_get_context("premium_api_cache") or {}
+        api_cache_enabled = bool(api_cache.get("enabled", False))
+        api_cache_ttl = int(api_cache.get("ttl_seconds", 60))
+
+        # Per client throughput & daily quota tiers, each of the `app_clients`
+        # picks one with `usage_plan`
+        usage_plans = self.node.try_get_context("usage_plans") or {
+            "standard": {"rate_limit": 5, "burst_limit": 10, "quota_per_day": 10000}
+        }
+        client_plans = [_c.get("usage_plan", "standard") for _c in app_clients]
+        unknown_plans = set(client_plans) - set(usage_plans)
+        if unknown_plans:
+            raise ValueError(f"Unknown usage plans {sorted(unknown_plans)}")
+        # A client is only guaranteed its rate when the stage carries all of them at once
+        reserved_rps = sum(float(usage_plans[_p]["rate_limit"])
+                           for _p in client_plans)
+        if reserved_rps > perf_profile.throttling_rate_limit:
+            raise ValueError(
+                f"The usage plans of the app clients add up to {reserved_rps:.0f} rps, more than "
+                f"the {perf_profile.throttling_rate_limit:.0f} rps stage limit of the {perf_profile.name} profile")
+
+        # Finer grained limits than the usage plans, per client & route, enforced
+        # by the function across its containers
+        rate_limits = self.node.try_get_context("premium_api_rate_limits") or {}
+        rate_limit_routes = rate_limits.get("routes") or {}
+        rate_limit_backend = rate_limits.get("backend", "dynamodb")
+        if rate_limit_backend not in ("memory", "dynamodb"):
+            raise ValueError(
+                f"Unsupported premium_api_rate_limits backend: {rate_limit_backend}")
+
+        # Deny list of revoked access tokens, checked by the authorizer & the function
+        token_revocation = self.node.try_get_context("token_revocation") or {}
+        token_revocation_enabled = bool(token_revocation.get("enabled", True))
+        revocation_env = {}
+        revocation_table = None
+        if token_revocation_enabled:
+            revocation_table = _dynamodb.Table(
+                self,
+                "revocationTable",
+                partition_key=_dynamodb.Attribute(
+                    name="pk",
+                    type=_dynamodb.AttributeType.STRING
+                ),
+                sort_key=_dynamodb.Attribute(
+                    name="sk",
+                    type=_dynamodb.AttributeType.STRING
+                ),
+                billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="ttl",
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+            revocation_env = {
+                "REVOCATION_STORE": f"dynamodb:{revocation_table.table_name}",
+                "REVOCATION_REFRESH_SECONDS": str(token_revocation.get("refresh_seconds", 10))
+            }
+
+        # Each function ships only the modules it imports, byte-compiled ahead.
+        # The functions are bundled first, the layer keeps what they use of it
+        bundler = AssetBundler.from_context(
+            self.node, perf_profile.python_version, ["lambda_layers/shared"])
+        premium_content_asset = bundler.function(
+            "premium_content", "premium_api/lambda_src", "premium_content")
+        if authorizer_mode == "lambda":
+            api_authorizer_asset = bundler.function(
+                "api_authorizer", "premium_api/lambda_src", "api_authorizer")
+
+        # Code shared by the functions, structured logging etc.
+        shared_layer = _lambda.LayerVersion(
+            self,
+            "sharedLayer",
+            code=_lambda.Code.from_asset(
+                bundler.layer("shared_layer", "lambda_layers/shared")),
+            compatible_runtimes=[perf_profile.runtime],
+            description="Code shared by the lambda functions"
+        )
+
+        # Route/Method -> Required Scopes policy. Compiled once, it drives the
+        # API Gateway method settings here and the authorization lookups at runtime.
+        # The items of a batch are authorized one by one against their own routes
+        route_policy = CompiledRoutePolicy([
+            ("GET", "/home/premium",
+             [f"{unicorn_user_pool_res_srv_identifier}/{unicorn_read_scope}"]),
+            ("POST", "/home/premium",
+             [f"{unicorn_user_pool_res_srv_identifier}/{unicorn_write_scope}"]),
+            ("POST", "/home/premium/batch",
+             [f"{unicorn_user_pool_res_srv_identifier}/{unicorn_read_scope}"]),
+        ])
+        known_routes = {f"{_m} {_r}" for _m, _r in route_policy.routes()}
+        unknown_routes = set(rate_limit_routes) - known_routes - {"*"}
+        if unknown_routes:
+            raise ValueError(
+                f"Rate limits for unknown routes {sorted(unknown_routes)}")
 
+        rate_limit_table = None
+        rate_limit_store = ""
+        if rate_limit_routes and rate_limit_backend == "dynamodb":
+            rate_limit_table = _dynamodb.Table(
+                self,
+                "rateLimitTable",
+                partition_key=_dynamodb.Attribute(
+                    name="pk",
+                    type=_dynamodb.AttributeType.STRING
+                ),
+                billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="ttl",
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+            rate_limit_store = f"dynamodb:{rate_limit_table.table_name}"
+
+        # Create Serverless Event Processor using Lambda):
         premium_content_fn = _lambda.Function(
             self,
             "premiumContentFunction",
             function_name="premium_function",
-            runtime=_lambda.Runtime.PYTHON_3_7,
-            handler="index.lambda_handler",
-            code=_lambda.InlineCode(
-                premium_content_fn_code),
+            handler="premium_content.lambda_handler",
+            code=_lambda.Code.from_asset(premium_content_asset),
+            layers=[shared_layer],
             timeout=core.Duration.seconds(3),
-            reserved_concurrent_executions=1,
+            **perf_profile.function_props(),
             environment={
                 "LOG_LEVEL": "INFO",
+                "LOG_SAMPLE_RATES": "INFO=0.1",
+                "METRICS_SAMPLE_RATE": "1.0",
+                "CONTENT_CACHE_TTL_SECONDS": str(api_cache_ttl),
+                "MAX_BATCH_ITEMS": "50",
+                "ROUTE_POLICY": route_policy.to_json(),
+                "RATE_LIMITS": json.dumps(rate_limit_routes),
+                "RATE_LIMIT_STORE": rate_limit_store,
+                **revocation_env,
                 "Environment": "Production"
             }
         )
+        if revocation_table:
+            revocation_table.grant_read_data(premium_content_fn)
+        if rate_limit_table:
+            rate_limit_table.grant_read_write_data(premium_content_fn)
+
+        # Keep the function warm with provisioned concurrency, when the profile asks for it
+        premium_content_fn_target = perf_profile.apply(
+            self, premium_content_fn)
 
         # Create Custom Loggroup
         # /aws/lambda/function-name
@@ -55,11 +199,35 @@ class PremiumApiStack(core.Stack):
             removal_policy=core.RemovalPolicy.DESTROY
         )
 
+        # Cached GETs are keyed on the access token, so a response is only ever
+        # served back to the client & scope it was produced for. Also on the
+        # validator & the codings accepted, a 304 or a compressed body is only
+        # served to the callers that asked for one.
+        cache_key_parameters = [
+            "method.request.header.Authorization",
+            "method.request.header.If-None-Match",
+            "method.request.header.Accept-Encoding"
+        ]
+        api_cache_options = {}
+        if api_cache_enabled:
+            api_cache_options = {
+                "cache_cluster_enabled": True,
+                "cache_cluster_size": str(api_cache.get("cluster_size", "0.5")),
+                "method_options": {
+                    f"{resource_path}/{http_method}": _apigw.MethodDeploymentOptions(
+                        caching_enabled=True,
+                        cache_ttl=core.Duration.seconds(api_cache_ttl)
+                    )
+                    for http_method, resource_path in route_policy.routes()
+                    if http_method == "GET"
+                }
+            }
+
         # Add API GW front end for the Lambda
         walled_garden_api_stage_options = _apigw.StageOptions(
             stage_name="prod",
-            throttling_rate_limit=10,
-            throttling_burst_limit=100,
+            **perf_profile.stage_throttling(),
+            **api_cache_options,
             logging_level=_apigw.MethodLoggingLevel.INFO
         )
 
@@ -69,51 +237,157 @@ class PremiumApiStack(core.Stack):
             "walledGardenApi",
             rest_api_name="walled-garden-api",
             deploy_options=walled_garden_api_stage_options,
+            # Compressed bodies go back base64 encoded, API Gateway decodes them for the client
+            binary_media_types=["*/*"],
             endpoint_types=[
                 _apigw.EndpointType.REGIONAL
             ],
-            handler=premium_content_fn,
-            proxy=False
+            handler=premium_content_fn_target,
+            proxy=False,
+            # The Lambda authorizer names the api key from the verified token,
+            # with the Cognito authorizer the client sends it in `x-api-key`
+            api_key_source_type=_apigw.ApiKeySourceType.AUTHORIZER if authorizer_mode == "lambda" else _apigw.ApiKeySourceType.HEADER
         )
 
+        # One usage plan per tier, one api key per app client. Clients over
+        # their plan are turned away by API Gateway with a 429 before the
+        # function is invoked.
+        api_usage_plans = {}
+        for plan_name in sorted(set(client_plans)):
+            _p = usage_plans[plan_name]
+            api_usage_plans[plan_name] = api_01.add_usage_plan(
+                f"usagePlan-{plan_name}",
+                name=f"walled-garden-{plan_name}",
+                throttle=_apigw.ThrottleSettings(
+                    rate_limit=_p["rate_limit"],
+                    burst_limit=_p["burst_limit"]
+                ),
+                quota=_apigw.QuotaSettings(
+                    limit=_p["quota_per_day"],
+                    period=_apigw.Period.DAY
+                ) if _p.get("quota_per_day") else None,
+                api_stages=[_apigw.UsagePlanPerApiStage(
+                    api=api_01, stage=api_01.deployment_stage)]
+            )
+        # With the lambda authorizer the key's value is the client id, the
+        # authorizer names it from the verified token. The Cognito authorizer
+        # takes the key from the `x-api-key` header, a client id is no secret,
+        # so API Gateway generates the values.
+        api_key_clients = []
+        for app_client, plan_name in zip(app_clients, client_plans):
+            client_id = app_client_ids[app_client["name"]]
+            api_key = _apigw.ApiKey(
+                self,
+                f"apiKey-{app_client['name']}",
+                api_key_name=f"walled-garden-{app_client['name']}",
+                value=client_id if authorizer_mode == "lambda" else None
+            )
+            api_key_clients.append([api_key.key_id, client_id])
+            _apigw.CfnUsagePlanKey(
+                self,
+                f"usagePlanKey-{app_client['name']}",
+                key_id=api_key.key_id,
+                key_type="API_KEY",
+                usage_plan_id=api_usage_plans[plan_name].usage_plan_id
+            )
+
+        # The function turns away a caller whose request was metered on
+        # another app client's key
+        premium_content_fn.add_environment(
+            "API_KEY_CLIENTS", self.to_json_string(api_key_clients))
+        # Keys the consumer reads the generated values of
+        self.api_key_clients = api_key_clients if authorizer_mode != "lambda" else []
+
         # Add the wall to the garden - API Authorizer
-        api_01_authorizer = _apigw.CfnAuthorizer(
-            self,
-            "walledGardenApiAuthorizer",
-            name="walledGardenSentry",
-            rest_api_id=api_01.rest_api_id,
-            type="COGNITO_USER_POOLS",
-            provider_arns=[unicorn_user_pool_arn],
-            authorizer_result_ttl_in_seconds=15,
-            identity_source="method.request.header.Authorization"
-        )
+        if authorizer_mode == "lambda":
+            # Verify the tokens locally in a Lambda, against the user pool signing keys
+            api_authorizer_fn = _lambda.Function(
+                self,
+                "apiAuthorizerFunction",
+                function_name="premium_api_authorizer",
+                runtime=perf_profile.runtime,
+                memory_size=perf_profile.memory_size,
+                handler="api_authorizer.lambda_handler",
+                code=_lambda.Code.from_asset(api_authorizer_asset),
+                layers=[shared_layer],
+                timeout=core.Duration.seconds(3),
+                environment={
+                    "LOG_LEVEL": "INFO",
+                    "Environment": "Production",
+                    "USER_POOL_ID": core.Fn.select(1, core.Fn.split("/", unicorn_user_pool_arn)),
+                    "USER_POOL_REGION": core.Aws.REGION,
+                    # Tokens of the other app clients of the pool are rejected
+                    "ALLOWED_CLIENT_IDS": core.Fn.join(",", list(app_client_ids.values())),
+                    "ROUTE_POLICY": route_policy.to_json(),
+                    "AUTHORIZER_POLICY": authorizer_policy,
+                    **revocation_env
+                }
+            )
+            perf_profile.set_architecture(api_authorizer_fn)
+            if revocation_table:
+                revocation_table.grant_read_data(api_authorizer_fn)
+            api_authorizer_fn_lg = _logs.LogGroup(
+                self,
+                "apiAuthorizerFnLoggroup",
+                log_group_name=f"/aws/lambda/{api_authorizer_fn.function_name}",
+                retention=_logs.RetentionDays.ONE_WEEK,
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+            api_01_authorizer = _apigw.TokenAuthorizer(
+                self,
+                "walledGardenApiLambdaAuthorizer",
+                authorizer_name="walledGardenSentry",
+                handler=api_authorizer_fn,
+                results_cache_ttl=core.Duration.seconds(authorizer_results_ttl),
+                identity_source="method.request.header.Authorization"
+            )
+        else:
+            api_01_authorizer = _apigw.CfnAuthorizer(
+                self,
+                "walledGardenApiAuthorizer",
+                name="walledGardenSentry",
+                rest_api_id=api_01.rest_api_id,
+                type="COGNITO_USER_POOLS",
+                provider_arns=[unicorn_user_pool_arn],
+                authorizer_result_ttl_in_seconds=15,
+                identity_source="method.request.header.Authorization"
+            )
 
-        get_content = api_01.root.add_resource("home")
-        # premium_content = get_content.add_resource("{premium}")
-        premium_content = get_content.add_resource("premium")
-        premium_content_method_get = premium_content.add_method(
-            "GET",
-            authorization_type=_apigw.AuthorizationType.COGNITO,
-            authorization_scopes=[
-                f"{unicorn_user_pool_res_srv_identifier}/{unicorn_read_scope}"
-            ]
-        )
+        for http_method, resource_path in route_policy.routes():
+            api_resource = api_01.root.resource_for_path(resource_path)
+            method_options = {"api_key_required": True}
+            if api_cache_enabled and http_method == "GET":
+                method_options = {
+                    **method_options,
+                    "integration": _apigw.LambdaIntegration(
+                        premium_content_fn_target,
+                        cache_key_parameters=cache_key_parameters
+                    ),
+                    # Only the token is required
+                    "request_parameters": {
+                        p: p.endswith(".Authorization") for p in cache_key_parameters}
+                }
+            if authorizer_mode == "lambda":
+                api_resource.add_method(
+                    http_method, authorizer=api_01_authorizer, **method_options)
+            else:
+                api_method = api_resource.add_method(
+                    http_method,
+                    authorization_type=_apigw.AuthorizationType.COGNITO,
+                    authorization_scopes=route_policy.scopes_for(
+                        http_method, resource_path),
+                    **method_options
+                )
+                api_method.node.find_child("Resource").add_property_override(
+                    "AuthorizerId", api_01_authorizer.ref)
 
-        premium_content_method_get.node.find_child("Resource").add_property_override(
-            "AuthorizerId", api_01_authorizer.ref)
-        # Add POST method
-        premium_content_method_post = premium_content.add_method(
-            "POST",
-            authorization_type=_apigw.AuthorizationType.COGNITO,
-            authorization_scopes=[
-                f"{unicorn_user_pool_res_srv_identifier}/{unicorn_write_scope}"
-            ]
-        )
-        premium_content_method_post.node.find_child("Resource").add_property_override(
-            "AuthorizerId", api_01_authorizer.ref)
+        premium_content = api_01.root.resource_for_path("/home/premium")
+        premium_content_batch = api_01.root.resource_for_path(
+            "/home/premium/batch")
 
         # Export API Endpoint URL
         self.premium_content_api_url = premium_content.url
+        self.premium_content_batch_api_url = premium_content_batch.url
 
         # Outputs
         output_1 = core.CfnOutput(self,
@@ -121,3 +395,14 @@ class PremiumApiStack(core.Stack):
                                   value=f"{premium_content.url}",
                                   description="Use a browser to access this url"
                                   )
+        output_2 = core.CfnOutput(self,
+                                  "PremiumBatchApiUrl",
+                                  value=f"{premium_content_batch.url}",
+                                  description="POST a list of items to fetch them in one call"
+                                  )
+        if revocation_table:
+            output_3 = core.CfnOutput(self,
+                                      "RevocationTableName",
+                                      value=f"{revocation_table.table_name}",
+                                      description="Revoke tokens with premium_api/lambda_src/revocation.py --table"
+                                      )
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Puts the function and layer code on the path the way the lambda runtime
+does, `/var/task` & `/opt/python`, so the tests import the modules by the
+names the handlers use.
+"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for _p in (
+    # The CDK app's own modules, `bundling` etc.
+    ROOT_DIR,
+    os.path.join(ROOT_DIR, "lambda_layers", "shared", "python"),
+    os.path.join(ROOT_DIR, "api_consumers", "lambda_src"),
+    os.path.join(ROOT_DIR, "premium_api", "lambda_src"),
+    os.path.join(ROOT_DIR, "cognito_identity_provider", "app_client_secret_rotation", "lambda_src"),
+    os.path.join(ROOT_DIR, "benchmarks"),
+):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def signing_key():
+    """ RSA key signing the test tokens, smaller than Cognito's to keep the suite quick """
+    from rsa_keys import RsaPrivateKey
+    return RsaPrivateKey(kid="test-key", bits=1024)
@@ -0,0 +1,154 @@
+import importlib
+import json
+
+import pytest
+
+from shared.api_request import ApiRequest
+
+
+class FakeResponse:
+    def __init__(self, status, body=b"", headers=None):
+        self.status = status
+        self.raw = body
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def consumers(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("PREMIUM_CONTENT_API_URL", "https://premium.example/prod/home/premium")
+    import content_consumers
+    content_consumers = importlib.reload(content_consumers)
+    # Each client's token is its id, the api answers from `responses`
+    monkeypatch.setattr(
+        content_consumers, "_auth_headers",
+        lambda client, scope: (client or "default", {"Authorization": client or "default"}))
+    content_consumers.calls = []
+    content_consumers.responses = []
+
+    def _premium_request(method, url, headers, deadline, body=None, idempotent=True):
+        content_consumers.calls.append(dict(headers))
+        resp = content_consumers.responses.pop(0)
+        return resp, resp.raw
+    monkeypatch.setattr(content_consumers, "_premium_request", _premium_request)
+    return content_consumers
+
+
+def _read(consumers, client=None):
+    headers = {"x-client-id": client} if client else {}
+    return consumers.get_content(ApiRequest("GET", "/content/authorized-read", headers=headers))
+
+
+def _ok(message, etag):
+    return FakeResponse(200, json.dumps({"message": message}).encode(),
+                        {"Content-Type": "text/plain", "ETag": etag})
+
+
+def test_unchanged_content_is_revalidated(consumers):
+    consumers.responses = [_ok("hello", '"v1"'), FakeResponse(304)]
+    assert _read(consumers) == "hello"
+    assert _read(consumers) == "hello"
+    assert "If-None-Match" not in consumers.calls[0]
+    assert consumers.calls[1]["If-None-Match"] == '"v1"'
+
+
+def test_etags_are_kept_per_client(consumers, monkeypatch):
+    monkeypatch.setattr(consumers.global_args, "CLIENT_SELECTION",
+                        {"/content/authorized-read": ["*"]})
+    consumers.responses = [_ok("for a", '"a1"'), _ok("for b", '"b1"')]
+    assert _read(consumers, "client-a") == "for a"
+    # Another client's ETag is never sent, nor its content served back
+    assert _read(consumers, "client-b") == "for b"
+    assert "If-None-Match" not in consumers.calls[1]
+
+
+def test_not_modified_without_a_cached_copy_is_an_error(consumers):
+    consumers.responses = [FakeResponse(304)]
+    with pytest.raises(consumers.DependencyError) as e:
+        _read(consumers)
+    assert e.value.status_code == 502
+
+
+def _event(resource):
+    return {"resource": resource, "path": resource, "httpMethod": "GET", "headers": {},
+            "requestContext": {"resourcePath": resource, "httpMethod": "GET"}}
+
+
+@pytest.mark.parametrize("status", [401, 403, 404, 405])
+def test_premium_api_errors_are_relayed_with_their_status(consumers, status):
+    consumers.responses = [FakeResponse(
+        status, json.dumps({"message": "Unauthorized"}).encode(),
+        {"Content-Type": "application/json"})]
+    resp = consumers.lambda_handler(_event("/content/unauthorized-read"), None)
+    assert resp["statusCode"] == status
+    assert "Unauthorized" in json.loads(resp["body"])["message"]
+
+
+def test_empty_premium_api_body_is_an_error(consumers):
+    consumers.responses = [FakeResponse(200, b"", {"Content-Type": "application/json"})]
+    with pytest.raises(consumers.DependencyError) as e:
+        _read(consumers)
+    assert e.value.status_code == 502
+
+
+def test_batch_errors_are_relayed_with_their_status(consumers):
+    consumers.responses = [FakeResponse(
+        413, json.dumps({"message": "Too many items"}).encode())]
+    resp = consumers.lambda_handler(_event("/content/authorized-batch-read"), None)
+    assert resp["statusCode"] == 413
+
+
+def test_aggregate_reports_each_routes_status(consumers, monkeypatch):
+    monkeypatch.setattr(consumers.global_args, "FANOUT_ROUTES",
+                        ["/content/unauthorized-read", "/content/authorized-read"])
+    body = json.dumps({"message": "Unauthorized"}).encode()
+    consumers.responses = [FakeResponse(401, body), FakeResponse(401, body)]
+    resp = consumers.lambda_handler(_event("/content/aggregate"), None)
+    assert resp["statusCode"] == 200
+    assert [_r["status_code"] for _r in json.loads(resp["body"])["message"]] == [401, 401]
+
+
+@pytest.fixture
+def selectable(consumers, monkeypatch):
+    monkeypatch.setattr(consumers.global_args, "CLIENT_SELECTION",
+                        {"/content/authorized-read": ["client-a"]})
+    consumers.responses = [_ok("hello", '"v1"')]
+    return consumers
+
+
+def test_listed_client_is_selected(selectable):
+    _read(selectable, "client-a")
+    assert selectable.calls[0]["Authorization"] == "client-a"
+
+
+@pytest.mark.parametrize("client", ["client-b", "*"])
+def test_unlisted_client_gets_the_default(selectable, client):
+    _read(selectable, client)
+    assert selectable.calls[0]["Authorization"] == "default"
+
+
+def test_selection_is_per_route(selectable):
+    selectable.get_content(ApiRequest(
+        "POST", "/content/authorized-write", query={"client": "client-a"}))
+    assert selectable.calls[0]["Authorization"] == "default"
+
+
+class FakeApiGateway:
+    def __init__(self):
+        self.calls = []
+
+    def get_api_key(self, apiKey, includeValue):
+        self.calls.append(apiKey)
+        return {"id": apiKey, "value": f"value-of-{apiKey}"}
+
+
+def test_generated_api_keys_are_read_once(consumers, monkeypatch):
+    apigw = FakeApiGateway()
+    monkeypatch.setattr(consumers.aws_clients, "client", lambda service_name: apigw)
+    monkeypatch.setattr(consumers, "_api_key_ids", {"client-a": "key-a"})
+
+    assert consumers._api_key("client-a") == "value-of-key-a"
+    assert consumers._api_key("client-a") == "value-of-key-a"
+    assert apigw.calls == ["key-a"]
+    # Clients without a generated key send their client id
+    assert consumers._api_key("client-b") == "client-b"
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+from fanout_client import Deadline, DeadlineExceeded, FanoutClient
+
+
+class Concurrency:
+    """ Calls that sleep `seconds`, counting how many run at once """
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+        self.timeouts = []
+        self._lock = threading.Lock()
+
+    def call(self, value, seconds=0.02):
+        def fn(timeout):
+            with self._lock:
+                self.timeouts.append(timeout)
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            try:
+                time.sleep(seconds)
+            finally:
+                with self._lock:
+                    self.running -= 1
+            return value
+        return fn
+
+
+def _failing(error):
+    def fn(timeout):
+        raise error
+    return fn
+
+
+@pytest.fixture
+def fanout():
+    return FanoutClient(max_concurrency=2)
+
+
+def test_calls_run_concurrently_in_call_order(fanout):
+    c = Concurrency()
+    started = time.perf_counter()
+    results = fanout.run({k: c.call(k, 0.2) for k in ("a", "b")}, Deadline(2))
+    elapsed = time.perf_counter() - started
+    assert list(results) == ["a", "b"]
+    assert [r.value for r in results.values()] == ["a", "b"]
+    assert all(r.ok and r.elapsed_ms >= 200 for r in results.values())
+    # Slowest call, not the sum
+    assert elapsed < 0.35
+
+
+def test_concurrency_is_bounded(fanout):
+    c = Concurrency()
+    results = fanout.run({str(i): c.call(i) for i in range(6)}, Deadline(2))
+    assert all(r.ok for r in results.values())
+    assert c.peak == 2
+
+
+def test_calls_get_the_time_left_as_their_timeout(fanout):
+    c = Concurrency()
+    fanout.run({"a": c.call("a")}, Deadline(1))
+    assert 0.9 < c.timeouts[0] <= 1
+
+
+def test_a_failing_call_does_not_fail_the_others(fanout):
+    error = ValueError("premium api down")
+    c = Concurrency()
+    results = fanout.run({"ok": c.call("ok"), "bad": _failing(error)}, Deadline(2))
+    assert results["ok"].ok and results["ok"].value == "ok"
+    assert not results["bad"].ok and results["bad"].error is error
+
+
+def test_calls_past_the_deadline_are_cancelled(fanout):
+    c = Concurrency()
+    started = time.perf_counter()
+    results = fanout.run({"fast": c.call("fast", 0.01), "slow": c.call("slow", 1)}, Deadline(0.15))
+    # The invocation does not wait for the slow call
+    assert time.perf_counter() - started < 0.5
+    assert results["fast"].ok
+    assert isinstance(results["slow"].error, DeadlineExceeded)
+
+
+def test_queued_calls_are_not_started_after_the_deadline():
+    fanout = FanoutClient(max_concurrency=1)
+    c = Concurrency()
+    results = fanout.run({"slow": c.call("slow", 1), "queued": c.call("queued")}, Deadline(0.1))
+    assert all(isinstance(r.error, DeadlineExceeded) for r in results.values())
+    assert len(c.timeouts) == 1
+
+
+def test_spent_deadline_starts_nothing(fanout):
+    c = Concurrency()
+    results = fanout.run({"a": c.call("a")}, Deadline(0))
+    assert isinstance(results["a"].error, DeadlineExceeded)
+    assert c.timeouts == []
+
+
+def test_the_loop_is_reused_across_invocations(fanout):
+    c = Concurrency()
+    fanout.run({"a": c.call("a")}, Deadline(1))
+    loop = fanout._loop
+    assert fanout.run({}, Deadline(1)) == {}
+    assert fanout.run({"b": c.call("b")}, Deadline(1))["b"].value == "b"
+    assert fanout._loop is loop
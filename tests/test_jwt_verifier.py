@@ -0,0 +1,237 @@
+import importlib
+import time
+
+import pytest
+
+from jwt_verifier import JwksCache, JwtVerificationError, JwtVerifier, claim_time
+from rsa_keys import RsaPrivateKey, access_token_claims
+from route_policy import CompiledRoutePolicy
+
+ISSUER = "https://cognito-idp.us-east-1.amazonaws.com/us-east-1_test"
+STAGE_ARN = "arn:aws:execute-api:us-east-1:111111111111:api/prod"
+
+
+@pytest.fixture
+def jwks(signing_key):
+    _j = JwksCache(f"{ISSUER}/.well-known/jwks.json")
+    _j.load({"keys": [signing_key.jwk()]})
+    return _j
+
+
+def _token(key, client_id="client-a", scope="premium_api/read", **extra):
+    return key.encode_jwt(access_token_claims(ISSUER, client_id, scope, **extra))
+
+
+def test_valid_token_returns_its_claims(signing_key, jwks):
+    claims = JwtVerifier(ISSUER, jwks).verify(_token(signing_key))
+    assert claims["client_id"] == "client-a"
+    assert claims["scope"] == "premium_api/read"
+
+
+@pytest.mark.parametrize("extra, reason", [
+    ({"expires_in": -1}, "Token expired"),
+    ({"iss": "https://issuer.example.com"}, "Invalid issuer"),
+    ({"token_use": "id"}, "Invalid token_use"),
+])
+def test_claim_checks(signing_key, jwks, extra, reason):
+    claims = access_token_claims(ISSUER, "client-a", "premium_api/read",
+                                 **{k: v for k, v in extra.items() if k != "expires_in"},
+                                 expires_in=extra.get("expires_in", 3600))
+    with pytest.raises(JwtVerificationError, match=reason):
+        JwtVerifier(ISSUER, jwks).verify(signing_key.encode_jwt(claims))
+
+
+def test_tampered_token_is_rejected(signing_key, jwks):
+    header, payload, signature = _token(signing_key).split(".")
+    forged = _token(signing_key, scope="premium_api/read premium_api/write").split(".")[1]
+    with pytest.raises(JwtVerificationError, match="Invalid signature"):
+        JwtVerifier(ISSUER, jwks).verify(f"{header}.{forged}.{signature}")
+
+
+def test_token_of_unknown_key_is_rejected(jwks):
+    # The last fetch of the signing keys was just now, no re-fetch
+    other = RsaPrivateKey(kid="other-key", bits=512)
+    with pytest.raises(JwtVerificationError, match="Unknown signing key"):
+        JwtVerifier(ISSUER, jwks).verify(_token(other))
+
+
+@pytest.mark.parametrize("token", ["", "abc", "a.b.c"])
+def test_malformed_token_is_rejected(jwks, token):
+    with pytest.raises(JwtVerificationError):
+        JwtVerifier(ISSUER, jwks).verify(token)
+
+
+def test_client_ids_allow_list(signing_key, jwks):
+    verifier = JwtVerifier(ISSUER, jwks, client_ids=["client-a"])
+    assert verifier.verify(_token(signing_key, "client-a"))["client_id"] == "client-a"
+    with pytest.raises(JwtVerificationError, match="Invalid client_id"):
+        verifier.verify(_token(signing_key, "client-b"))
+
+
+def test_empty_client_ids_allow_no_client(signing_key, jwks):
+    with pytest.raises(JwtVerificationError, match="Invalid client_id"):
+        JwtVerifier(ISSUER, jwks, client_ids=[]).verify(_token(signing_key))
+
+
+def test_cached_token_is_rejected_once_expired(signing_key, jwks):
+    verifier = JwtVerifier(ISSUER, jwks)
+    token = _token(signing_key, expires_in=1)
+    assert verifier.verify(token) is verifier.verify(token)
+    verifier._verified[next(iter(verifier._verified))]["exp"] = time.time() - 1
+    with pytest.raises(JwtVerificationError, match="Token expired"):
+        verifier.verify(token)
+
+
+def test_claim_time_reads_epochs_and_dates():
+    assert claim_time(1593000000) == 1593000000.0
+    assert claim_time("1593000000") == 1593000000.0
+    assert claim_time("Wed Jun 24 12:00:00 UTC 2020") == 1593000000.0
+    assert claim_time(None) == 0.0
+
+
+READ, WRITE = "premium_api/read", "premium_api/write"
+ROUTES = [
+    ("GET", "/home/premium", [READ]),
+    ("POST", "/home/premium", [WRITE]),
+    ("POST", "/home/premium/batch", [READ]),
+]
+
+
+@pytest.fixture
+def authorizer(monkeypatch, signing_key):
+    """ `api_authorizer` imported with the environment the stack gives it """
+    def _load(allowed_client_ids, routes=ROUTES[:1], policy="aggregated", max_entries=1024):
+        monkeypatch.setenv("LOG_LEVEL", "ERROR")
+        monkeypatch.setenv("USER_POOL_ID", "us-east-1_test")
+        monkeypatch.setenv("USER_POOL_REGION", "us-east-1")
+        monkeypatch.setenv("ALLOWED_CLIENT_IDS", allowed_client_ids)
+        monkeypatch.setenv("ROUTE_POLICY", CompiledRoutePolicy(routes).to_json())
+        monkeypatch.setenv("AUTHORIZER_POLICY", policy)
+        monkeypatch.setenv("DECISION_CACHE_MAX_ENTRIES", str(max_entries))
+        import api_authorizer
+        module = importlib.reload(api_authorizer)
+        module._verifier.jwks.load({"keys": [signing_key.jwk()]})
+        # Tokens the decisions were not served from the cache for
+        module.verified = []
+        _verify = module._verifier.verify
+
+        def verify(token):
+            module.verified.append(token)
+            return _verify(token)
+        monkeypatch.setattr(module._verifier, "verify", verify)
+        return module
+    return _load
+
+
+def _authorize(module, token, method="GET/home/premium"):
+    return module.lambda_handler(
+        {"type": "TOKEN", "authorizationToken": token,
+         "methodArn": f"{STAGE_ARN}/{method}"}, None)
+
+
+def _statement(response):
+    _s = response["policyDocument"]["Statement"][0]
+    return _s["Effect"], _s["Resource"]
+
+
+def test_authorizer_only_allows_the_listed_clients(authorizer, signing_key):
+    module = authorizer("client-a,client-b")
+    response = _authorize(module, _token(signing_key, "client-b"))
+    assert response["policyDocument"]["Statement"][0]["Effect"] == "Allow"
+    with pytest.raises(Exception, match="Unauthorized"):
+        _authorize(module, _token(signing_key, "client-c"))
+
+
+def test_authorizer_without_allowed_clients_fails_closed(authorizer, signing_key):
+    module = authorizer("")
+    with pytest.raises(Exception, match="Unauthorized"):
+        _authorize(module, _token(signing_key, "client-a"))
+
+
+def test_aggregated_policy_lists_the_allowed_methods_only(authorizer, signing_key):
+    module = authorizer("client-a", routes=ROUTES)
+    assert _statement(_authorize(module, _token(signing_key, scope=READ))) == ("Allow", [
+        f"{STAGE_ARN}/GET/home/premium", f"{STAGE_ARN}/POST/home/premium/batch"])
+    assert _statement(_authorize(module, _token(signing_key, scope=WRITE))) == (
+        "Allow", [f"{STAGE_ARN}/POST/home/premium"])
+
+
+def test_aggregated_policy_is_the_stage_when_every_method_is_allowed(authorizer, signing_key):
+    module = authorizer("client-a", routes=ROUTES)
+    token = _token(signing_key, scope=f"{READ} {WRITE}")
+    assert _statement(_authorize(module, token)) == ("Allow", [f"{STAGE_ARN}/*"])
+
+
+def test_aggregated_policy_denies_tokens_without_known_scopes(authorizer, signing_key):
+    module = authorizer("client-a", routes=ROUTES)
+    assert _statement(_authorize(module, _token(signing_key, scope="openid"))) == (
+        "Deny", [f"{STAGE_ARN}/*"])
+
+
+def test_method_policy_covers_the_method_called(authorizer, signing_key):
+    module = authorizer("client-a", routes=ROUTES, policy="method")
+    token = _token(signing_key, scope=READ)
+    assert _statement(_authorize(module, token)) == ("Allow", f"{STAGE_ARN}/GET/home/premium")
+    assert _statement(_authorize(module, token, "POST/home/premium")) == (
+        "Deny", f"{STAGE_ARN}/POST/home/premium")
+    # A decision per method
+    assert len(module.verified) == 2
+
+
+def test_aggregated_decision_serves_every_method_of_the_stage(authorizer, signing_key):
+    module = authorizer("client-a", routes=ROUTES)
+    token = _token(signing_key, scope=READ)
+    first = _authorize(module, token)
+    assert _authorize(module, token, "POST/home/premium/batch") is first
+    assert module.verified == [token]
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def test_decision_lapses_when_the_token_expires(authorizer, signing_key, monkeypatch):
+    module = authorizer("client-a")
+    token = _token(signing_key, expires_in=60)
+    clock = Clock(time.time())
+    monkeypatch.setattr(module, "time", clock)
+    _authorize(module, token)
+    _authorize(module, token)
+    assert module.verified == [token]
+
+    exp = next(iter(module._decisions._entries.values())).claims["exp"]
+    clock.now = exp - 1
+    _authorize(module, token)
+    assert module.verified == [token]
+    # Not served from the cache at `exp`, the token is verified again
+    clock.now = exp
+    _authorize(module, token)
+    assert module.verified == [token, token]
+
+
+def test_least_recently_used_decision_is_evicted(authorizer, signing_key):
+    module = authorizer("client-a", max_entries=2)
+    a, b, c = (_token(signing_key) for _ in range(3))
+    _authorize(module, a)
+    _authorize(module, b)
+    # `a` used last, `b` goes when `c` comes in
+    _authorize(module, a)
+    _authorize(module, c)
+    assert len(module._decisions) == 2
+    _authorize(module, a)
+    assert module.verified == [a, b, c]
+    _authorize(module, b)
+    assert module.verified == [a, b, c, b]
+
+
+def test_decision_cache_can_be_turned_off(authorizer, signing_key):
+    module = authorizer("client-a", max_entries=0)
+    token = _token(signing_key)
+    _authorize(module, token)
+    _authorize(module, token)
+    assert module.verified == [token, token]
+    assert len(module._decisions) == 0
@@ -0,0 +1,37 @@
+import logging
+import os
+
+from bundling.lambda_bundle import AssetBundler, module_closure
+
+from conftest import ROOT_DIR
+
+
+SECRET_ROTATION_DIR = os.path.join(
+    ROOT_DIR, "cognito_identity_provider", "app_client_secret_rotation", "lambda_src")
+SHARED_LAYER_DIR = os.path.join(ROOT_DIR, "lambda_layers", "shared")
+
+
+def test_closure_follows_imports_into_the_layer():
+    _layer_root = os.path.join(SHARED_LAYER_DIR, "python")
+    found = module_closure("secret_rotation", [SECRET_ROTATION_DIR, _layer_root])
+    assert found[SECRET_ROTATION_DIR] == {"secret_rotation.py"}
+    assert os.path.join("shared", "aws_clients.py") in found[_layer_root]
+    assert os.path.join("shared", "__init__.py") in found[_layer_root]
+    # Modules no function imports stay out of the layer
+    assert os.path.join("shared", "rate_limiter.py") not in found[_layer_root]
+
+
+def test_layer_holds_what_the_functions_import(tmp_path):
+    bundler = AssetBundler(str(tmp_path), (3, 12), [SHARED_LAYER_DIR], compile_modules=False)
+    out_dir = bundler.function("secret_rotation", SECRET_ROTATION_DIR, "secret_rotation")
+    assert os.listdir(out_dir) == ["secret_rotation.py"]
+    layer_dir = bundler.layer("shared_layer", SHARED_LAYER_DIR)
+    assert os.path.isfile(os.path.join(layer_dir, "python", "shared", "http_client.py"))
+    assert not os.path.exists(os.path.join(layer_dir, "python", "shared", "rate_limiter.py"))
+
+
+def test_missing_python_is_logged(tmp_path, caplog):
+    caplog.set_level(logging.WARNING)
+    bundler = AssetBundler(str(tmp_path), (2, 1), [SHARED_LAYER_DIR])
+    bundler.function("secret_rotation", SECRET_ROTATION_DIR, "secret_rotation")
+    assert "No python2.1 to byte-compile" in caplog.text
@@ -0,0 +1,153 @@
+import base64
+import importlib
+import json
+import time
+
+import pytest
+
+from route_policy import CompiledRoutePolicy
+
+READ, WRITE = "premium_api/read", "premium_api/write"
+
+
+@pytest.fixture
+def premium_content(monkeypatch):
+    monkeypatch.setenv("API_KEY_CLIENTS", json.dumps([["key-a", "client-a"], ["key-b", "client-b"]]))
+    import premium_content
+    yield importlib.reload(premium_content)
+    # Later tests get the module of the default settings
+    monkeypatch.undo()
+    importlib.reload(premium_content)
+
+
+def _event(client_id, api_key_id, http_method="GET", resource="/home/premium",
+           body=None, scope=READ):
+    return {
+        "httpMethod": http_method,
+        "resource": resource,
+        "headers": {},
+        "body": body,
+        "requestContext": {
+            "httpMethod": http_method,
+            "resourcePath": resource,
+            "identity": {"apiKeyId": api_key_id},
+            "authorizer": {"claims": {
+                "client_id": client_id,
+                "scope": scope,
+                "jti": f"{client_id}-jti",
+                "iat": str(int(time.time())),
+                "exp": str(int(time.time()) + 3600)
+            }}
+        }
+    }
+
+
+def test_request_metered_on_the_callers_key_is_served(premium_content):
+    resp = premium_content.lambda_handler(_event("client-a", "key-a"), None)
+    assert resp["statusCode"] == 200
+
+
+@pytest.mark.parametrize("api_key_id", ["key-b", "unknown-key", None])
+def test_request_metered_on_another_key_is_forbidden(premium_content, api_key_id):
+    resp = premium_content.lambda_handler(_event("client-a", api_key_id), None)
+    assert resp["statusCode"] == 403
+
+
+def test_key_check_is_skipped_without_keys(premium_content, monkeypatch):
+    monkeypatch.setattr(premium_content, "_api_key_clients", {})
+    resp = premium_content.lambda_handler(_event("client-a", None), None)
+    assert resp["statusCode"] == 200
+
+
+def test_revoked_token_is_rejected_after_the_refresh(monkeypatch):
+    monkeypatch.setenv("REVOCATION_STORE", "memory")
+    monkeypatch.setenv("REVOCATION_REFRESH_SECONDS", "10")
+    import premium_content
+    premium_content = importlib.reload(premium_content)
+    try:
+        event = _event("client-a", "key-a")
+        assert premium_content.lambda_handler(event, None)["statusCode"] == 200
+
+        from revocation import Revocation
+        premium_content._revocations.store.put(
+            Revocation("jti", "client-a-jti", expires_at=time.time() + 3600))
+        # Still allowed until the list is refreshed
+        assert premium_content.lambda_handler(event, None)["statusCode"] == 200
+
+        premium_content._revocations._next_refresh = 0
+        resp = premium_content.lambda_handler(event, None)
+        assert resp["statusCode"] == 401
+        # Other tokens of the client are not affected
+        event["requestContext"]["authorizer"]["claims"]["jti"] = "another-jti"
+        assert premium_content.lambda_handler(event, None)["statusCode"] == 200
+    finally:
+        monkeypatch.undo()
+        importlib.reload(premium_content)
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    monkeypatch.setenv("ROUTE_POLICY", CompiledRoutePolicy([
+        ("GET", "/home/premium", [READ]),
+        ("POST", "/home/premium", [WRITE]),
+        ("POST", "/home/premium/batch", [READ]),
+    ]).to_json())
+    monkeypatch.setenv("MAX_BATCH_ITEMS", "3")
+    monkeypatch.setenv("RATE_LIMITS", json.dumps(
+        {"GET /home/premium": {"rate_limit": 1, "burst_limit": 2}}))
+    import premium_content
+    premium_content = importlib.reload(premium_content)
+
+    def _call(items=None, body=None, scope=READ, client_id="client-a", encode=False):
+        if body is None:
+            body = json.dumps({"items": items})
+        event = _event(client_id, None, "POST", "/home/premium/batch", body, scope)
+        if encode:
+            # binary_media_types "*/*", API Gateway hands every body over base64 encoded
+            event["body"] = base64.b64encode(body.encode()).decode()
+            event["isBase64Encoded"] = True
+        resp = premium_content.lambda_handler(event, None)
+        if resp["statusCode"] != 207:
+            return resp["statusCode"], None
+        return 207, [(_r["id"], _r["status"]) for _r in json.loads(resp["body"])["responses"]]
+    yield _call
+    monkeypatch.undo()
+    importlib.reload(premium_content)
+
+
+def test_batch_items_are_authorized_one_by_one(batch):
+    status, items = batch([
+        {"id": "read", "method": "GET", "path": "/home/premium"},
+        {"id": "write", "method": "POST", "path": "/home/premium", "body": {"x": 1}},
+    ])
+    assert status == 207
+    assert items == [("read", 200), ("write", 403)]
+
+
+def test_batch_items_of_unknown_routes(batch):
+    _, items = batch([
+        {"id": "missing", "method": "GET", "path": "/home/other"},
+        {"id": "method", "method": "DELETE", "path": "/home/premium"},
+        {"id": "nested", "method": "POST", "path": "/home/premium/batch"},
+    ])
+    assert [_s for _, _s in items] == [404, 405, 400]
+
+
+def test_batch_items_are_rate_limited(batch):
+    _, items = batch([{"id": str(i), "method": "GET", "path": "/home/premium"} for i in range(3)])
+    assert [_s for _, _s in items] == [200, 200, 429]
+
+
+def test_batch_item_cap(batch):
+    status, _ = batch([{"id": str(i), "method": "GET", "path": "/home/premium"} for i in range(4)])
+    assert status == 413
+
+
+@pytest.mark.parametrize("body", ["not json", json.dumps({"items": "x"}), json.dumps({"other": []}), ""])
+def test_malformed_batch_is_rejected(batch, body):
+    assert batch(body=body)[0] == 400
+
+
+def test_base64_encoded_batch_is_served(batch):
+    _, items = batch([{"id": "read", "method": "GET", "path": "/home/premium"}], encode=True)
+    assert items == [("read", 200)]
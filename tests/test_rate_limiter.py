@@ -0,0 +1,147 @@
+import logging
+
+import pytest
+
+from shared import rate_limiter
+from shared.rate_limiter import (InMemoryBucketStore, RateLimit, RateLimiter,
+                                 SqliteBucketStore, bucket_store_from_uri)
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    _c = Clock()
+    monkeypatch.setattr(rate_limiter, "time", _c)
+    return _c
+
+
+class CountingStore:
+    """ Bucket store counting the takes that reach it, or failing them """
+
+    def __init__(self, store=None, error=None):
+        self.store = store or InMemoryBucketStore()
+        self.error = error
+        self.takes = 0
+
+    def take(self, *args):
+        self.takes += 1
+        if self.error:
+            raise self.error
+        return self.store.take(*args)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryBucketStore()
+    return SqliteBucketStore(str(tmp_path / "buckets.db"))
+
+
+def test_bucket_allows_the_burst_then_refills(store):
+    # 2 a second, 4 at once
+    interval, tolerance = 0.5, 2.0
+    assert [store.take("k", 1, interval, tolerance, 0.0) for _ in range(4)] == [0] * 4
+    assert store.take("k", 1, interval, tolerance, 0.0) == pytest.approx(0.5)
+    # A token back every interval
+    assert store.take("k", 1, interval, tolerance, 0.5) == 0
+    assert store.take("k", 1, interval, tolerance, 0.5) > 0
+    # Other buckets are untouched
+    assert store.take("other", 4, interval, tolerance, 0.5) == 0
+
+
+def test_bucket_does_not_take_more_than_it_holds(store):
+    assert store.take("k", 3, 0.5, 2.0, 0.0) == 0
+    assert store.take("k", 2, 0.5, 2.0, 0.0) == pytest.approx(0.5)
+    assert store.take("k", 1, 0.5, 2.0, 0.0) == 0
+
+
+def _limiter(store, rate_limit=1, burst_limit=3, lease_seconds=0):
+    return RateLimiter(
+        {"POST /home/premium": {"rate_limit": rate_limit, "burst_limit": burst_limit}},
+        store=store, lease_seconds=lease_seconds, max_lease=10)
+
+
+def test_client_over_its_limit_waits(clock):
+    limiter = _limiter(InMemoryBucketStore())
+    assert [limiter.check("a", "POST", "/home/premium") for _ in range(3)] == [0] * 3
+    assert limiter.check("a", "POST", "/home/premium") == pytest.approx(1)
+    # Limits are per client & route
+    assert limiter.check("b", "POST", "/home/premium") == 0
+    assert limiter.check("a", "GET", "/home/premium") == 0
+
+    clock.now += 1
+    assert limiter.check("a", "POST", "/home/premium") == 0
+
+
+def test_denials_are_remembered_until_the_bucket_refills(clock):
+    store = CountingStore()
+    limiter = _limiter(store, burst_limit=1)
+    assert limiter.check("a", "POST", "/home/premium") == 0
+    assert limiter.check("a", "POST", "/home/premium") > 0
+    takes = store.takes
+    assert limiter.check("a", "POST", "/home/premium") > 0
+    assert store.takes == takes
+
+    clock.now += 1
+    assert limiter.check("a", "POST", "/home/premium") == 0
+    assert store.takes == takes + 1
+
+
+def test_tokens_are_taken_ahead_for_the_lease(clock):
+    store = CountingStore()
+    limiter = _limiter(store, rate_limit=5, burst_limit=10, lease_seconds=1)
+    assert [limiter.check("a", "POST", "/home/premium") for _ in range(5)] == [0] * 5
+    assert store.takes == 1
+
+    # The lease expires with whatever it had left
+    clock.now += 1.5
+    limiter.check("a", "POST", "/home/premium")
+    assert store.takes == 2
+
+
+def test_lease_falls_back_to_a_single_token(clock):
+    store = CountingStore()
+    limiter = _limiter(store, rate_limit=5, burst_limit=10, lease_seconds=1)
+    store.store.take("a:POST /home/premium", 9, 0.2, 2.0, clock.now)
+    assert limiter.check("a", "POST", "/home/premium") == 0
+    assert limiter.check("a", "POST", "/home/premium") > 0
+
+
+def test_unavailable_store_fails_open(clock, caplog):
+    caplog.set_level(logging.WARNING)
+    store = CountingStore(error=ConnectionError("table unreachable"))
+    limiter = _limiter(store, burst_limit=1)
+    assert [limiter.check("a", "POST", "/home/premium") for _ in range(3)] == [0] * 3
+    assert store.takes == 3
+    assert "Rate limit store unavailable" in caplog.text
+
+
+def test_routes_without_limits_are_not_checked(clock):
+    store = CountingStore()
+    limiter = _limiter(store)
+    assert limiter.check("a", "DELETE", "/home/premium") == 0
+    assert limiter.check("", "POST", "/home/premium") == 0
+    assert store.takes == 0
+
+    limiter = RateLimiter({"*": {"rate_limit": 1, "burst_limit": 1}}, store=store)
+    assert limiter.limit_for("DELETE", "/anything").route == "*"
+
+
+@pytest.mark.parametrize("rate_limit, burst_limit", [(0, 1), (1, 0)])
+def test_invalid_limits_are_rejected(rate_limit, burst_limit):
+    with pytest.raises(ValueError):
+        RateLimit("POST /home/premium", rate_limit, burst_limit, 1, 10)
+
+
+def test_store_from_uri(tmp_path):
+    assert isinstance(bucket_store_from_uri(""), InMemoryBucketStore)
+    assert isinstance(bucket_store_from_uri(f"sqlite:{tmp_path}/b.db"), SqliteBucketStore)
+    with pytest.raises(ValueError):
+        bucket_store_from_uri("redis:host")
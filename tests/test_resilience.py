@@ -0,0 +1,294 @@
+import threading
+
+import pytest
+
+import resilience
+from resilience import (CircuitBreaker, CircuitOpenError, DependencyError,
+                        ThrottledError, hedged_call, retry_call)
+
+
+class Clock:
+    """ `time` of the module, `sleep` moves the clock on instead of blocking """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ClockDeadline:
+    def __init__(self, clock, seconds):
+        self.clock = clock
+        self.expires_at = clock.now + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - self.clock.now)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    _c = Clock()
+    monkeypatch.setattr(resilience, "time", _c)
+    # The largest delay of each attempt, not a random one
+    monkeypatch.setattr(resilience, "backoff_delay",
+                        lambda attempt, base, cap: min(cap, base * (2 ** attempt)))
+    return _c
+
+
+class Calls:
+    """ Callable answering with `outcomes` in turn, raising the exceptions """
+
+    def __init__(self, *outcomes, clock=None, takes=0.0):
+        self.outcomes = list(outcomes)
+        self.timeouts = []
+        self.clock = clock
+        self.takes = takes
+
+    def __call__(self, timeout):
+        self.timeouts.append(timeout)
+        if self.clock is not None:
+            self.clock.now += self.takes
+        _o = self.outcomes.pop(0)
+        if isinstance(_o, Exception):
+            raise _o
+        return _o
+
+
+def _down():
+    return DependencyError("Dep", "answered 503", retryable=True)
+
+
+# Circuit breaker
+
+def test_breaker_opens_after_the_threshold(clock):
+    breaker = CircuitBreaker("Dep", failure_threshold=3, reset_timeout=10)
+    for _ in range(3):
+        with pytest.raises(DependencyError):
+            breaker.call(Calls(_down()), 1)
+    assert breaker.state == CircuitBreaker.OPEN
+    fn = Calls("ok")
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.call(fn, 1)
+    assert e.value.status_code == 503 and e.value.retry_after == 10
+    assert fn.timeouts == []
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker("Dep", failure_threshold=2)
+    with pytest.raises(DependencyError):
+        breaker.call(Calls(_down()), 1)
+    assert breaker.call(Calls("ok"), 1) == "ok"
+    with pytest.raises(DependencyError):
+        breaker.call(Calls(_down()), 1)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_answers_that_are_not_outages_keep_the_breaker_closed(clock):
+    breaker = CircuitBreaker("Dep", failure_threshold=1)
+    with pytest.raises(DependencyError):
+        breaker.call(Calls(DependencyError("Dep", "answered 403", status_code=403)), 1)
+    with pytest.raises(ValueError):
+        breaker.call(Calls(ValueError("bad json")), 1)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_breaker_lets_one_probe_through(clock):
+    breaker = CircuitBreaker("Dep", failure_threshold=1, reset_timeout=10)
+    with pytest.raises(DependencyError):
+        breaker.call(Calls(_down()), 1)
+    clock.now += 5
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 5
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # The probe is in flight, everyone else still fails fast
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker("Dep", failure_threshold=5, reset_timeout=10)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now += 10
+    with pytest.raises(DependencyError):
+        breaker.call(Calls(_down()), 1)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opened_at == clock.now
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+# Retries
+
+def test_retryable_failures_are_retried_with_backoff(clock):
+    fn = Calls(_down(), ThrottledError("Dep"), "ok")
+    assert retry_call(fn, ClockDeadline(clock, 5), attempts=3, base=0.05) == "ok"
+    assert clock.sleeps == [0.05, 0.1]
+    # Every attempt gets the time left as its timeout
+    assert fn.timeouts == [5, pytest.approx(4.95), pytest.approx(4.85)]
+
+
+def test_last_failure_is_raised_after_the_attempts(clock):
+    fn = Calls(_down(), _down(), _down(), "ok")
+    with pytest.raises(DependencyError):
+        retry_call(fn, ClockDeadline(clock, 5), attempts=3)
+    assert len(fn.timeouts) == 3
+
+
+def test_failures_that_are_not_retryable_are_raised_at_once(clock):
+    fn = Calls(DependencyError("Dep", "answered 404", status_code=404), "ok")
+    with pytest.raises(DependencyError) as e:
+        retry_call(fn, ClockDeadline(clock, 5))
+    assert e.value.status_code == 404
+    assert len(fn.timeouts) == 1 and clock.sleeps == []
+
+
+def test_retry_after_is_honoured_up_to_the_cap(clock):
+    fn = Calls(ThrottledError("Dep", retry_after=0.5), ThrottledError("Dep", retry_after=30), "ok")
+    assert retry_call(fn, ClockDeadline(clock, 5), cap=1.0) == "ok"
+    assert clock.sleeps == [0.5, 1.0]
+
+
+def test_no_retry_without_time_left_for_it(clock):
+    # Each attempt takes most of the budget
+    fn = Calls(_down(), "ok", clock=clock, takes=0.9)
+    with pytest.raises(DependencyError):
+        retry_call(fn, ClockDeadline(clock, 1.0), min_attempt_time=0.1)
+    assert len(fn.timeouts) == 1 and clock.sleeps == []
+
+
+def test_spent_deadline_is_a_timeout(clock):
+    fn = Calls("ok")
+    with pytest.raises(DependencyError) as e:
+        retry_call(fn, ClockDeadline(clock, 0))
+    assert e.value.status_code == 504
+    assert fn.timeouts == []
+
+
+def test_calls_that_are_not_idempotent_are_only_retried_when_throttled(clock):
+    # As the consumer retries a write, the request was never taken on a 429
+    only_throttled = lambda err: isinstance(err, ThrottledError)
+    fn = Calls(ThrottledError("Dep"), "ok")
+    assert retry_call(fn, ClockDeadline(clock, 5), retry_on=only_throttled) == "ok"
+    fn = Calls(_down(), "ok")
+    with pytest.raises(DependencyError):
+        retry_call(fn, ClockDeadline(clock, 5), retry_on=only_throttled)
+    assert len(fn.timeouts) == 1
+
+
+def test_retries_go_through_the_breaker(clock):
+    breaker = CircuitBreaker("Dep", failure_threshold=2, reset_timeout=10)
+    fn = Calls(_down(), _down(), "ok")
+    with pytest.raises(CircuitOpenError):
+        retry_call(fn, ClockDeadline(clock, 5), attempts=3, breaker=breaker)
+    # The third attempt failed fast, the dependency was not called
+    assert len(fn.timeouts) == 2
+
+
+# Hedged calls, on real threads
+
+class Gated:
+    """ Each call waits for its own gate, then answers with its outcome """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.gates = [threading.Event() for _ in outcomes]
+        self.started = []
+        self._lock = threading.Lock()
+
+    def __call__(self, timeout):
+        with self._lock:
+            i = len(self.started)
+            self.started.append(timeout)
+        # Past its timeout too, as a call stuck on a slow dependency does
+        self.gates[i].wait(5)
+        _o = self.outcomes[i]
+        if isinstance(_o, Exception):
+            raise _o
+        return _o
+
+
+def test_fast_answer_is_not_hedged():
+    fn = Gated("first")
+    fn.gates[0].set()
+    assert hedged_call(fn, timeout=1, hedge_after=0.5) == "first"
+    assert len(fn.started) == 1
+
+
+def test_slow_call_is_hedged_and_the_first_success_wins():
+    fn = Gated("first", "hedge")
+    fn.gates[1].set()
+    try:
+        assert hedged_call(fn, timeout=2, hedge_after=0.02) == "hedge"
+        assert len(fn.started) == 2
+        # The hedge only gets what is left of the timeout
+        assert fn.started[1] < fn.started[0]
+    finally:
+        fn.gates[0].set()
+
+
+def test_failure_before_hedging_is_raised_as_it_is():
+    error = DependencyError("Dep", "answered 403", status_code=403)
+    fn = Gated(error)
+    fn.gates[0].set()
+    with pytest.raises(DependencyError) as e:
+        hedged_call(fn, timeout=1, hedge_after=0.5)
+    assert e.value is error
+    assert len(fn.started) == 1
+
+
+def _fails_once_hedged(hedge_outcome):
+    """ The first call fails once the hedge is sent, the hedge then answers with `hedge_outcome` """
+    hedged = threading.Event()
+    first_done = threading.Event()
+    calls = []
+
+    def fn(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            hedged.wait(timeout)
+            first_done.set()
+            raise _down()
+        hedged.set()
+        first_done.wait(timeout)
+        if isinstance(hedge_outcome, Exception):
+            raise hedge_outcome
+        return hedge_outcome
+    return fn, calls
+
+
+def test_hedge_success_wins_over_a_failed_first_call():
+    fn, calls = _fails_once_hedged("hedge")
+    # The first call's failure does not shadow the hedge's success
+    assert hedged_call(fn, timeout=2, hedge_after=0.02) == "hedge"
+    assert len(calls) == 2
+
+
+def test_both_calls_failing_raises_the_failure():
+    fn, calls = _fails_once_hedged(DependencyError("Dep", "answered 502", retryable=True))
+    with pytest.raises(DependencyError) as e:
+        hedged_call(fn, timeout=2, hedge_after=0.02)
+    assert e.value.retryable and e.value.status_code == 502
+    assert len(calls) == 2
+
+
+def test_no_answer_within_the_timeout_is_a_timeout():
+    fn = Gated("first", "hedge")
+    try:
+        with pytest.raises(DependencyError) as e:
+            hedged_call(fn, timeout=0.1, hedge_after=0.02, dependency="Dep")
+        assert e.value.status_code == 504 and e.value.retryable
+    finally:
+        for _g in fn.gates:
+            _g.set()
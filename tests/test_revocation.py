@@ -0,0 +1,129 @@
+import pytest
+
+from revocation import (DenyList, InMemoryRevocationStore, Revocation, RevocationList,
+                        RevocationStore, revocation_list_from_uri)
+
+
+NOW = 1_000_000.0
+
+
+def _claims(jti="jti-1", client_id="client-a", iat=NOW - 100):
+    return {"jti": jti, "client_id": client_id, "iat": iat}
+
+
+def test_empty_list_revokes_nothing():
+    assert DenyList().is_revoked(_claims(), NOW) is None
+
+
+def test_revoked_jti():
+    _d = DenyList([Revocation("jti", "jti-1", expires_at=NOW + 60)])
+    assert _d.is_revoked(_claims(), NOW) == "jti"
+    assert _d.is_revoked(_claims(jti="jti-2"), NOW) is None
+
+
+def test_revoked_client_until_it_expires():
+    _d = DenyList([Revocation("client_id", "client-a", expires_at=NOW + 60)])
+    assert _d.is_revoked(_claims(), NOW) == "client_id"
+    assert _d.is_revoked(_claims(client_id="client-b"), NOW) is None
+    assert _d.is_revoked(_claims(), NOW + 61) is None
+
+
+def test_issued_before_of_one_client_or_all():
+    _d = DenyList([Revocation("issued_before", NOW - 50, client_id="client-a")])
+    assert _d.is_revoked(_claims(), NOW) == "issued_before"
+    assert _d.is_revoked(_claims(iat=NOW - 10), NOW) is None
+    assert _d.is_revoked(_claims(client_id="client-b"), NOW) is None
+
+    _d.add(Revocation("issued_before", NOW - 50))
+    assert _d.is_revoked(_claims(client_id="client-b"), NOW) == "issued_before"
+
+
+def test_issued_before_expires():
+    _d = DenyList([
+        Revocation("issued_before", NOW - 50, expires_at=NOW + 60),
+        Revocation("issued_before", NOW - 200, expires_at=NOW + 600),
+    ])
+    assert _d.is_revoked(_claims(), NOW) == "issued_before"
+    # The later cutoff expired, the earlier one is still in force
+    assert _d.is_revoked(_claims(), NOW + 61) is None
+    assert _d.is_revoked(_claims(iat=NOW - 300), NOW + 61) == "issued_before"
+    assert _d.is_revoked(_claims(iat=NOW - 300), NOW + 601) is None
+
+
+def test_prune_drops_expired_entries():
+    _d = DenyList([
+        Revocation("jti", "jti-1", expires_at=NOW + 10),
+        Revocation("client_id", "client-b", expires_at=NOW + 10),
+        Revocation("client_id", "client-c"),
+        Revocation("issued_before", NOW - 50, expires_at=NOW + 10),
+        Revocation("issued_before", NOW - 60, client_id="client-a"),
+    ])
+    assert len(_d) == 5
+    _d.prune(NOW + 11)
+    assert len(_d) == 2
+    assert _d.is_revoked(_claims(client_id="client-c"), NOW + 11) == "client_id"
+    assert _d.is_revoked(_claims(), NOW + 11) == "issued_before"
+
+
+def test_same_cutoff_lasts_as_long_as_the_later_entry():
+    _d = DenyList([
+        Revocation("issued_before", NOW - 50, expires_at=NOW + 60),
+        Revocation("issued_before", NOW - 50, expires_at=NOW + 10),
+    ])
+    assert _d.is_revoked(_claims(), NOW + 30) == "issued_before"
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        RevocationStore()
+
+
+def test_list_picks_up_new_revocations_on_refresh():
+    store = InMemoryRevocationStore()
+    revocations = RevocationList(store, refresh_interval=10, full_sync_interval=300)
+    revocations.refresh(NOW)
+    assert revocations._deny_list.is_revoked(_claims(), NOW) is None
+
+    # Written by another container, seen by the next incremental refresh
+    store.put(Revocation("jti", "jti-1", expires_at=NOW + 3600, revoked_at=NOW + 1))
+    revocations.refresh(NOW + 11)
+    assert revocations._deny_list.is_revoked(_claims(), NOW + 11) == "jti"
+
+
+def test_full_sync_drops_deleted_and_expired_entries():
+    store = InMemoryRevocationStore()
+    store.put(Revocation("jti", "jti-1", expires_at=NOW + 3600, revoked_at=NOW))
+    store.put(Revocation("jti", "jti-2", expires_at=NOW + 5, revoked_at=NOW))
+    revocations = RevocationList(store, full_sync_interval=300)
+    revocations.refresh(NOW)
+    assert len(revocations) == 2
+
+    store._revocations.pop(0)
+    revocations.refresh(NOW + 301)
+    assert len(revocations) == 0
+
+
+def test_failed_refresh_keeps_the_list():
+    class FailingStore(InMemoryRevocationStore):
+        fail = False
+
+        def since(self, revoked_after=None):
+            if self.fail:
+                raise ConnectionError("table unreachable")
+            return super().since(revoked_after)
+
+    store = FailingStore()
+    store.put(Revocation("jti", "jti-1", expires_at=NOW + 3600, revoked_at=NOW))
+    revocations = RevocationList(store, refresh_interval=10)
+    revocations.refresh(NOW)
+    store.fail = True
+    revocations.refresh(NOW + 400)
+    assert revocations._deny_list.is_revoked(_claims(), NOW + 400) == "jti"
+    assert revocations._next_refresh == NOW + 410
+
+
+def test_list_from_uri():
+    assert revocation_list_from_uri("") is None
+    assert isinstance(revocation_list_from_uri("memory").store, InMemoryRevocationStore)
+    with pytest.raises(ValueError):
+        revocation_list_from_uri("redis:host")
@@ -0,0 +1,73 @@
+from route_policy import CompiledRoutePolicy
+
+READ, WRITE = "premium_api/read", "premium_api/write"
+
+
+def _policy():
+    return CompiledRoutePolicy([
+        ("GET", "/home/premium", [READ]),
+        ("post", "/home/premium", [WRITE]),
+        ("POST", "/home/premium/batch", [READ]),
+        ("DELETE", "/home/premium", [READ, WRITE]),
+    ])
+
+
+def test_scope_claim_is_a_bitmask_of_the_known_scopes():
+    policy = _policy()
+    assert policy.scope_mask("") == 0
+    assert policy.scope_mask(READ) == policy.scope_bits[READ]
+    assert policy.scope_mask(f"{WRITE} openid {READ}") == \
+        policy.scope_bits[READ] | policy.scope_bits[WRITE]
+
+
+def test_route_needs_any_one_scope_it_lists():
+    policy = _policy()
+    read, write = policy.scope_mask(READ), policy.scope_mask(WRITE)
+    assert policy.is_allowed("GET", "/home/premium", read)
+    assert not policy.is_allowed("POST", "/home/premium", read)
+    # Like API Gateway's authorization_scopes, one of them is enough
+    assert policy.is_allowed("DELETE", "/home/premium", read)
+    assert policy.is_allowed("DELETE", "/home/premium", write)
+    assert not policy.is_allowed("DELETE", "/home/premium", 0)
+
+
+def test_route_without_scopes_is_open():
+    policy = CompiledRoutePolicy([("GET", "/health", []), ("GET", "/home/premium", [READ])])
+    assert policy.is_allowed("GET", "/health", 0)
+    assert policy.allowed_routes(0) == (("GET", "/health"),)
+
+
+def test_unknown_routes_are_never_allowed():
+    policy = _policy()
+    everything = policy.scope_mask(f"{READ} {WRITE}")
+    assert policy.required_mask("GET", "/home/other") is None
+    assert not policy.is_allowed("GET", "/home/other", everything)
+    assert not policy.is_allowed("PUT", "/home/premium", everything)
+
+
+def test_allowed_routes_in_declaration_order():
+    policy = _policy()
+    assert policy.allowed_routes(policy.scope_mask(READ)) == (
+        ("GET", "/home/premium"), ("POST", "/home/premium/batch"), ("DELETE", "/home/premium"))
+    assert policy.allowed_routes(0) == ()
+    assert len(policy.allowed_routes(policy.scope_mask(f"{READ} {WRITE}"))) == 4
+
+
+def test_scopes_for_a_route():
+    policy = _policy()
+    assert policy.scopes_for("post", "/home/premium") == [WRITE]
+    assert policy.scopes_for("DELETE", "/home/premium") == [READ, WRITE]
+
+
+def test_json_round_trip_keeps_the_policy():
+    policy = _policy()
+    shipped = CompiledRoutePolicy.from_json(policy.to_json())
+    assert shipped.routes() == policy.routes()
+    assert dict(shipped.route_masks) == dict(policy.route_masks)
+    assert shipped.scopes_for("DELETE", "/home/premium") == [READ, WRITE]
+
+
+def test_empty_policy_allows_nothing():
+    policy = CompiledRoutePolicy.from_json("{}")
+    assert policy.routes() == []
+    assert not policy.is_allowed("GET", "/home/premium", policy.scope_mask(READ))
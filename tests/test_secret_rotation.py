@@ -0,0 +1,254 @@
+import base64
+import copy
+import itertools
+import json
+
+import pytest
+
+import secret_rotation
+from shared import http_client
+
+
+ARN = "arn:aws:secretsmanager:us-east-1:111122223333:secret:cognito_pool"
+
+
+class ResourceNotFoundException(Exception):
+    pass
+
+
+class FakeSecretsManager:
+    """ One secret, its versions and their stages """
+
+    class exceptions:
+        ResourceNotFoundException = ResourceNotFoundException
+
+    def __init__(self, doc):
+        self.rotation_enabled = True
+        self.values = {"v0": json.dumps(doc)}
+        self.stages = {"v0": ["AWSCURRENT"]}
+
+    def start_rotation(self, token):
+        """ Secrets Manager stages the new version before calling createSecret """
+        for _stages in self.stages.values():
+            if "AWSPENDING" in _stages:
+                _stages.remove("AWSPENDING")
+        self.stages[token] = ["AWSPENDING"]
+
+    def document(self, stage="AWSCURRENT"):
+        return json.loads(self.get_secret_value(SecretId=ARN, VersionStage=stage)["SecretString"])
+
+    def describe_secret(self, SecretId):
+        return {"RotationEnabled": self.rotation_enabled,
+                "VersionIdsToStages": copy.deepcopy(self.stages)}
+
+    def get_secret_value(self, SecretId, VersionId=None, VersionStage="AWSCURRENT"):
+        for _v, _stages in self.stages.items():
+            if (VersionId in (None, _v)) and VersionStage in _stages and _v in self.values:
+                return {"SecretString": self.values[_v], "VersionId": _v}
+        raise ResourceNotFoundException(f"{VersionId} {VersionStage}")
+
+    def put_secret_value(self, SecretId, ClientRequestToken, SecretString, VersionStages):
+        self.values[ClientRequestToken] = SecretString
+        self.stages.setdefault(ClientRequestToken, [])
+        for _s in VersionStages:
+            if _s not in self.stages[ClientRequestToken]:
+                self.stages[ClientRequestToken].append(_s)
+
+    def update_secret_version_stage(self, SecretId, VersionStage, MoveToVersionId, RemoveFromVersionId):
+        self.stages[RemoveFromVersionId].remove(VersionStage)
+        self.stages[MoveToVersionId].append(VersionStage)
+
+
+class FakeCognito:
+    """ Client secrets of the app clients, at most two each """
+
+    def __init__(self, secrets):
+        self._ids = itertools.count(1)
+        self.secrets = {
+            client_id: [{"ClientSecretId": f"id-{next(self._ids)}", "ClientSecretValue": value}]
+            for client_id, value in secrets.items()}
+
+    def list_user_pool_client_secrets(self, UserPoolId, ClientId, **kwargs):
+        # Cognito only ever hands back the ids
+        return {"ClientSecrets": [{"ClientSecretId": _s["ClientSecretId"]}
+                                  for _s in self.secrets[ClientId]]}
+
+    def add_user_pool_client_secret(self, UserPoolId, ClientId):
+        if len(self.secrets[ClientId]) >= 2:
+            raise ValueError(f"{ClientId} holds two secrets already")
+        _n = next(self._ids)
+        _s = {"ClientSecretId": f"id-{_n}", "ClientSecretValue": f"secret-{_n}"}
+        self.secrets[ClientId].append(_s)
+        return {"ClientSecretDescriptor": dict(_s)}
+
+    def delete_user_pool_client_secret(self, UserPoolId, ClientId, ClientSecretId):
+        self.secrets[ClientId] = [
+            _s for _s in self.secrets[ClientId] if _s["ClientSecretId"] != ClientSecretId]
+
+    def valid(self, client_id, secret):
+        return any(_s["ClientSecretValue"] == secret for _s in self.secrets.get(client_id, []))
+
+
+class FakeResponse:
+    def __init__(self, status, body):
+        self.status = status
+        self.data = json.dumps(body).encode()
+
+
+def _document():
+    return {
+        "user_pool_id": "us-east-1_pool",
+        "user_pool_client_id": "client-a",
+        "app_client_secret": "secret-a",
+        "user_pool_oauth2_endpoint": "https://auth.example/oauth2/token",
+        "unicorn_user_pool_res_srv_identifier": "premium_api",
+        "app_clients": {
+            "client-a": {"client_name": "a", "app_client_secret": "secret-a", "scopes": ["read"]},
+            "client-b": {"client_name": "b", "app_client_secret": "secret-b", "scopes": ["read"]},
+        }
+    }
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    sm = FakeSecretsManager(_document())
+    cognito = FakeCognito({"client-a": "secret-a", "client-b": "secret-b"})
+    clients = {"secretsmanager": sm, "cognito-idp": cognito}
+    monkeypatch.setattr(secret_rotation, "client", lambda service_name: clients[service_name])
+
+    def _token_endpoint(method, url, headers=None, fields=None, timeout=None, **kwargs):
+        _id, _, _secret = base64.b64decode(
+            headers["Authorization"][len("Basic "):]).decode().partition(":")
+        if cognito.valid(_id, _secret):
+            return FakeResponse(200, {"access_token": f"token-of-{_id}", "expires_in": 3600})
+        return FakeResponse(400, {"error": "invalid_client"})
+    monkeypatch.setattr(http_client, "request", _token_endpoint)
+    return sm, cognito
+
+
+def _step(step, token):
+    secret_rotation.lambda_handler(
+        {"SecretId": ARN, "ClientRequestToken": token, "Step": step}, None)
+
+
+def _rotate(sm, token):
+    sm.start_rotation(token)
+    for step in ("createSecret", "setSecret", "testSecret", "finishSecret"):
+        _step(step, token)
+
+
+def _mints(cognito, doc, client_id):
+    return cognito.valid(client_id, secret_rotation._field(doc, client_id, "app_client_secret"))
+
+
+def test_rotation_keeps_the_old_secrets_valid(aws):
+    sm, cognito = aws
+    old = sm.document()
+    _rotate(sm, "v1")
+
+    new = sm.document()
+    assert "AWSCURRENT" in sm.stages["v1"] and "AWSCURRENT" not in sm.stages["v0"]
+    for client_id in ("client-a", "client-b"):
+        assert secret_rotation._field(new, client_id, "app_client_secret") != \
+            secret_rotation._field(old, client_id, "app_client_secret")
+        assert _mints(cognito, new, client_id)
+        # Consumers still holding the old document keep minting
+        assert _mints(cognito, old, client_id)
+    # The primary client's top level fields are rotated along with its entry
+    assert new["app_client_secret"] == new["app_clients"]["client-a"]["app_client_secret"]
+
+
+def test_next_rotation_removes_the_secrets_replaced_before(aws):
+    sm, cognito = aws
+    first = sm.document()
+    _rotate(sm, "v1")
+    second = sm.document()
+    _rotate(sm, "v2")
+
+    assert "AWSCURRENT" in sm.stages["v2"] and "AWSCURRENT" not in sm.stages["v1"]
+    for client_id in ("client-a", "client-b"):
+        assert len(cognito.secrets[client_id]) == 2
+        assert not _mints(cognito, first, client_id)
+        assert _mints(cognito, second, client_id)
+        assert _mints(cognito, sm.document(), client_id)
+
+
+def test_create_secret_is_idempotent(aws):
+    sm, cognito = aws
+    sm.start_rotation("v1")
+    _step("createSecret", "v1")
+    pending = sm.document("AWSPENDING")
+    _step("createSecret", "v1")
+    assert sm.document("AWSPENDING") == pending
+    assert all(len(_s) == 2 for _s in cognito.secrets.values())
+
+
+def test_retried_create_after_a_failed_attempt(aws):
+    sm, cognito = aws
+    _rotate(sm, "v1")
+    current = sm.document()
+    sm.start_rotation("v2")
+    _step("createSecret", "v2")
+    # The attempt failed before it was finished, Secrets Manager tries again
+    # with a new version, the secrets the failed one added are replaced
+    _rotate(sm, "v3")
+    assert all(len(_s) == 2 for _s in cognito.secrets.values())
+    for client_id in ("client-a", "client-b"):
+        assert _mints(cognito, current, client_id)
+        assert _mints(cognito, sm.document(), client_id)
+
+
+def test_set_secret_checks_cognito_holds_the_new_secrets(aws):
+    sm, cognito = aws
+    sm.start_rotation("v1")
+    _step("createSecret", "v1")
+    cognito.secrets["client-b"] = cognito.secrets["client-b"][:1]
+    with pytest.raises(ValueError, match="client-b"):
+        _step("setSecret", "v1")
+
+
+def test_failed_test_step_leaves_the_current_version(aws):
+    sm, cognito = aws
+    sm.start_rotation("v1")
+    _step("createSecret", "v1")
+    _step("setSecret", "v1")
+    cognito.secrets["client-b"] = cognito.secrets["client-b"][:1]
+    with pytest.raises(ValueError, match="got no token"):
+        _step("testSecret", "v1")
+    assert sm.stages["v0"] == ["AWSCURRENT"]
+
+
+def test_clients_without_a_secret_are_not_rotated(aws):
+    sm, cognito = aws
+    doc = _document()
+    # The retriever keeps an empty secret for a client that has none
+    doc["app_clients"]["client-c"] = {"client_name": "c", "app_client_secret": "", "scopes": ["read"]}
+    sm.values["v0"] = json.dumps(doc)
+    _rotate(sm, "v1")
+    assert sm.document()["app_clients"]["client-c"] == doc["app_clients"]["client-c"]
+
+
+def test_finish_on_the_current_version_does_nothing(aws):
+    sm, cognito = aws
+    _rotate(sm, "v1")
+    stages = copy.deepcopy(sm.stages)
+    secret_rotation.finish_secret(sm, ARN, "v1")
+    assert sm.stages == stages
+
+
+@pytest.mark.parametrize("change", ["disabled", "unknown_version", "not_pending", "unknown_step"])
+def test_handler_refuses_bad_requests(aws, change):
+    sm, cognito = aws
+    sm.start_rotation("v1")
+    step = "createSecret"
+    token = "v1"
+    if change == "disabled":
+        sm.rotation_enabled = False
+    elif change == "unknown_version":
+        token = "v9"
+    elif change == "not_pending":
+        sm.stages["v1"] = []
+    else:
+        step = "cleanupSecret"
+    with pytest.raises(ValueError):
+        _step(step, token)
@@ -0,0 +1,185 @@
+import threading
+import time
+
+import pytest
+
+from token_cache import TokenCache
+from token_store import InMemoryTokenStore
+
+
+class Minter:
+    """ `fetch_fn` handing out numbered tokens that live `expires_in` seconds """
+
+    def __init__(self, expires_in=3600):
+        self.expires_in = expires_in
+        self.calls = []
+
+    def __call__(self, scope):
+        self.calls.append(scope)
+        return f"{scope}-token-{len(self.calls)}", self.expires_in
+
+
+def test_token_is_reused_until_close_to_expiry():
+    mint = Minter()
+    cache = TokenCache(mint, expiry_skew=30, refresh_window=120)
+
+    assert cache.get("read") == "read-token-1"
+    assert cache.get("read") == "read-token-1"
+    assert mint.calls == ["read"]
+
+
+def test_tokens_are_kept_per_scope():
+    mint = Minter()
+    cache = TokenCache(mint)
+
+    assert cache.get("read") == "read-token-1"
+    assert cache.get("write") == "write-token-2"
+    assert cache.get(("client-a", "read")) == "('client-a', 'read')-token-3"
+    assert cache.get("read") == "read-token-1"
+
+
+def test_token_within_expiry_skew_is_minted_again():
+    mint = Minter(expires_in=20)
+    cache = TokenCache(mint, expiry_skew=30, refresh_window=0)
+
+    assert cache.get("read") == "read-token-1"
+    assert cache.get("read") == "read-token-2"
+
+
+def test_invalidate_drops_one_scope_or_all():
+    mint = Minter()
+    cache = TokenCache(mint)
+    cache.get("read")
+    cache.get("write")
+
+    cache.invalidate("read")
+    assert cache.get("read") == "read-token-3"
+    assert cache.get("write") == "write-token-2"
+
+    cache.invalidate()
+    assert cache.get("write") == "write-token-4"
+
+
+def test_failed_mint_is_raised_and_not_cached():
+    def _fail(scope):
+        raise RuntimeError("token endpoint down")
+
+    cache = TokenCache(_fail)
+    with pytest.raises(RuntimeError):
+        cache.get("read")
+    cache.fetch_fn = Minter()
+    assert cache.get("read") == "read-token-1"
+
+
+class SlowMinter(Minter):
+    """ `Minter` that holds every call until `release` is set """
+
+    def __init__(self, expires_in=3600):
+        super().__init__(expires_in)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, scope):
+        self.started.set()
+        assert self.release.wait(5)
+        return super().__call__(scope)
+
+
+def _run(fn, n):
+    results, threads = [None] * n, []
+    for i in range(n):
+        def _call(i=i):
+            try:
+                results[i] = fn()
+            except Exception as e:
+                results[i] = e
+        threads.append(threading.Thread(target=_call))
+        threads[-1].start()
+    return results, threads
+
+
+def test_concurrent_misses_share_one_mint():
+    mint = SlowMinter()
+    cache = TokenCache(mint)
+    results, threads = _run(lambda: cache.get("read"), 8)
+    assert mint.started.wait(5)
+    time.sleep(0.05)
+    mint.release.set()
+    for t in threads:
+        t.join(5)
+
+    assert mint.calls == ["read"]
+    assert results == ["read-token-1"] * 8
+
+
+def test_concurrent_misses_share_the_failure():
+    release = threading.Event()
+
+    def _fail(scope):
+        assert release.wait(5)
+        raise RuntimeError("token endpoint down")
+
+    cache = TokenCache(_fail)
+    results, threads = _run(lambda: cache.get("read"), 4)
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert not cache._inflight
+
+
+def test_token_in_the_refresh_window_is_refreshed_inline(monkeypatch):
+    # The lambda freezes threads between invocations, none may be started
+    monkeypatch.setattr(threading.Thread, "start", lambda self: pytest.fail("thread started"))
+    mint = Minter(expires_in=100)
+    cache = TokenCache(mint, expiry_skew=30, refresh_window=120)
+
+    assert cache.get("read") == "read-token-1"
+    assert cache.get("read") == "read-token-2"
+    assert mint.calls == ["read", "read"]
+
+
+def test_failed_early_refresh_keeps_the_cached_token():
+    mint = Minter(expires_in=100)
+    cache = TokenCache(mint, expiry_skew=30, refresh_window=120)
+    cache.get("read")
+
+    def _fail(scope):
+        raise RuntimeError("token endpoint down")
+    cache.fetch_fn = _fail
+    assert cache.get("read") == "read-token-1"
+    assert not cache._inflight
+
+    # The next caller tries again
+    cache.fetch_fn = mint
+    assert cache.get("read") == "read-token-2"
+
+
+def test_early_refresh_does_not_wait_on_a_refresh_in_flight():
+    mint = SlowMinter(expires_in=100)
+    mint.release.set()
+    cache = TokenCache(mint, expiry_skew=30, refresh_window=120)
+    cache.get("read")
+
+    mint.release.clear()
+    results, threads = _run(lambda: cache.get("read"), 1)
+    assert mint.started.wait(5)
+    # Served the cached token while the first caller refreshes it
+    assert cache.get("read") == "read-token-1"
+    mint.release.set()
+    threads[0].join(5)
+    assert results == ["read-token-2"]
+    assert cache._tokens["read"].access_token == "read-token-2"
+
+
+def test_early_refresh_keeps_the_token_while_another_container_holds_the_lease():
+    store = InMemoryTokenStore()
+    cache = TokenCache(Minter(expires_in=100), expiry_skew=30,
+                       refresh_window=120, store=store, lease_wait=5)
+    cache.get("read")
+    assert store.acquire_lease("read", "other-container", ttl=30)
+
+    started = time.time()
+    assert cache.get("read") == "read-token-1"
+    assert time.time() - started < 1
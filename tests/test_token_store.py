@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+from token_cache import TokenCache
+from token_store import (DynamoDBTokenStore, EncryptedTokenStore, FileTokenStore,
+                         InMemoryTokenStore, SqliteTokenStore, SsmTokenStore,
+                         token_store_from_uri)
+
+
+@pytest.fixture(params=["memory", "file", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryTokenStore()
+    if request.param == "file":
+        return FileTokenStore(str(tmp_path / "tokens"))
+    return SqliteTokenStore(str(tmp_path / "tokens.db"))
+
+
+def test_put_is_versioned(store):
+    assert store.get("client:read") is None
+    assert store.put("client:read", "token-1", 100.0)
+    _s = store.get("client:read")
+    assert (_s.access_token, _s.expires_at) == ("token-1", 100.0)
+
+    # Publishing again needs the version that was read
+    assert not store.put("client:read", "token-x", 200.0)
+    assert store.put("client:read", "token-2", 200.0, _s.version)
+    assert not store.put("client:read", "token-y", 300.0, _s.version)
+    assert store.get("client:read").access_token == "token-2"
+
+
+def test_lease_has_a_single_owner(store):
+    assert store.acquire_lease("client:read", "a", ttl=30)
+    assert not store.acquire_lease("client:read", "b", ttl=30)
+    # The owner may renew it, only the owner releases it
+    assert store.acquire_lease("client:read", "a", ttl=30)
+    store.release_lease("client:read", "b")
+    assert not store.acquire_lease("client:read", "b", ttl=30)
+    store.release_lease("client:read", "a")
+    assert store.acquire_lease("client:read", "b", ttl=30)
+
+
+def test_expired_lease_is_taken_over(store):
+    assert store.acquire_lease("client:read", "a", ttl=-1)
+    assert store.acquire_lease("client:read", "b", ttl=30)
+    assert not store.acquire_lease("client:read", "a", ttl=30)
+
+
+def test_leases_are_per_key(store):
+    assert store.acquire_lease("client:read", "a", ttl=30)
+    assert store.acquire_lease("client:write", "b", ttl=30)
+
+
+class FakeCipher:
+    def encrypt(self, plaintext, context):
+        return f"enc[{context['token_key']}]{plaintext}"
+
+    def decrypt(self, ciphertext, context):
+        prefix = f"enc[{context['token_key']}]"
+        if not ciphertext.startswith(prefix):
+            raise ValueError("encryption context mismatch")
+        return ciphertext[len(prefix):]
+
+
+def test_encrypted_store_keeps_only_ciphertext():
+    inner = InMemoryTokenStore()
+    store = EncryptedTokenStore(inner, FakeCipher())
+    assert store.put("client:read", "token-1", 100.0)
+    assert inner.get("client:read").access_token == "enc[client:read]token-1"
+    assert store.get("client:read").access_token == "token-1"
+
+    # A ciphertext copied under another key does not decrypt
+    inner.put("client:write", inner.get("client:read").access_token, 100.0)
+    with pytest.raises(ValueError):
+        store.get("client:write")
+
+
+class ConditionalCheckFailed(Exception):
+    response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.put_calls = []
+        self.fail = False
+
+    def put_item(self, **kwargs):
+        self.put_calls.append(kwargs)
+        if self.fail:
+            raise ConditionalCheckFailed()
+
+
+def test_dynamodb_store_maps_failed_conditions_to_false():
+    ddb = FakeDynamoDB()
+    store = DynamoDBTokenStore("tokens", client_factory=lambda: ddb)
+    assert store.put("client:read", "token-1", 100.0)
+    assert ddb.put_calls[-1]["ConditionExpression"] == "attribute_not_exists(pk)"
+    assert store.acquire_lease("client:read", "a", ttl=30)
+
+    ddb.fail = True
+    assert not store.put("client:read", "token-2", 200.0, version=1)
+    assert ddb.put_calls[-1]["ExpressionAttributeValues"] == {":v": {"N": "1"}}
+    assert not store.acquire_lease("client:read", "b", ttl=30)
+
+
+def test_store_from_uri(tmp_path):
+    assert token_store_from_uri("") is None
+    assert token_store_from_uri("none") is None
+    assert isinstance(token_store_from_uri("memory"), InMemoryTokenStore)
+    assert isinstance(token_store_from_uri(f"sqlite:{tmp_path}/t.db"), SqliteTokenStore)
+    assert isinstance(token_store_from_uri("ssm:/tokens", "key-id"), SsmTokenStore)
+    assert isinstance(token_store_from_uri("memory", "key-id"), EncryptedTokenStore)
+    with pytest.raises(ValueError):
+        token_store_from_uri("redis:host")
+
+
+def test_containers_sharing_a_store_mint_once(store):
+    calls = []
+    release = threading.Event()
+
+    def _mint(key):
+        calls.append(key)
+        assert release.wait(5)
+        return f"token-{len(calls)}", 3600
+
+    # Two containers, each with its own cache
+    caches = [TokenCache(_mint, store=store, lease_wait=5) for _ in range(2)]
+    results = [None, None]
+
+    def _get(i):
+        results[i] = caches[i].get(("client", "read"))
+    threads = [threading.Thread(target=_get, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert calls == [("client", "read")]
+    assert results == ["token-1", "token-1"]
+    assert store.get("client:read").access_token == "token-1"
+
+
+def test_store_is_abstract():
+    from token_store import TokenStore
+    with pytest.raises(TypeError):
+        TokenStore()